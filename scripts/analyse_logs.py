@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Analyse tile server access logs (Apache/nginx common or combined format, or morgan's dev format; gzipped or not) to size the
+tilelive-cache (tessera -C, in MB) and pick hot tiles to warm on boot. Requests are counted per layer, zoom and tile, and
+heatmaps of requests per tile at a chosen zoom are written as GeoJSON. The request stream is replayed through simulated LRU
+and LFU caches bounded by bytes, as tilelive-cache is, to give hit ratio curves. For each deployment (deployments/<name>.json,
+as uploaded by deploy.py) the smallest cache within a margin of the best hit ratio is recommended, and the most requested
+tiles are written in the --hot-tiles format of server/download_data.py
+'''
+
+import argparse
+import glob
+import gzip
+import heapq
+import json
+import math
+import os
+import re
+import sqlite3
+from collections import Counter, OrderedDict
+
+from mbtiles import tile_bounds
+
+TILE_PATH = r'/(?P<layer>[^/\s?]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.pbf'
+LOG_FORMATS = [
+    # Common/combined: 1.2.3.4 - - [date] "GET /layer/z/x/y.pbf HTTP/1.1" 200 1234 ...
+    re.compile(r'"(?:GET|HEAD) [^"\s]*?' + TILE_PATH + r'[^"\s]* [^"]*" (?P<status>\d{3}) (?P<bytes>\d+|-)'),
+    # morgan dev: GET /layer/z/x/y.pbf 200 12.345 ms - 1234
+    re.compile(r'(?:GET|HEAD) [^\s]*?' + TILE_PATH + r'\S* (?P<status>\d{3}) [\d.]+ ms - (?P<bytes>\d+|-)')
+]
+CACHE_SIZES = [16, 32, 64, 128, 256, 512, 1024, 2048, 4096] # MB
+DEFAULT_TILE_SIZE = 20 * 1024 # Bytes assumed for tiles with no size in the logs or mbtiles
+ANSI = re.compile(r'\x1b\[[0-9;]*m') # morgan dev colours its output
+
+
+def parse_line(line):
+    'A tile request (layer, z, x, y, status, bytes or None) from a log line, or None if the line is not a tile request'
+    line = ANSI.sub('', line)
+    for log_format in LOG_FORMATS:
+        match = log_format.search(line)
+        if match:
+            size = match.group('bytes')
+            return (match.group('layer'), int(match.group('z')), int(match.group('x')), int(match.group('y')),
+                    int(match.group('status')), int(size) if size != '-' else None)
+    return None
+
+
+def read_requests(filenames):
+    'Yield the successful tile requests in log files, in order'
+    for filename in filenames:
+        with (gzip.open(filename, 'rt', errors='replace') if filename.endswith('.gz') else open(filename, errors='replace')) as f:
+            for line in f:
+                request = parse_line(line)
+                if request is not None and request[4] in (200, 204, 304):
+                    yield request
+
+
+class TileSizes:
+    'Size of each tile: from the logs where given, otherwise from data/<layer>.mbtiles if it exists, otherwise a default'
+    def __init__(self, data_dir='data', default=DEFAULT_TILE_SIZE):
+        self.data_dir = data_dir
+        self.default = default
+        self.sizes = {}
+        self.databases = {}
+
+    def add(self, tile, size):
+        if size:
+            self.sizes[tile] = size
+
+    def get(self, tile):
+        if tile not in self.sizes:
+            layer, z, x, y = tile
+            if layer not in self.databases:
+                filename = os.path.join(self.data_dir, '{}.mbtiles'.format(layer))
+                self.databases[layer] = sqlite3.connect('file:{}?mode=ro'.format(filename), uri=True) if os.path.exists(filename) else None
+            db = self.databases[layer]
+            row = db.execute('SELECT length(tile_data) FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                             (z, x, (1 << z) - 1 - y)).fetchone() if db is not None else None
+            self.sizes[tile] = row[0] if row and row[0] else self.default
+        return self.sizes[tile]
+
+
+def simulate_lru(stream, capacity):
+    'Replay (tile, size) requests through an LRU cache of capacity bytes. Returns (hits, hit bytes)'
+    cache = OrderedDict()
+    used = hits = hit_bytes = 0
+    for tile, size in stream:
+        if tile in cache:
+            cache.move_to_end(tile)
+            hits += 1
+            hit_bytes += size
+            continue
+        if size > capacity:
+            continue
+        cache[tile] = size
+        used += size
+        while used > capacity:
+            _, evicted = cache.popitem(last=False)
+            used -= evicted
+    return hits, hit_bytes
+
+
+def simulate_lfu(stream, capacity):
+    '''
+    Replay (tile, size) requests through an LFU cache of capacity bytes, evicting the least frequently requested tile (the
+    least recently requested of those tied). Frequencies are counted while a tile is cached. Returns (hits, hit bytes)
+    '''
+    cache = {} # tile: (frequency, last request, size)
+    heap = [] # (frequency, last request, tile), with stale entries skipped when popped
+    used = hits = hit_bytes = 0
+    for i, (tile, size) in enumerate(stream):
+        if tile in cache:
+            frequency, _, size = cache[tile]
+            cache[tile] = (frequency + 1, i, size)
+            heapq.heappush(heap, (frequency + 1, i, tile))
+            hits += 1
+            hit_bytes += size
+            continue
+        if size > capacity:
+            continue
+        cache[tile] = (1, i, size)
+        heapq.heappush(heap, (1, i, tile))
+        used += size
+        while used > capacity:
+            frequency, last, evicted = heapq.heappop(heap)
+            if cache.get(evicted, (None, None))[:2] == (frequency, last):
+                used -= cache.pop(evicted)[2]
+        if len(heap) > 4 * len(cache) + 1024: # Drop stale entries now and then
+            heap = [(frequency, last, t) for t, (frequency, last, _) in cache.items()]
+            heapq.heapify(heap)
+    return hits, hit_bytes
+
+
+def hit_ratio_curves(stream, cache_sizes=CACHE_SIZES):
+    'Hit ratios of LRU and LFU caches of each size (in MB) for a list of (tile, size) requests'
+    total_bytes = sum(size for _, size in stream)
+    curves = OrderedDict()
+    for policy, simulate in [('lru', simulate_lru), ('lfu', simulate_lfu)]:
+        curves[policy] = []
+        for megabytes in cache_sizes:
+            hits, hit_bytes = simulate(stream, megabytes * 1024**2)
+            curves[policy].append(OrderedDict([
+                ('cache_mb', megabytes),
+                ('hit_ratio', hits / len(stream) if stream else 0),
+                ('byte_hit_ratio', hit_bytes / total_bytes if total_bytes else 0)
+            ]))
+    return curves
+
+
+def recommend(curve, margin=0.01):
+    'The smallest cache size (MB) with a hit ratio within margin of the best in a curve'
+    best = max(point['hit_ratio'] for point in curve)
+    return next(point['cache_mb'] for point in curve if point['hit_ratio'] >= best - margin)
+
+
+def hot_tiles(counts, share=0.5, max_tiles=1000):
+    '''
+    The most requested tiles, until they account for share of requests (or max_tiles), in the --hot-tiles format of
+    download_data.py: {layer: [{"z": z, "x": [x, x], "y": [y, y]}, ...]}
+    '''
+    total = sum(counts.values())
+    hot = OrderedDict()
+    covered = 0
+    for (layer, z, x, y), count in counts.most_common(max_tiles):
+        if covered >= share * total:
+            break
+        hot.setdefault(layer, []).append(OrderedDict([('z', z), ('x', [x, x]), ('y', [y, y])]))
+        covered += count
+    return hot
+
+
+def heatmap(counts, layer, zoom):
+    'GeoJSON of the tiles of a layer at zoom, with the number of requests within each (from zoom up)'
+    cells = Counter()
+    for (tile_layer, z, x, y), count in counts.items():
+        if tile_layer == layer and z >= zoom:
+            cells[x >> (z - zoom), y >> (z - zoom)] += count
+    features = []
+    for (x, y), count in sorted(cells.items()):
+        w, s, e, n = tile_bounds(zoom, x, y)
+        features.append(OrderedDict([
+            ('type', 'Feature'),
+            ('properties', OrderedDict([('z', zoom), ('x', x), ('y', y), ('requests', count), ('log_requests', math.log10(count))])),
+            ('geometry', {'type': 'Polygon', 'coordinates': [[[w, s], [e, s], [e, n], [w, n], [w, s]]]})
+        ]))
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def analyse(requests, sizes, deployments, cache_sizes=CACHE_SIZES, hot_share=0.5, max_hot_tiles=1000):
+    'Build the report for a list of requests. deployments maps deployment names to their layers'
+    counts = Counter((layer, z, x, y) for layer, z, x, y, _, _ in requests)
+    by_zoom = OrderedDict()
+    for (layer, z, _, _), count in sorted(counts.items()):
+        zooms = by_zoom.setdefault(layer, OrderedDict())
+        zooms[str(z)] = zooms.get(str(z), 0) + count
+    report = OrderedDict([
+        ('requests', len(requests)),
+        ('unique_tiles', len(counts)),
+        ('layers', OrderedDict((layer, OrderedDict([('requests', sum(zooms.values())), ('zooms', zooms)])) for layer, zooms in by_zoom.items())),
+        ('deployments', OrderedDict())
+    ])
+    for name, layers in deployments.items():
+        stream = [((layer, z, x, y), sizes.get((layer, z, x, y))) for layer, z, x, y, _, _ in requests if layer in layers]
+        deployment_counts = Counter({tile: count for tile, count in counts.items() if tile[0] in layers})
+        curves = hit_ratio_curves(stream, cache_sizes)
+        report['deployments'][name] = OrderedDict([
+            ('requests', len(stream)),
+            ('unique_tiles', len(deployment_counts)),
+            ('unique_bytes', sum(sizes.get(tile) for tile in deployment_counts)),
+            ('curves', curves),
+            ('recommended_cache_mb', recommend(curves['lru']) if stream else None), # tilelive-cache is an LRU cache
+            ('hot_tiles', hot_tiles(deployment_counts, hot_share, max_hot_tiles))
+        ])
+    return report, counts
+
+
+def load_deployments(filenames):
+    'Layers of each deployment file, by deployment name'
+    deployments = OrderedDict()
+    for filename in filenames:
+        with open(filename) as f:
+            deployments[os.path.splitext(os.path.basename(filename))[0]] = set(json.load(f)['data'])
+    return deployments
+
+
+def print_report(report):
+    for layer, stats in report['layers'].items():
+        print('{:40} {:>10} requests  '.format(layer, stats['requests']) + '  '.join('z{}: {}'.format(z, count) for z, count in stats['zooms'].items()))
+    for name, deployment in report['deployments'].items():
+        print('Deployment {}: {} requests for {} tiles ({:.1f}MB)'.format(name, deployment['requests'], deployment['unique_tiles'], deployment['unique_bytes'] / 1024**2))
+        print('  {:>8}  {:>9}  {:>9}'.format('Cache MB', 'LRU hits', 'LFU hits'))
+        for lru, lfu in zip(deployment['curves']['lru'], deployment['curves']['lfu']):
+            print('  {:>8}  {:>9.1%}  {:>9.1%}'.format(lru['cache_mb'], lru['hit_ratio'], lfu['hit_ratio']))
+        print('  Recommended: -C {}, {} hot tiles'.format(deployment['recommended_cache_mb'], sum(len(tiles) for tiles in deployment['hot_tiles'].values())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('logs', nargs='+', help='Access log files, oldest first (.gz files are read compressed)')
+    parser.add_argument('--deployments', nargs='*', help='deployments/<name>.json files to make recommendations for (default: every file in deployments/, or all layers)')
+    parser.add_argument('--cache-sizes', type=int, nargs='+', default=CACHE_SIZES, help='Cache sizes in MB to simulate')
+    parser.add_argument('--hot-share', type=float, default=0.5, help='Share of requests the hot tiles should cover (default: 0.5)')
+    parser.add_argument('--max-hot-tiles', type=int, default=1000)
+    parser.add_argument('--heatmap-zoom', type=int, default=8, help='Zoom of the tiles requests are counted in for heatmaps (default: 8)')
+    parser.add_argument('--data-dir', default='data', help='Directory of <layer>.mbtiles to look up tile sizes missing from the logs')
+    parser.add_argument('--output', default='log_analysis', help='Directory to write the report, heatmaps and hot tile lists to')
+    args = parser.parse_args()
+
+    sizes = TileSizes(args.data_dir)
+    requests = []
+    for request in read_requests(args.logs):
+        requests.append(request)
+        sizes.add(request[:4], request[5])
+    deployment_files = args.deployments if args.deployments is not None else sorted(glob.glob(os.path.join('deployments', '*.json')))
+    deployments = load_deployments(deployment_files) if deployment_files else OrderedDict([('all', {request[0] for request in requests})])
+    report, counts = analyse(requests, sizes, deployments, args.cache_sizes, args.hot_share, args.max_hot_tiles)
+
+    os.makedirs(args.output, exist_ok=True)
+    with open(os.path.join(args.output, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    for layer in report['layers']:
+        with open(os.path.join(args.output, 'heatmap-{}.json'.format(layer)), 'w') as f:
+            json.dump(heatmap(counts, layer, args.heatmap_zoom), f)
+    for name, deployment in report['deployments'].items():
+        with open(os.path.join(args.output, 'hot-tiles-{}.json'.format(name)), 'w') as f:
+            json.dump(deployment['hot_tiles'], f, indent=2)
+    print_report(report)
+    print('Report, heatmaps and hot tile lists (for download_data.py --hot-tiles) written to {}/'.format(args.output))
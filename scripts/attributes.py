@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'Columnar attribute access for OGR layers, so validation and region ID extraction can be vectorised with NumPy'
+
+import numpy as np
+from osgeo import ogr
+
+BATCH_SIZE = 65536
+
+# NumPy type and typed getter of the columns of each OGR field type read by feature (others are read with GetField)
+_FIELD_READERS = {
+    ogr.OFTInteger: (np.int64, ogr.Feature.GetFieldAsInteger64),
+    ogr.OFTInteger64: (np.int64, ogr.Feature.GetFieldAsInteger64),
+    ogr.OFTReal: (np.float64, ogr.Feature.GetFieldAsDouble),
+    ogr.OFTString: (object, ogr.Feature.GetFieldAsString)
+}
+
+
+def _as_array(values):
+    'Convert a batch of values from OGR into a NumPy array, decoding byte strings and keeping nulls as None'
+    if np.ma.isMaskedArray(values) and np.ma.is_masked(values):
+        # Nullable numeric columns with nulls, from the Arrow stream
+        return np.array([None if masked else value for value, masked in zip(values.data.tolist(), np.ma.getmaskarray(values).tolist())], dtype=object)
+    array = np.asarray(values)
+    if array.dtype.kind == 'S':
+        array = np.array([v.decode('utf-8') for v in array.tolist()], dtype=object)
+    elif array.dtype == object:
+        array = np.array([v.decode('utf-8') if isinstance(v, bytes) else v for v in array.tolist()], dtype=object)
+    return array
+
+
+class AttributeTable:
+    '''
+    Cache of attribute columns for an OGR layer, read in batches
+    Columns are only read when first requested, and all uncached columns requested together are read in one pass over the layer
+    '''
+    def __init__(self, layer, batch_size=BATCH_SIZE):
+        self.layer = layer
+        self.batch_size = batch_size
+        self.num_features = layer.GetFeatureCount()
+        layer_defn = layer.GetLayerDefn()
+        self.attributes = [layer_defn.GetFieldDefn(i).name for i in range(layer_defn.GetFieldCount())]
+        self._columns = {}
+
+    def _read_arrow(self, columns):
+        'Read columns through the GDAL Arrow stream interface (GDAL >= 3.6)'
+        batches = {column: [] for column in columns}
+        # Masked arrays mark the nulls of numeric columns, which would otherwise read as 0
+        stream = self.layer.GetArrowStreamAsNumPy(options=['INCLUDE_FID=NO', 'USE_MASKED_ARRAYS=YES', 'MAX_FEATURES_IN_BATCH={}'.format(self.batch_size)])
+        for batch in stream:
+            for column in columns:
+                batches[column].append(_as_array(batch[column]))
+        stream = None
+        return batches
+
+    def _read_features(self, columns):
+        '''
+        Read columns by iterating over features (GDAL < 3.6), with each value read by the typed getter of its field straight
+        into a NumPy array of the column's type, and nulls marked in a mask
+        '''
+        layer_defn = self.layer.GetLayerDefn()
+        size = max(self.num_features, 0) # -1 if the driver can't count features
+        fields = []
+        for column in columns:
+            index = layer_defn.GetFieldIndex(column)
+            dtype, getter = _FIELD_READERS.get(layer_defn.GetFieldDefn(index).GetType(), (object, ogr.Feature.GetField))
+            fields.append((index, getter, np.empty(size, dtype=dtype), np.zeros(size, dtype=bool)))
+        count = 0
+        for feature in self.layer:
+            if count == size: # More features than counted
+                size = max(2 * size, 1024)
+                fields = [(index, getter, np.concatenate([values, np.empty(size - count, dtype=values.dtype)]),
+                           np.concatenate([nulls, np.zeros(size - count, dtype=bool)])) for index, getter, values, nulls in fields]
+            for index, getter, values, nulls in fields:
+                if feature.IsFieldSetAndNotNull(index):
+                    values[count] = getter(feature, index)
+                else:
+                    nulls[count] = True
+            count += 1
+        batches = {}
+        for column, (index, getter, values, nulls) in zip(columns, fields):
+            values, nulls = values[:count], nulls[:count]
+            if nulls.any():
+                values = values.astype(object)
+                values[nulls] = None
+            batches[column] = [values]
+        return batches
+
+    def _concatenate(self, arrays):
+        'Join batches, falling back to an object array when batches have differing types (eg. nulls in some batches only)'
+        if not arrays:
+            return np.array([], dtype=object)
+        if len(set(array.dtype for array in arrays)) > 1:
+            arrays = [array.astype(object) for array in arrays]
+        return np.concatenate(arrays)
+
+    def columns(self, *names):
+        'Return a list of NumPy arrays for the named attributes, in layer order'
+        missing = [name for name in dict.fromkeys(names) if name not in self._columns]
+        if missing:
+            ignored = [attribute for attribute in self.attributes if attribute not in missing]
+            self.layer.SetIgnoredFields(ignored + ['OGR_GEOMETRY', 'OGR_STYLE'])
+            self.layer.ResetReading()
+            try:
+                if hasattr(self.layer, 'GetArrowStreamAsNumPy'):
+                    batches = self._read_arrow(missing)
+                else:
+                    batches = self._read_features(missing)
+            finally:
+                self.layer.SetIgnoredFields([])
+                self.layer.ResetReading()
+            for name in missing:
+                self._columns[name] = self._concatenate(batches[name])
+        return [self._columns[name] for name in names]
+
+    def column(self, name):
+        'Return a NumPy array for the named attribute, in layer order'
+        return self.columns(name)[0]
+
+
+def is_valid_fid(values, num_features):
+    'Determine if values number features from 0 to num_features - 1 in any order (as integers, or integral reals)'
+    if len(values) != num_features:
+        return False
+    if values.dtype == object:
+        if any(v is None for v in values.tolist()):
+            return False
+        try:
+            values = values.astype(np.float64)
+        except (TypeError, ValueError):
+            return False
+    if values.dtype.kind == 'f':
+        # Shapefile numeric fields are often read as Real
+        if not np.all(np.isfinite(values)) or not np.all(values == np.floor(values)):
+            return False
+        values = values.astype(np.int64)
+    if values.dtype.kind not in 'iu':
+        return False
+    if num_features == 0:
+        return True
+    if values.min() < 0 or values.max() >= num_features:
+        return False
+    return bool((np.bincount(values, minlength=num_features) == 1).all())
+
+
+def is_unique(values):
+    'Determine if values uniquely identify every feature (null values are never unique)'
+    if values.dtype == object:
+        items = values.tolist()
+        return None not in items and len(set(items)) == len(items)
+    return len(np.unique(values)) == len(values)
+
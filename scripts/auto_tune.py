@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Automatic tuning of tippecanoe's maxzoom, detail and simplification against a tile size budget. Candidate settings are tried
+in parallel on a sample of the layer: every feature within a few tiles (at a sample zoom) around randomly chosen features, so
+the sample is as dense as the layer itself where it has features. The tiles each candidate makes within the sample are measured,
+and the chosen settings are the cheapest (smallest sample tiles in total) with a p99 compressed tile size under the target and
+every sampled feature present at max zoom, keeping the highest max zoom for which any candidate meets the target
+'''
+
+import os
+import random
+import uuid
+from collections import OrderedDict
+from contextlib import closing
+
+import asyncio
+from asyncio.subprocess import DEVNULL
+from osgeo import ogr
+
+from mbtiles import open_mbtiles, decompress, tile_columns, column_tiles, tile_bounds, tile_for
+from prepare_geometry import wgs84_transform
+from stats import percentile
+from vector_tile import decode, DecodeError
+
+SAMPLES = 8 # Features to take sample tiles around
+WINDOW_ZOOM = 7 # Zoom of the sample tiles. Tile sizes are measured from this zoom up
+MAXZOOM_STEPS = 2 # How many zoom levels below the requested maxzoom to try
+DETAIL_STEPS = [0, 2, 4] # Bits of detail below full detail (32 - maxzoom) to try
+SIMPLIFICATIONS = [1, 2, 4] # tippecanoe -S factors to try
+
+
+def default_settings(max_zoom):
+    'The settings tiles have always been generated with: full detail and no extra simplification'
+    return OrderedDict([('maxzoom', max_zoom), ('detail', 32 - max_zoom), ('simplification', 1)])
+
+
+def candidates(max_zoom, min_zoom=0):
+    'Candidate settings, from the requested maxzoom down to MAXZOOM_STEPS below it (but not below min_zoom)'
+    for z in range(max_zoom, max(max_zoom - MAXZOOM_STEPS, min_zoom) - 1, -1):
+        for detail_step in DETAIL_STEPS:
+            for simplification in SIMPLIFICATIONS:
+                yield OrderedDict([('maxzoom', z), ('detail', 32 - z - detail_step), ('simplification', simplification)])
+
+
+def sample_windows(geometry_file, input_layer_name, samples=SAMPLES, window_zoom=WINDOW_ZOOM, seed=0):
+    'The distinct tiles (x, y) at window_zoom containing the centroids of randomly chosen features'
+    data_source = ogr.Open(geometry_file)
+    layer = data_source.GetLayerByName(input_layer_name)
+    transform = wgs84_transform(layer.GetSpatialRef())
+    layer.SetIgnoredFields([layer.GetLayerDefn().GetFieldDefn(i).GetName() for i in range(layer.GetLayerDefn().GetFieldCount())])
+    count = layer.GetFeatureCount()
+    windows = set()
+    for index in sorted(random.Random(seed).sample(range(count), min(samples, count))):
+        layer.SetNextByIndex(index)
+        geometry = layer.GetNextFeature().GetGeometryRef()
+        if geometry is None or geometry.IsEmpty():
+            continue
+        centroid = geometry.Centroid()
+        if transform is not None:
+            centroid.Transform(transform)
+        windows.add(tile_for(centroid.GetX(), centroid.GetY(), window_zoom))
+    return sorted(windows)
+
+
+def sample_fids(filenames):
+    'FIDs of the features in sample GeoJSON files'
+    fids = set()
+    for filename in filenames:
+        data_source = ogr.GetDriverByName('GeoJSON').Open(filename)
+        layer = data_source.GetLayer()
+        layer.SetIgnoredFields(['OGR_GEOMETRY'] + [layer.GetLayerDefn().GetFieldDefn(i).GetName() for i in range(layer.GetLayerDefn().GetFieldCount())])
+        fids.update(feature.GetFID() for feature in layer)
+    return fids
+
+
+def measure(mbtiles, windows, window_zoom, max_zoom):
+    '''
+    Compressed sizes of the tiles from window_zoom up that are within the sample windows, and the feature ids in the tiles
+    at max_zoom. Returns (sizes, ids, number of tiles that could not be decoded)
+    '''
+    windows = set(windows)
+    sizes = []
+    ids = set()
+    errors = 0
+    with closing(open_mbtiles(mbtiles)) as db:
+        for z, x, y, data in column_tiles(db, tile_columns(db)):
+            if z >= window_zoom and (x >> (z - window_zoom), y >> (z - window_zoom)) in windows:
+                sizes.append(len(data))
+            if z == max_zoom:
+                try:
+                    ids.update(feature.id for layer in decode(decompress(data), properties=False) for feature in layer.features)
+                except DecodeError:
+                    errors += 1
+    return sorted(sizes), ids, errors
+
+
+async def _extract(scheduler, geometry_file, input_layer_name, window_zoom, x, y):
+    'Extract the features within a sample tile to a temporary GeoJSON file, keeping their FIDs as feature ids'
+    filename = 'temp/{}.json'.format(uuid.uuid4().hex)
+    w, s, e, n = tile_bounds(window_zoom, x, y)
+    o2o, o2o_finished = await scheduler.exec(*[
+        'ogr2ogr',
+        '-t_srs', 'EPSG:4326',
+        '-spat', str(w), str(s), str(e), str(n),
+        '-spat_srs', 'EPSG:4326',
+        '-preserve_fid',
+        '-f', 'GeoJSON',
+        filename, geometry_file, input_layer_name
+    ])
+    if await o2o_finished != 0:
+        raise RuntimeError('Extracting sample tile {}/{}/{} from {} failed'.format(window_zoom, x, y, geometry_file))
+    return filename
+
+
+async def _try(scheduler, command, settings, sample_files, windows, window_zoom, expected_fids, target, memory):
+    'Generate tiles for the sample with one candidate and measure them'
+    result = OrderedDict(settings)
+    mbtiles = 'temp/{}.mbtiles'.format(uuid.uuid4().hex)
+    try:
+        tippe, tippe_finished = await scheduler.exec(*command(settings, sample_files, mbtiles), stdout=DEVNULL, stderr=DEVNULL, memory=memory)
+        result['returncode'] = await tippe_finished
+        if result['returncode'] == 0:
+            sizes, ids, errors = await asyncio.get_event_loop().run_in_executor(None, measure, mbtiles, windows, window_zoom, settings['maxzoom'])
+            result['tiles'] = len(sizes)
+            result['total_bytes'] = sum(sizes)
+            result['p99_bytes'] = percentile(sizes, 99) or 0
+            result['missing_fids'] = len(expected_fids - ids)
+            result['decode_errors'] = errors
+    finally:
+        if os.path.exists(mbtiles):
+            os.remove(mbtiles)
+    result['meets_target'] = result['returncode'] == 0 and result['p99_bytes'] <= target and result['missing_fids'] == 0 and result['decode_errors'] == 0
+    return result
+
+
+def choose(results):
+    'The cheapest candidate meeting the target at the highest maxzoom any candidate meets it at, or None'
+    passed = [result for result in results if result['meets_target']]
+    if not passed:
+        return None
+    max_zoom = max(result['maxzoom'] for result in passed)
+    best = min((result for result in passed if result['maxzoom'] == max_zoom), key=lambda result: result['total_bytes'])
+    return OrderedDict((key, best[key]) for key in ['maxzoom', 'detail', 'simplification'])
+
+
+async def tune(scheduler, command, geometry_file, input_layer_name, max_zoom, target, samples=SAMPLES, window_zoom=WINDOW_ZOOM, seed=0):
+    '''
+    Try candidate settings on a sample of a layer, running tippecanoe with command(settings, geojson_files, mbtiles_filename)
+    through scheduler. target is the p99 compressed tile size in bytes. Returns the chosen settings and a report of every candidate.
+    If no candidate meets the target, or the sample has no features, the default settings are returned
+    '''
+    window_zoom = max(min(window_zoom, max_zoom - MAXZOOM_STEPS), 0)
+    windows = sample_windows(geometry_file, input_layer_name, samples, window_zoom, seed)
+    sample_files = await asyncio.gather(*[_extract(scheduler, geometry_file, input_layer_name, window_zoom, x, y) for x, y in windows], return_exceptions=True)
+    results = []
+    try:
+        for error in sample_files:
+            if isinstance(error, Exception):
+                raise error
+        expected_fids = sample_fids(sample_files)
+        # Without sample features (an empty layer, or empty windows) there is nothing to tune on, and without sample files
+        # tippecanoe would wait for input on stdin
+        if expected_fids:
+            memory = 2 * sum(os.path.getsize(filename) for filename in sample_files)
+            results = await asyncio.gather(*[_try(scheduler, command, settings, sample_files, windows, window_zoom, expected_fids, target, memory)
+                                             for settings in candidates(max_zoom, window_zoom)])
+    finally:
+        for filename in sample_files:
+            if isinstance(filename, str) and os.path.exists(filename):
+                os.remove(filename)
+    chosen = choose(results)
+    report = OrderedDict([
+        ('target_p99_bytes', target),
+        ('window_zoom', window_zoom),
+        ('windows', [[x, y] for x, y in windows]),
+        ('sample_features', len(expected_fids)),
+        ('candidates', results),
+        ('met_target', chosen is not None),
+        ('chosen', chosen or default_settings(max_zoom))
+    ])
+    return report['chosen'], report
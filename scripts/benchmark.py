@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Load test a running vector tile server. Layers come from config/*.json, and their bbox, serverMaxNativeZoom and layerName from
+regionMapping.json and output_files/regionMapping-<layer>.json. Random tiles within each layer's bbox are requested at the given
+concurrency, and throughput, latency percentiles, bytes per tile and error/empty tile rates are reported per layer and zoom.
+Results are saved as JSON, and --compare prints the change from a previous run
+'''
+
+import argparse
+import glob
+import http.client
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from mbtiles import tile_for
+from stats import percentile
+
+
+def server_layers(config_dir='config'):
+    'Names of layers served according to the server config files'
+    layers = []
+    for filename in sorted(glob.glob(os.path.join(config_dir, '*.json'))):
+        with open(filename) as f:
+            layers.extend(path.strip('/') for path in json.load(f))
+    return layers
+
+
+def region_mapping_layers(filenames):
+    'Dict of layerName to (bbox, serverMaxNativeZoom) from vector tile regionMapping entries'
+    layers = {}
+    for filename in filenames:
+        with open(filename) as f:
+            entries = json.load(f)['regionWmsMap']
+        for entry in entries.values():
+            if entry.get('serverType') == 'MVT' and entry.get('bbox'):
+                layers[entry['layerName']] = (entry['bbox'], int(entry.get('serverMaxNativeZoom', 12)))
+    return layers
+
+
+def request_mix(layers, count, min_zoom=0, seed=0):
+    '''
+    count random (layer, z, x, y) requests spread evenly over layers, weighting each zoom by its number of
+    tiles in the bbox (capped so the highest zooms don't swamp the rest), like a client panning and zooming around
+    '''
+    rng = random.Random(seed)
+    requests = []
+    for i in range(count):
+        layer, ((w, s, e, n), max_zoom) = layers[i % len(layers)]
+        zooms = list(range(min_zoom, max_zoom + 1))
+        z = rng.choices(zooms, weights=[min(2 ** z, 64) for z in zooms])[0]
+        x, y = tile_for(rng.uniform(w, e), rng.uniform(s, n), z)
+        requests.append((layer, z, x, y))
+    return requests
+
+
+class Client:
+    'Keep-alive HTTP connection per thread'
+    def __init__(self, base_url):
+        self.url = urlsplit(base_url)
+        self.local = threading.local()
+
+    def get(self, path):
+        'Request a path, returning (status, body length, seconds), with status None on connection errors'
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=30)
+        start = time.perf_counter()
+        try:
+            self.local.connection.request('GET', self.url.path.rstrip('/') + path, headers={'Accept-Encoding': 'gzip'})
+            response = self.local.connection.getresponse()
+            body = response.read()
+            return response.status, len(body), time.perf_counter() - start
+        except (http.client.HTTPException, OSError):
+            self.local.connection.close()
+            del self.local.connection
+            return None, 0, time.perf_counter() - start
+
+
+def summarise(samples, duration):
+    'Summary statistics for a list of (status, bytes, seconds)'
+    latencies = sorted(seconds * 1000 for _, _, seconds in samples)
+    ok = [size for status, size, _ in samples if status == 200]
+    return OrderedDict([
+        ('requests', len(samples)),
+        ('throughput', len(samples) / duration if duration else None),
+        ('p50_ms', percentile(latencies, 50)),
+        ('p95_ms', percentile(latencies, 95)),
+        ('p99_ms', percentile(latencies, 99)),
+        ('mean_bytes', sum(ok) / len(ok) if ok else None),
+        ('error_rate', sum(1 for status, _, _ in samples if status not in (200, 204)) / len(samples)),
+        ('empty_rate', sum(1 for status, size, _ in samples if status in (200, 204) and size == 0) / len(samples))
+    ])
+
+
+def run(base_url, requests, concurrency):
+    'Run requests against the server, returning results per layer and zoom'
+    client = Client(base_url)
+    def fetch(request):
+        layer, z, x, y = request
+        return request, client.get('/{}/{}/{}/{}.pbf'.format(layer, z, x, y))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(fetch, requests))
+    duration = time.perf_counter() - start
+
+    by_layer = OrderedDict()
+    for (layer, z, _, _), sample in results:
+        by_layer.setdefault(layer, OrderedDict()).setdefault(z, []).append(sample)
+    report = OrderedDict([('total', summarise([sample for _, sample in results], duration)), ('layers', OrderedDict())])
+    for layer, zooms in sorted(by_layer.items()):
+        layer_samples = [sample for samples in zooms.values() for sample in samples]
+        report['layers'][layer] = OrderedDict([
+            ('total', summarise(layer_samples, duration)),
+            ('zooms', OrderedDict((str(z), summarise(samples, duration)) for z, samples in sorted(zooms.items())))
+        ])
+    return report
+
+
+def format_value(value, spec):
+    return format(value, spec) if value is not None else '-'
+
+
+def print_report(report, previous=None):
+    columns = [('requests', 'd'), ('throughput', '.1f'), ('p50_ms', '.1f'), ('p95_ms', '.1f'), ('p99_ms', '.1f'), ('mean_bytes', '.0f'), ('error_rate', '.3f'), ('empty_rate', '.3f')]
+    print('{:40}  {:>4}  '.format('Layer', 'Zoom') + '  '.join('{:>10}'.format(name) for name, _ in columns))
+    def row(name, zoom, stats, old):
+        cells = []
+        for key, spec in columns:
+            cell = format_value(stats[key], spec)
+            if old is not None and stats[key] is not None and old.get(key):
+                cell += ' ({:+.0%})'.format(stats[key] / old[key] - 1)
+            cells.append('{:>10}'.format(cell))
+        print('{:40}  {:>4}  '.format(name, zoom) + '  '.join(cells))
+    old_layers = previous['layers'] if previous else {}
+    for layer, layer_report in report['layers'].items():
+        old_layer = old_layers.get(layer, {})
+        for z, stats in layer_report['zooms'].items():
+            row(layer, z, stats, old_layer.get('zooms', {}).get(z))
+        row(layer, 'all', layer_report['total'], old_layer.get('total'))
+    row('Total', 'all', report['total'], previous['total'] if previous else None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8000', help='Base URL of the tile server')
+    parser.add_argument('--layers', nargs='*', help='Layers to test (default: every layer in config/ with a regionMapping entry)')
+    parser.add_argument('--region-mapping', nargs='*', help='regionMapping files (default: regionMapping.json and output_files/regionMapping-*.json)')
+    parser.add_argument('--requests', type=int, default=10000, help='Total number of tile requests')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--min-zoom', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0, help='Random seed, so runs request the same tiles')
+    parser.add_argument('--output', default='benchmark-{}.json'.format(time.strftime('%Y%m%d-%H%M%S')), help='File to save results to')
+    parser.add_argument('--compare', help='Results of a previous run to compare with')
+    args = parser.parse_args()
+
+    region_mapping = region_mapping_layers(args.region_mapping or [f for f in ['regionMapping.json'] if os.path.exists(f)] + sorted(glob.glob(os.path.join('output_files', 'regionMapping-*.json'))))
+    served = args.layers or server_layers()
+    layers = [(layer, region_mapping[layer]) for layer in served if layer in region_mapping]
+    missing = [layer for layer in served if layer not in region_mapping]
+    if missing:
+        print('Skipping layers without a vector tile regionMapping entry: {}'.format(', '.join(missing)))
+    if not layers:
+        parser.error('No layers to test')
+
+    requests = request_mix(layers, args.requests, args.min_zoom, args.seed)
+    report = run(args.url, requests, args.concurrency)
+    report['settings'] = OrderedDict([('url', args.url), ('requests', args.requests), ('concurrency', args.concurrency), ('seed', args.seed), ('time', time.strftime('%Y-%m-%dT%H:%M:%S'))])
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_report(report, previous)
+    print('Results saved to {}'.format(args.output))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Benchmark partitioned tile generation (partition_tiles.py) against a single tippecanoe process on a synthetic layer: a grid
+of jagged polygons, denser towards one corner like population based boundaries. Reports the time taken by each and how
+many tiles of the partitioned output differ from the single process output
+'''
+
+import argparse
+import json
+import math
+import os
+import random
+import time
+import uuid
+from contextlib import closing
+
+import asyncio
+
+from tippecanoe import tippecanoe_args
+from auto_tune import default_settings
+from scheduler import JobScheduler
+from mbtiles import open_mbtiles, decompress
+import partition_tiles
+
+
+def synthetic_layer(filename, features, vertices=64, seed=0, bounds=(113, -44, 154, -10)):
+    'Write a GeoJSON file of features polygons with vertices vertices each and an FID attribute'
+    rng = random.Random(seed)
+    w, s, e, n = bounds
+    side = int(math.ceil(math.sqrt(features)))
+    with open(filename, 'w') as f:
+        f.write('{"type": "FeatureCollection", "features": [\n')
+        for fid in range(features):
+            # Squeeze cells towards the south west corner, so partitions have to balance uneven density
+            i, j = fid % side, fid // side
+            x0, x1 = [w + (e - w) * (k / side) ** 2 for k in (i, i + 1)]
+            y0, y1 = [s + (n - s) * (k / side) ** 2 for k in (j, j + 1)]
+            cx, cy, rx, ry = (x0 + x1) / 2, (y0 + y1) / 2, (x1 - x0) / 2, (y1 - y0) / 2
+            ring = [[cx + rx * math.cos(a) * rng.uniform(0.7, 1), cy + ry * math.sin(a) * rng.uniform(0.7, 1)]
+                    for a in (2 * math.pi * v / vertices for v in range(vertices))]
+            feature = {'type': 'Feature', 'properties': {'FID': fid, 'name': 'Region {}'.format(fid)},
+                       'geometry': {'type': 'Polygon', 'coordinates': [ring + ring[:1]]}}
+            f.write((',\n' if fid else '') + json.dumps(feature))
+        f.write('\n]}\n')
+
+
+def tiles(mbtiles):
+    'Dict of (z, x, y) to uncompressed tile data'
+    with closing(open_mbtiles(mbtiles)) as db:
+        return {(z, x, y): decompress(data) for z, x, y, data in db.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles')}
+
+
+async def run(geojson_file, max_zoom, partitions, zoom):
+    tile_settings = default_settings(max_zoom)
+    scheduler = JobScheduler()
+    single = 'temp/{}.mbtiles'.format(uuid.uuid4().hex)
+    partitioned = 'temp/{}.mbtiles'.format(uuid.uuid4().hex)
+    try:
+        start = time.perf_counter()
+        tippe, tippe_finished = await scheduler.exec(*tippecanoe_args('benchmark', tile_settings, [geojson_file], single))
+        assert await tippe_finished == 0, 'tippecanoe failed'
+        single_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        command = lambda tile_settings, geojson_files, output, zoom_range: tippecanoe_args('benchmark', tile_settings, geojson_files, output, zoom_range)
+        assert await partition_tiles.generate(scheduler, command, geojson_file, tile_settings, partitioned, partitions, zoom) == 0, 'Partitioned tiling failed'
+        partitioned_time = time.perf_counter() - start
+
+        single_tiles, partitioned_tiles = tiles(single), tiles(partitioned)
+    finally:
+        for filename in [single, partitioned]:
+            if os.path.exists(filename):
+                os.remove(filename)
+    print('Single process: {:.1f}s, {} tiles'.format(single_time, len(single_tiles)))
+    print('{} partitions from zoom {}: {:.1f}s, {} tiles ({:.2f}x speedup)'.format(partitions, zoom, partitioned_time, len(partitioned_tiles), single_time / partitioned_time))
+    print('Tiles only in single process output: {}, only in partitioned output: {}, different: {}'.format(
+        len(single_tiles.keys() - partitioned_tiles.keys()), len(partitioned_tiles.keys() - single_tiles.keys()),
+        sum(1 for key in single_tiles.keys() & partitioned_tiles.keys() if single_tiles[key] != partitioned_tiles[key])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--features', type=int, default=200000, help='Number of synthetic polygons (default: 200000)')
+    parser.add_argument('--vertices', type=int, default=64, help='Vertices per polygon (default: 64)')
+    parser.add_argument('--max-zoom', type=int, default=12)
+    parser.add_argument('--partitions', type=int, default=os.cpu_count() or 1, help='Number of partitions (default: number of cores)')
+    parser.add_argument('--partition-zoom', type=int, default=partition_tiles.PARTITION_ZOOM)
+    parser.add_argument('--geojson', help='Use (or create, if it does not exist) this synthetic GeoJSON file instead of a temporary one')
+    args = parser.parse_args()
+
+    os.makedirs('temp', exist_ok=True)
+    geojson_file = args.geojson or 'temp/{}.json'.format(uuid.uuid4().hex)
+    if not os.path.exists(geojson_file):
+        print('Writing {} synthetic polygons to {}'.format(args.features, geojson_file))
+        synthetic_layer(geojson_file, args.features, args.vertices)
+    try:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(run(geojson_file, args.max_zoom, args.partitions, args.partition_zoom))
+        loop.close()
+    finally:
+        if not args.geojson:
+            os.remove(geojson_file)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'Content-addressed cache of layer build artifacts, so unchanged layers are restored instead of rebuilt'
+
+import os
+import json
+import shutil
+import hashlib
+import uuid
+
+import numpy as np
+
+CACHE_VERSION = 1 # Bump when the build pipeline changes in a way that changes its outputs
+
+
+def file_digest(filename, chunk_size=1 << 20):
+    'SHA-256 hex digest of a file'
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _place(source, destination, link):
+    '''
+    Atomically replace destination with a copy of source, or a hard link to it if link is True (falling back to a copy
+    if linking isn't possible, eg. across devices). Only link files that are always replaced rather than rewritten in place
+    '''
+    temp = '{}.{}.tmp'.format(destination, uuid.uuid4().hex)
+    if link:
+        try:
+            os.link(source, temp)
+        except OSError:
+            link = False
+    if not link:
+        shutil.copyfile(source, temp)
+    os.replace(temp, destination)
+
+
+class BuildCache:
+    '''
+    Artifacts are stored under directory/<key>/ where the key is a hash of everything that went into building them.
+    A cache with no directory is disabled: nothing is ever restored or stored
+    '''
+    def __init__(self, directory='cache'):
+        self.directory = directory
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    @staticmethod
+    def key(*parts):
+        'Hash the inputs of an artifact. Parts can be strings, numbers, lists, NumPy arrays or bytes'
+        h = hashlib.sha256(str(CACHE_VERSION).encode('utf-8'))
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                if part.dtype == object:
+                    data = json.dumps(part.tolist()).encode('utf-8')
+                else:
+                    data = part.dtype.str.encode('utf-8') + np.ascontiguousarray(part).tobytes()
+            elif isinstance(part, bytes):
+                data = part
+            else:
+                data = json.dumps(part).encode('utf-8')
+            h.update(hashlib.sha256(data).digest()) # Hash each part separately so parts can't run into each other
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def restore(self, key, files, link=False):
+        '''
+        Restore cached artifacts to their destinations. files maps artifact names to destination filenames.
+        Returns the artifact metadata (a dict) if every artifact was cached, otherwise None
+        '''
+        if not self.enabled:
+            return None
+        entry = self._entry(key)
+        metadata_filename = os.path.join(entry, 'metadata.json')
+        if not os.path.exists(metadata_filename) or not all(os.path.exists(os.path.join(entry, name)) for name in files):
+            return None
+        for name, destination in files.items():
+            _place(os.path.join(entry, name), destination, link)
+        with open(metadata_filename) as f:
+            return json.load(f)
+
+    def store(self, key, files, metadata=None, link=False):
+        'Store artifacts (files maps artifact names to source filenames) with optional JSON metadata under key'
+        if not self.enabled:
+            return
+        entry = self._entry(key)
+        os.makedirs(entry, exist_ok=True)
+        for name, source in files.items():
+            _place(source, os.path.join(entry, name), link)
+        # Metadata is written last: an entry without metadata is incomplete and is never restored
+        temp = os.path.join(entry, 'metadata.json.{}.tmp'.format(uuid.uuid4().hex))
+        with open(temp, 'w') as f:
+            json.dump(metadata or {}, f)
+        os.replace(temp, os.path.join(entry, 'metadata.json'))
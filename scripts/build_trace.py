@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Stage level tracing of layer builds. Each stage of a layer (ogr2ogr cleaning, FID generation, tippecanoe, bbox, regionids,
+test CSVs, ...) is recorded with its start and end time and:
+
+- for subprocesses: CPU time and peak RSS from rusage, and bytes read and written from /proc/<pid>/io. Traced commands are
+  run through this script (build_trace.py exec <usage file> -- <command>), which waits for the command and writes its
+  usage, so commands run concurrently are measured separately
+- for in-process stages: CPU time and block IO of the thread running the stage, and peak RSS of this process. With
+  profiling, each is run under cProfile and its stats saved to <directory>/trace-<layer>-<stage>.prof
+
+Writing a layer's trace gives <directory>/trace-<layer>.json in Chrome trace event format (open it in chrome://tracing or
+Perfetto), with concurrent stages on separate rows, and a summary table. Run with trace files to print their summaries
+'''
+
+import argparse
+import cProfile
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import resource
+import asyncio.subprocess
+
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF) # Linux only
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024 # ru_maxrss is in bytes on macOS and KB elsewhere
+
+
+def read_proc_io(pid):
+    'Bytes read and written by a process (including pipes), or None where /proc is unavailable'
+    try:
+        with open('/proc/{}/io'.format(pid)) as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def measure_command(usage_file, args):
+    '''
+    Run a command with this process's stdin, stdout and stderr, writing its CPU time, peak RSS and bytes read and
+    written to usage_file. Returns the command's return code
+    '''
+    proc = subprocess.Popen(args)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda sig, frame: proc.send_signal(sig))
+    io = None
+    if hasattr(os, 'waitid'):
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT) # Wait without reaping, so /proc/<pid>/io is still there
+        io = read_proc_io(proc.pid)
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    with open(usage_file, 'w') as f:
+        json.dump(OrderedDict([
+            ('cpu', usage.ru_utime + usage.ru_stime),
+            ('maxrss', usage.ru_maxrss * MAXRSS_UNIT),
+            ('read', io[0] if io else usage.ru_inblock * 512),
+            ('written', io[1] if io else usage.ru_oublock * 512)
+        ]), f)
+    return proc.returncode
+
+
+def slug(name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '-', name).strip('-')
+
+
+class BuildTrace:
+    '''
+    Records the stages of layer builds, writing traces to directory.
+    A trace with no directory is disabled: commands and stages run as usual and nothing is recorded
+    '''
+    def __init__(self, directory=None, profile=False):
+        self.directory = directory
+        self.profile = profile
+        self.origin = time.time()
+        self.events = OrderedDict() # Layer name to a list of stage events
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def record(self, layer, stage, start, end, kind, **usage):
+        event = OrderedDict([('stage', stage), ('kind', kind), ('start', start), ('end', end)])
+        event.update(usage)
+        self.events.setdefault(layer, []).append(event)
+
+    async def exec(self, scheduler, layer, stage, args, **kwargs):
+        '''
+        Start a command through scheduler (or straight away without one), measuring it when tracing.
+        Returns the process and a future to its return code, like JobScheduler.exec
+        '''
+        if self.enabled:
+            usage_file = os.path.join('temp', '{}.usage.json'.format(uuid.uuid4().hex))
+            args = [sys.executable, os.path.abspath(__file__), 'exec', usage_file, '--'] + list(args)
+        if scheduler is not None:
+            proc, finished = await scheduler.exec(*args, **kwargs)
+        else:
+            proc = await asyncio.create_subprocess_exec(*args, **kwargs)
+            finished = asyncio.ensure_future(proc.wait())
+        if self.enabled:
+            finished = asyncio.ensure_future(self._command_finished(layer, stage, time.time(), usage_file, finished))
+        return proc, finished
+
+    async def _command_finished(self, layer, stage, start, usage_file, finished):
+        returncode = await finished
+        usage = {}
+        if os.path.exists(usage_file):
+            with open(usage_file) as f:
+                usage = json.load(f)
+            os.remove(usage_file)
+        self.record(layer, stage, start, time.time(), 'subprocess', returncode=returncode, **usage)
+        return returncode
+
+    def measure(self, layer, stage, func, *args):
+        'Call func(*args) in this thread, recording it as an in-process stage when tracing. Returns its result'
+        if not self.enabled:
+            return func(*args)
+        before = resource.getrusage(RUSAGE_THREAD)
+        start = time.time()
+        profiler = cProfile.Profile() if self.profile else None # Profiles only the thread it runs in
+        try:
+            return profiler.runcall(func, *args) if profiler is not None else func(*args)
+        finally:
+            profile_file = None
+            if profiler is not None:
+                profile_file = os.path.join(self.directory, 'trace-{}-{}.prof'.format(slug(layer), slug(stage)))
+                profiler.dump_stats(profile_file)
+            self._record_in_process(layer, stage, start, before, profile_file)
+
+    def _record_in_process(self, layer, stage, start, before, profile_file):
+        after = resource.getrusage(RUSAGE_THREAD)
+        usage = OrderedDict([
+            ('cpu', (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime)),
+            ('maxrss', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT),
+            ('read', (after.ru_inblock - before.ru_inblock) * 512),
+            ('written', (after.ru_oublock - before.ru_oublock) * 512)
+        ])
+        if profile_file is not None:
+            usage['profile'] = profile_file
+        self.record(layer, stage, start, time.time(), 'python', **usage)
+
+    async def call(self, layer, stage, func, *args):
+        'Run func(*args) in a worker thread, recording it as an in-process stage when tracing'
+        return await asyncio.get_event_loop().run_in_executor(None, self.measure, layer, stage, func, *args)
+
+    @contextmanager
+    def stage(self, layer, stage):
+        '''
+        Record the wall clock time of a block, which may await (so other work can run during it: CPU use isn't
+        attributed). Used for stages made up of other stages, or whose work happens in other processes
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                self.record(layer, stage, start, time.time(), 'span')
+
+    def chrome_trace(self, layer):
+        'Chrome trace event format of a layer, with overlapping stages put on separate rows (threads)'
+        events = sorted(self.events.get(layer, []), key=lambda event: event['start'])
+        row_ends = []
+        trace_events = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'tid': 0, 'args': {'name': layer}}]
+        for event in events:
+            row = next((i for i, end in enumerate(row_ends) if end <= event['start']), len(row_ends))
+            if row == len(row_ends):
+                row_ends.append(0)
+            row_ends[row] = event['end']
+            trace_events.append(OrderedDict([
+                ('name', event['stage']),
+                ('cat', event['kind']),
+                ('ph', 'X'),
+                ('ts', int((event['start'] - self.origin) * 1e6)),
+                ('dur', int((event['end'] - event['start']) * 1e6)),
+                ('pid', 1),
+                ('tid', row),
+                ('args', OrderedDict((key, value) for key, value in event.items() if key not in ('stage', 'kind', 'start', 'end')))
+            ]))
+        return OrderedDict([('traceEvents', trace_events), ('displayTimeUnit', 'ms'), ('otherData', {'layer': layer, 'stages': events})])
+
+    def write(self, layer):
+        'Write the trace of a layer, returning its filename (or None when not tracing)'
+        if not self.enabled or layer not in self.events:
+            return None
+        filename = os.path.join(self.directory, 'trace-{}.json'.format(slug(layer)))
+        with open(filename, 'w') as f:
+            json.dump(self.chrome_trace(layer), f)
+        return filename
+
+    def summary(self, layer):
+        return format_summary(layer, self.events.get(layer, []))
+
+
+def format_summary(layer, events):
+    'Table of the stages of a layer, in the order they started'
+    def number(value, scale=1, places=1):
+        return '-' if value is None else '{:.{}f}'.format(value / scale, places)
+    rows = [('Stage', 'Start (s)', 'Wall (s)', 'CPU (s)', 'Peak RSS (MB)', 'Read (MB)', 'Written (MB)')]
+    origin = min((event['start'] for event in events), default=0)
+    for event in sorted(events, key=lambda event: event['start']):
+        rows.append((event['stage'] + (' (failed)' if event.get('returncode') else ''), number(event['start'] - origin), number(event['end'] - event['start']),
+                     number(event.get('cpu')), number(event.get('maxrss'), 1024**2), number(event.get('read'), 1024**2), number(event.get('written'), 1024**2)))
+    return 'Stages of {}:\n'.format(layer) + '\n'.join('{:40}  {:>9}  {:>9}  {:>9}  {:>13}  {:>10}  {:>12}'.format(*row) for row in rows)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['exec']:
+        # Measuring a traced command: build_trace.py exec <usage file> -- <command>
+        returncode = measure_command(sys.argv[2], sys.argv[4:])
+        if returncode < 0: # Die of the same signal, so the caller sees the same return code
+            signal.signal(-returncode, signal.SIG_DFL)
+            os.kill(os.getpid(), -returncode)
+        sys.exit(returncode)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('traces', nargs='+', help='Trace files (output_files/trace-<layer>.json) to summarise')
+    args = parser.parse_args()
+    for filename in args.traces:
+        with open(filename) as f:
+            trace = json.load(f)
+        print(format_summary(trace['otherData']['layer'], trace['otherData']['stages']))
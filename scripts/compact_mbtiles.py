@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Compact an mbtiles file by rewriting it into the deduplicated map/images schema: every distinct tile is stored once in images,
+keyed by a hash of its content, and map points each tile coordinate at its image. A tiles view keeps the file readable by
+anything that reads mbtiles. Tiles are recompressed at a chosen gzip level, indexed and the file is vacuumed
+'''
+
+import argparse
+import hashlib
+import os
+import sqlite3
+import uuid
+import zlib
+from collections import OrderedDict
+from contextlib import closing
+
+from mbtiles import open_mbtiles, decompress
+
+BATCH_SIZE = 10000
+
+SCHEMA = '''
+CREATE TABLE metadata (name TEXT, value TEXT);
+CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);
+CREATE TABLE images (tile_id TEXT, tile_data BLOB);
+CREATE VIEW tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row, images.tile_data AS tile_data
+    FROM map JOIN images ON images.tile_id = map.tile_id;
+'''
+
+INDEXES = '''
+CREATE UNIQUE INDEX name ON metadata (name);
+CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, tile_row);
+CREATE UNIQUE INDEX images_id ON images (tile_id);
+'''
+
+
+def gzip_tile(data, level):
+    'Gzip a tile deterministically (no timestamp in the header), so identical tiles give identical files'
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compact(filename, gzip_level=9):
+    'Rewrite filename in place into the deduplicated schema. Returns statistics about the compaction'
+    temp = '{}.{}.tmp'.format(filename, uuid.uuid4().hex)
+    size_before = os.path.getsize(filename)
+    tiles = 0
+    seen = set()
+    try:
+        with closing(open_mbtiles(filename)) as source, closing(sqlite3.connect(temp)) as db:
+            db.execute('PRAGMA journal_mode = OFF')
+            db.execute('PRAGMA synchronous = OFF')
+            db.executescript(SCHEMA)
+            db.executemany('INSERT INTO metadata VALUES (?, ?)', source.execute('SELECT name, value FROM metadata'))
+            rows = source.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles')
+            while True:
+                batch = rows.fetchmany(BATCH_SIZE)
+                if not batch:
+                    break
+                map_rows = []
+                image_rows = []
+                for z, x, y, data in batch:
+                    data = decompress(data)
+                    tile_id = hashlib.md5(data).hexdigest()
+                    map_rows.append((z, x, y, tile_id))
+                    if tile_id not in seen:
+                        seen.add(tile_id)
+                        image_rows.append((tile_id, gzip_tile(data, gzip_level)))
+                db.executemany('INSERT INTO map VALUES (?, ?, ?, ?)', map_rows)
+                db.executemany('INSERT INTO images VALUES (?, ?)', image_rows)
+                tiles += len(batch)
+            db.executescript(INDEXES)
+            db.commit()
+            db.execute('ANALYZE')
+            db.execute('VACUUM')
+        os.replace(temp, filename) # Replace rather than rewrite, so hard links (eg. to the build cache) are left alone
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    size_after = os.path.getsize(filename)
+    return OrderedDict([
+        ('tiles', tiles),
+        ('unique_tiles', len(seen)),
+        ('duplicate_ratio', 1 - len(seen) / tiles if tiles else 0),
+        ('size_before', size_before),
+        ('size_after', size_after)
+    ])
+
+
+def format_stats(name, stats):
+    return '{}: {} tiles, {} unique ({:.1%} duplicates), {:.1f}MB -> {:.1f}MB'.format(
+        name, stats['tiles'], stats['unique_tiles'], stats['duplicate_ratio'], stats['size_before'] / 1024**2, stats['size_after'] / 1024**2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help='mbtiles files to compact in place')
+    parser.add_argument('--gzip-level', type=int, default=9)
+    args = parser.parse_args()
+    for filename in args.files:
+        print(format_stats(filename, compact(filename, args.gzip_level)))
@@ -6,20 +6,49 @@
 # - Main function that converts 1 GeoJSON/shapefile to a vector tile layer with TerriaMap config and test files
 # - Use asycnio
 
-from contextlib import contextmanager, redirect_stdout
-import sys
 import os
 import errno
 import json
 from collections import OrderedDict
 import uuid
-import re
-
-from osgeo import ogr, osr
-import boto3
+import argparse
+
+from osgeo import ogr
+import numpy as np
+
+from attributes import AttributeTable, is_valid_fid, is_unique
+from manifest import load_manifest
+from scheduler import JobScheduler, WallClock
+from build_trace import BuildTrace
+from build_cache import BuildCache, file_digest
+from publish import publish_layers, s3_client, BUCKET
+from compact_mbtiles import compact, format_stats
+from profile_tiles import profile_layer, format_report
+from verify_tiles import verify_layer, format_report as format_verify_report
+from auto_tune import tune, default_settings
+from tippecanoe import tippecanoe_args
+import partition_tiles
+import regionids
+from prepare_geometry import prepare, format_counters
+try:
+    import region_index
+except ImportError: # Shapely is only needed for point in region indexes
+    region_index = None
+
+scheduler = JobScheduler() # Bounds the subprocesses run across all layers. Replaced in main() if limits are given
+build_cache = BuildCache() # Replaced in main() if another cache directory (or no cache) is requested
+build_trace = BuildTrace() # Records the stages of each layer build. Replaced in main() if tracing is requested
+compact_gzip_level = 9 # gzip level tiles are recompressed at when compacting mbtiles, or None to leave tippecanoe's output as is
+tile_budget = 500 * 1024 # Compressed tile size in bytes above which a layer is flagged when profiling, or None to not profile
+verify_layers = True # Check the FIDs, region values and validity of tiles after generating them
+auto_tune_target = None # p99 compressed tile size in bytes to tune tippecanoe settings for, or None to use the default settings
+partitions = None # Number of spatial partitions to tile each layer in (see partition_tiles.py), or None for a single tippecanoe process
+partition_zoom = partition_tiles.PARTITION_ZOOM
+compact_regionids = False # Whether to also write the compact encoding of regionid files (see regionids.py)
+prepare_processes = None # Worker processes to repair and reproject geometry with (see prepare_geometry.py), or None to use ogr2ogr
+build_region_indexes = False # Whether to build a point in region index of each layer (see region_index.py)
 
 import asyncio.subprocess
-from subprocess import Popen
 from asyncio.subprocess import PIPE, DEVNULL
 
 
@@ -39,15 +68,15 @@ def request_input(caption, default):
     response = input('\x1b[94m' + '{} '.format(caption) + ('({}): '.format(default) if default else '') + '\x1b[0m')
     return response if response != '' else default
 
+def ask(settings, key, caption, default):
+    'Take an answer from manifest settings when building from a manifest, otherwise request input from the user'
+    if settings is None:
+        return request_input(caption, default)
+    value = settings.get(key)
+    return value if value is not None else default
 
-def unique_with_prop(data_source, layername, prop):
-    'Determine if the property prop uniquely identifies every feature in the given layer of the DataSource'
-    layer = data_source.ExecuteSQL('SELECT COUNT(DISTINCT {1}) / COUNT(*) AS allunique FROM "{0}"'.format(layername, prop), dialect='SQLITE') # If one enjoys SQL attacking one's own files, then go ahead
-    all_unique = bool(layer.GetFeature(0).GetField('allunique'))
-    data_source.ReleaseResultSet(layer)
-    return all_unique
 
-def select_name_prop(properties):
+def select_name_prop(properties, settings=None):
     'Select a default name prop using Cesium FeatureInfo rules'
     # Adapted from Cesium ImageryLayerFeatureInfo.js (https://github.com/AnalyticalGraphicsInc/cesium/blob/1.19/Source/Scene/ImageryLayerFeatureInfo.js#L57)
     name_property_precedence = 10
@@ -66,11 +95,22 @@ def select_name_prop(properties):
         elif name_property_precedence > 4 and lower_key.find('title') != -1:
             name_property_precedence = 4
             name_property = key
-    return request_input('Which attribute should be used as the name property?', name_property)
+    return ask(settings, 'nameProp', 'Which attribute should be used as the name property?', name_property)
 
 def mbtiles_filename(layer_name):
     return os.path.join('data', '{}.mbtiles'.format(layer_name))
 
+def geometry_files(geometry_file):
+    'All the files making up a geometry file (shapefiles are split over several files)'
+    stem, ext = os.path.splitext(geometry_file)
+    if ext.lower() != '.shp':
+        return [geometry_file]
+    return [stem + sidecar for sidecar in ['.shp', '.shx', '.dbf', '.prj', '.cpg'] if os.path.exists(stem + sidecar)]
+
+def geometry_size(geometry_file):
+    'Total size in bytes of a geometry file, used to order layers and estimate memory use'
+    return sum(os.path.getsize(filename) for filename in geometry_files(geometry_file) if os.path.exists(filename))
+
 # async def to_geojson(geometry_file, input_layer_name, add_fid, start_future):
 #     'Convert geometry_file to a temporary GeoJSON (including cleaning geometry and adding an fid if requested) and return the temporary filename'
 #     filename = 'temp/{}.json'.format(uuid.uuid4().hex)
@@ -105,20 +145,27 @@ def mbtiles_filename(layer_name):
 #         filename = filename2 # New geojson is now the geojson file to use
 #     return filename
 
+STREAM_LINE_LIMIT = 1 << 30 # Maximum size of a single GeoJSONSeq feature when streaming
+
 class GeoJSONTemporaryFile:
     'Context manager for creating a temporary GeoJSON file from a given geometry file'
-    def __init__(self, geometry_file, input_layer_name, add_fid):
+    def __init__(self, geometry_file, input_layer_name, add_fid, layer_name):
         self.geometry_file = geometry_file
         self.input_layer_name = input_layer_name
         self.add_fid = add_fid
+        self.layer_name = layer_name # For tracing
         self.finished_future = None
         self.filename = ''
+        self.counters = None # Geometry repair counters, when prepared in parallel
 
     async def start(self):
         'Start loading of geojson files, and grab a future to the finished processing. Should resolve almost instantly (only waits on starting a subprocess)'
         filename = 'temp/{}.json'.format(uuid.uuid4().hex)
         print('Generated filename {}'.format(filename))
-        o2o = await asyncio.create_subprocess_exec(*[
+        if prepare_processes:
+            self.finished_future = asyncio.ensure_future(self.prepare(filename)) # Started now, so it overlaps with the prompts
+            return
+        o2o, conversion_finished = await build_trace.exec(scheduler, self.layer_name, 'ogr2ogr cleaning', [
             'ogr2ogr',
             '-t_srs', 'EPSG:4326',
             # '-clipsrc', '-180', '-85.0511', '180', '85.0511', # Clip to EPSG:4326 (not working)
@@ -139,7 +186,7 @@ class GeoJSONTemporaryFile:
                 layername = layer.GetName()
                 layer = None
                 ds = None
-                o2o = await asyncio.create_subprocess_exec(*[
+                o2o, fid_finished = await build_trace.exec(scheduler, self.layer_name, 'FID generation', [
                     'ogr2ogr',
                     '-t_srs', 'EPSG:4326',
                     '-f', 'GeoJSON',
@@ -147,12 +194,21 @@ class GeoJSONTemporaryFile:
                     filename2, filename
                 ])
                 print('Running FID generation')
-                await o2o.wait()
+                await fid_finished
                 print('Finished FID generation')
                 os.remove(filename)
                 filename = filename2 # New geojson is now the geojson file to use
             return filename
-        self.finished_future = finish_conversion(o2o.wait(), filename, self.add_fid)
+        self.finished_future = finish_conversion(conversion_finished, filename, self.add_fid)
+
+    async def prepare(self, filename):
+        'Repair, reproject and add fid in a pool of worker processes instead of ogr2ogr, holding scheduler slots for the workers'
+        processes = min(prepare_processes, scheduler.max_processes)
+        async with scheduler.slot(processes):
+            print('Running parallel geometry cleaning & reprojection')
+            self.counters = await build_trace.call(self.layer_name, 'prepare geometry', prepare, self.geometry_file, self.input_layer_name, filename, self.add_fid, 'FID', processes)
+        print('Finished geometry cleaning & reprojection of {}: {}'.format(self.geometry_file, format_counters(self.counters)))
+        return filename
 
     async def __aenter__(self):
         if self.finished_future is None:
@@ -165,39 +221,221 @@ class GeoJSONTemporaryFile:
 
 
 
-async def generate_tiles(geojson_file, layer_name, generate_tiles_to):
-    'Generate tiles with Tippecanoe'
-    tippe = await asyncio.create_subprocess_exec(*[
-        'tippecanoe',
-        '-q',
-        '-f',
-        '-P',
-        '-pp',
-        '-pS',
-        '-l', layer_name,
-        '-z', str(generate_tiles_to), # Max zoom
-        '-d', str(32-generate_tiles_to), # Detail
-        '-o', './{0}'.format(mbtiles_filename(layer_name)),
-        geojson_file
-    ], stdout=DEVNULL, stderr=DEVNULL)
-    return tippe.wait() # return finishing future (a future in a future)
-
-async def generate_test_csv(geometry_file, test_csv_file, input_layer_name, region_property, alias):
+async def generate_tiles(geojson_file, layer_name, tile_settings, memory=0):
+    'Generate tiles with Tippecanoe, in spatial partitions if requested'
+    if partitions:
+        command = lambda tile_settings, geojson_files, output, zoom_range: tippecanoe_args(layer_name, tile_settings, geojson_files, output, zoom_range)
+        async def generate_partitions():
+            with build_trace.stage(layer_name, 'tippecanoe partitions'):
+                return await partition_tiles.generate(scheduler, command, geojson_file, tile_settings, mbtiles_filename(layer_name), partitions, partition_zoom, memory)
+        return asyncio.ensure_future(generate_partitions())
+    tippe, tippe_finished = await build_trace.exec(scheduler, layer_name, 'tippecanoe', tippecanoe_args(layer_name, tile_settings, [geojson_file]), stdout=DEVNULL, stderr=DEVNULL, memory=memory)
+    return tippe_finished # return finishing future (a future in a future)
+
+def geojson_bounds(geojson_filename):
+    'Bounding box ([w, e, s, n]) of a GeoJSON file'
+    geojson_ds = ogr.GetDriverByName('GeoJSON').Open(geojson_filename)
+    geojson_layer = geojson_ds.GetLayer()
+    bounds = geojson_layer.GetExtent()
+    geojson_layer = None
+    geojson_ds = None
+    return bounds
+
+def extend_bounds(bounds, geometry):
+    'Extend bounds ([w, e, s, n]) to cover a GeoJSON geometry'
+    if geometry is None:
+        return
+    if geometry['type'] == 'GeometryCollection':
+        for g in geometry['geometries']:
+            extend_bounds(bounds, g)
+        return
+    stack = [geometry['coordinates']]
+    while stack:
+        coordinates = stack.pop()
+        if coordinates and isinstance(coordinates[0], (int, float)):
+            x, y = coordinates[0], coordinates[1]
+            if x < bounds[0]: bounds[0] = x
+            if x > bounds[1]: bounds[1] = x
+            if y < bounds[2]: bounds[2] = y
+            if y > bounds[3]: bounds[3] = y
+        else:
+            stack.extend(coordinates)
+
+async def stream_tiles(geometry_file, input_layer_name, layer_name, tile_settings, add_fid, fid_attribute, regionId_writers, memory=0):
+    '''
+    Clean and reproject geometry_file to GeoJSONSeq and pipe it straight into tippecanoe without a temporary file,
+    adding the FID inline. Regionid values are added to regionId_writers (a dict of column to RegionIdsWriter) from the same stream.
+    Returns the bbox ([w, e, s, n]), or None if there were no features, and tippecanoe's return code (non-zero if streaming failed)
+    '''
+    async with scheduler.slot(2, memory): # ogr2ogr and tippecanoe must run together
+        return await _stream_tiles(geometry_file, input_layer_name, layer_name, tile_settings, add_fid, fid_attribute, regionId_writers)
+
+async def _stream_tiles(geometry_file, input_layer_name, layer_name, tile_settings, add_fid, fid_attribute, regionId_writers):
+    o2o, o2o_finished = await build_trace.exec(None, layer_name, 'ogr2ogr cleaning', [
+        'ogr2ogr',
+        '-t_srs', 'EPSG:4326',
+        '-f', 'GeoJSONSeq',
+        '-dialect', 'SQLITE',
+        '-sql', 'SELECT ST_MakeValid(geometry) as geometry, * FROM "{}"'.format(input_layer_name),
+        '/vsistdout/', geometry_file
+    ], stdout=PIPE, limit=STREAM_LINE_LIMIT)
+    tippe, tippe_finished = await build_trace.exec(None, layer_name, 'tippecanoe', tippecanoe_args(layer_name, tile_settings), stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL)
+    print('Streaming geometry cleaning & reprojection into tippecanoe')
+
+    bounds = [float('inf'), float('-inf'), float('inf'), float('-inf')]
+    fid = 0
+    failed = False
+    try:
+        while True:
+            line = (await o2o.stdout.readline()).strip(b'\x1e \r\n') # Strip record separators if ogr2ogr adds them
+            if not line:
+                if o2o.stdout.at_eof():
+                    break
+                continue
+            feature = json.loads(line.decode('utf-8'))
+            if feature.get('properties') is None:
+                feature['properties'] = {}
+            properties = feature['properties']
+            if add_fid:
+                properties[fid_attribute] = fid
+                line = json.dumps(feature).encode('utf-8')
+            # Side consumers: bounding box and regionid values
+            extend_bounds(bounds, feature.get('geometry'))
+            feature_fid = int(properties[fid_attribute])
+            for column, writer in regionId_writers.items():
+                writer.set(feature_fid, properties.get(column))
+            tippe.stdin.write(line + b'\n')
+            await tippe.stdin.drain()
+            fid += 1
+    except (ConnectionError, ValueError) as err: # tippecanoe exited early, or ogr2ogr wrote something other than GeoJSON
+        print('Streaming {} into tippecanoe failed: {}'.format(layer_name, err))
+        failed = True
+    finally:
+        tippe.stdin.close()
+        if not o2o.stdout.at_eof():
+            # Nothing reads ogr2ogr's output any more, so it would block on a full pipe
+            try:
+                o2o.terminate()
+            except ProcessLookupError:
+                pass
+        await o2o_finished
+        returncode = await tippe_finished
+    if not failed:
+        print('Finished streaming {} features into tippecanoe'.format(fid))
+    # No bbox to write without features
+    return bounds if fid else None, returncode or int(failed)
+
+async def generate_test_csv(geometry_file, test_csv_file, input_layer_name, region_property, alias, layer_name):
     'Generate test csv for each region attribute. Attributes that require a disambiguation property are not supported'
-    o2o = await asyncio.create_subprocess_exec(*[
+    o2o, o2o_finished = await build_trace.exec(scheduler, layer_name, 'test csv {}'.format(region_property), [
         'ogr2ogr',
         '-f', 'CSV',
         '-dialect', 'SQLITE',
         '-sql', 'SELECT {0} as {1}, random() % 20 as randomval FROM "{2}"'.format(region_property, alias, input_layer_name),
         '/vsistdout/', geometry_file
     ], stdout=open(test_csv_file, 'w')) # CSV driver is problematic writing files, so deal with that in Python
-    return o2o.wait() # return finishing future (a future in a future)
+    return o2o_finished # return finishing future (a future in a future)
+
+async def compact_tiles(layer_name):
+    'Deduplicate and recompress the tiles of a layer (in a worker thread, as this is CPU bound)'
+    if compact_gzip_level is None:
+        return
+    stats = await build_trace.call(layer_name, 'compact', compact, mbtiles_filename(layer_name), compact_gzip_level)
+    print(format_stats('Compacted {}'.format(mbtiles_filename(layer_name)), stats))
 
+async def profile_tiles(layer_name):
+    'Profile the tiles of a layer, writing output_files/profile-<layer>.json and flagging the layer if tiles are over budget'
+    if tile_budget is None:
+        return
+    report = await build_trace.call(layer_name, 'profile tiles', profile_layer, layer_name, None, tile_budget)
+    if report['over_budget'] or report['decode_errors']:
+        print('Tile profile of {}:'.format(layer_name))
+        print(format_report(report))
+    else:
+        print('Tiles of {} are within budget (largest {} bytes)'.format(layer_name, report['total']['max_bytes']))
+
+async def verify_tiles(layer_name, num_features):
+    '''
+    Check the FIDs, region values and validity of the tiles of a layer, writing output_files/verify-<layer>.json.
+    Returns whether the tiles passed (or weren't checked), as failed layers mustn't be cached or published
+    '''
+    if not verify_layers:
+        return True
+    report = await build_trace.call(layer_name, 'verify tiles', verify_layer, layer_name, num_features)
+    print('Tile verification of {}:'.format(layer_name))
+    print(format_verify_report(report))
+    if not report['ok']:
+        print('Not caching or publishing {}, as its tiles failed verification (see output_files/verify-{}.json)'.format(layer_name, layer_name))
+    return report['ok']
+
+async def tune_tiles(geometry_file, input_layer_name, layer_name, generate_tiles_to):
+    '''
+    Choose tippecanoe settings for a layer that meet the auto tune target on a sample of the layer, writing the report of
+    every candidate tried to output_files/tune-<layer>.json. Returns the default settings when not auto tuning
+    '''
+    if auto_tune_target is None:
+        return default_settings(generate_tiles_to)
+    command = lambda tile_settings, geojson_files, output: tippecanoe_args(layer_name, tile_settings, geojson_files, output)
+    with build_trace.stage(layer_name, 'auto tune'):
+        tile_settings, report = await tune(scheduler, command, geometry_file, input_layer_name, generate_tiles_to, auto_tune_target)
+    with open(os.path.join('output_files', 'tune-{}.json'.format(layer_name)), 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Tuned tiles of {}: maxzoom {maxzoom}, detail {detail}, simplification {simplification}'.format(layer_name, **tile_settings) if report['met_target']
+          else 'No tile settings tried for {} meet the p99 target of {} bytes, using the defaults'.format(layer_name, auto_tune_target))
+    return tile_settings
+
+async def index_regions(geometry_file, input_layer_name, layer_name, columns, fid_attribute, key):
+    'Build the point in region index of a layer (in a worker thread), restoring it from the build cache if the source is unchanged'
+    if not build_region_indexes:
+        return
+    filename = region_index.index_filename(layer_name)
+    if build_cache.restore(key, {'index': filename}) is not None:
+        print('Restored {} from build cache'.format(filename))
+        return
+    count = await build_trace.call(layer_name, 'region index', region_index.build, geometry_file, input_layer_name, filename, columns, fid_attribute)
+    build_cache.store(key, {'index': filename})
+    print('Indexed {} regions of {} in {}'.format(count, layer_name, filename))
+
+async def store_when_finished(finished_future, key, files, metadata=None, link=False):
+    'Wait for a subprocess to finish, then store its artifacts in the build cache if it succeeded'
+    returncode = await finished_future
+    if returncode == 0:
+        build_cache.store(key, files, metadata, link)
+    return returncode
+
+def restore_regionids(key, filename):
+    'Restore a regionid file, its pre-compressed siblings and compact encoding (if one was written) from the build cache'
+    cached = build_cache.restore(key, regionids.outputs(filename))
+    if cached is not None and cached.get('encoding') and build_cache.restore(key, regionids.outputs(filename, compact=True)) is None:
+        return None
+    return cached
+
+async def cached_test_csv(geometry_file, test_csv_file, input_layer_name, region_property, alias, values, layer_name):
+    'Restore a test csv from the build cache (keyed by the region property values and alias), or generate it'
+    key = build_cache.key('test-csv', alias, values)
+    if build_cache.restore(key, {'csv': test_csv_file}) is not None:
+        print('Restored {} from build cache'.format(test_csv_file))
+        return asyncio.sleep(0) # Already finished
+    finished_future = await generate_test_csv(geometry_file, test_csv_file, input_layer_name, region_property, alias, layer_name)
+    return store_when_finished(finished_future, key, {'csv': test_csv_file})
+
+
+def regionMapping_entries_to_add(settings):
+    'Yield the name and settings of each regionMapping entry to add, from manifest settings or by requesting input'
+    if settings is not None:
+        for name, entry_settings in settings.get('regionMappingEntries', {}).items():
+            yield name, entry_settings
+        return
+    name = request_input('Name another regionMapping.json entry (leave blank to finish)', '')
+    while name != '':
+        yield name, None
+        name = request_input('Name another regionMapping.json entry (leave blank to finish)', '')
 
-async def create_layer(geometry_file):
+async def create_layer(geometry_file, stream=False, settings=None):
     '''
     Create a vector tile layer with a given geometry file complete with mbtiles, server config,
-    TerriaMap files and test csvs
+    TerriaMap files and test csvs. With stream, geometry is piped straight into tippecanoe instead of via temporary GeoJSON files.
+    Answers are taken from settings (a manifest layer entry) instead of prompts if given
     '''
     data_source = ogr.Open(geometry_file)
 
@@ -207,40 +445,52 @@ async def create_layer(geometry_file):
 
     layers = [data_source.GetLayerByIndex(i).GetName() for i in range(data_source.GetLayerCount())]
     print('File {} has the following layers: {}'.format(geometry_file, ', '.join(layers)))
-    input_layer_name = request_input('Which layer should be used?', layers[0] if len(layers) == 1 else '')
+    input_layer_name = ask(settings, 'inputLayer', 'Which layer should be used?', layers[0] if len(layers) == 1 else '')
     if input_layer_name not in layers:
         print('Layer {} is not in file {}'.format(input_layer_name, geometry_file))
         return
-    layer_name = request_input('What should this layer be called?', input_layer_name)
+    layer_name = ask(settings, 'layerName', 'What should this layer be called?', input_layer_name)
 
     layer = data_source.GetLayerByName(input_layer_name)
-    generate_tiles_to = int(request_input('What zoom level should tiles be generated to?', 12))
-    layer_defn = layer.GetLayerDefn()
-    attributes = [layer_defn.GetFieldDefn(i).name for i in range(layer_defn.GetFieldCount())]
-    layer_defn = None
+    generate_tiles_to = int(ask(settings, 'generateTilesTo', 'What zoom level should tiles be generated to?', 12))
+    attribute_table = AttributeTable(layer) # Attribute columns are read once and shared by FID validation, uniqueness checks and regionids
+    attributes = attribute_table.attributes
     print('Attributes in file: {}'.format(', '.join(attributes)))
-    has_fid = yes_no_to_bool(request_input('Is there an FID attribute?', 'n'), False)
-
-    geojson_tempfile = GeoJSONTemporaryFile(geometry_file, input_layer_name, not has_fid)
-    # Start geojson conversion. Must wait on the processing finished future sometime before Python execution ends
-    await geojson_tempfile.start()
+    if settings is None:
+        has_fid = yes_no_to_bool(request_input('Is there an FID attribute?', 'n'), False)
+    else:
+        has_fid = settings.get('fidAttribute') is not None
+    memory = 2 * geometry_size(geometry_file) # Rough estimate of tippecanoe memory use for scheduling
+
+    # Tiles only depend on the geometry file, layer choice and tippecanoe settings, so restore them if those haven't changed
+    source_digests = [file_digest(filename) for filename in geometry_files(geometry_file)] if build_cache.enabled else None
+    tiles_key = build_cache.key('mbtiles', source_digests,
+        input_layer_name, layer_name, generate_tiles_to, not has_fid, tippecanoe_args(layer_name, default_settings(generate_tiles_to)),
+        compact_gzip_level, auto_tune_target, partitions and (partitions, partition_zoom), bool(prepare_processes)) if build_cache.enabled else None
+    cached_tiles = build_cache.restore(tiles_key, {'mbtiles': mbtiles_filename(layer_name)}, link=True) # tippecanoe -f replaces the file, so linking is safe
+    if cached_tiles is not None:
+        print('Restored {} from build cache'.format(mbtiles_filename(layer_name)))
+        stream = False # Nothing to stream: regionids come from the attribute table
+    elif not stream:
+        geojson_tempfile = GeoJSONTemporaryFile(geometry_file, input_layer_name, not has_fid, layer_name)
+        # Start geojson conversion. Must wait on the processing finished future sometime before Python execution ends
+        await geojson_tempfile.start()
 
     # Ask for the current FID attribute if there is one, otherwise add an FID and use that
     # Test FID attribute
-    fid_attribute = request_input('Which attribute should be used as an FID?', 'FID') if has_fid else 'FID'
-    num_features = layer.GetFeatureCount()
-    if has_fid and set(layer.GetFeature(i).GetField(fid_attribute) for i in range(num_features)) != set(range(num_features)):
+    fid_attribute = ask(settings, 'fidAttribute', 'Which attribute should be used as an FID?', 'FID') if has_fid else 'FID'
+    num_features = attribute_table.num_features
+    if has_fid and not is_valid_fid(attribute_table.column(fid_attribute), num_features):
         print('Attribute not an appropriate FID (must number features from 0 to #features - 1 in any order)')
         return
 
-    server_url = request_input('Where is the vector tile server hosted?', 'http://localhost:8000/{}/{{z}}/{{x}}/{{y}}.pbf'.format(layer_name))
-    description = request_input('What is the description of this region map?', '')
+    server_url = ask(settings, 'server', 'Where is the vector tile server hosted?', 'http://localhost:8000/{}/{{z}}/{{x}}/{{y}}.pbf'.format(layer_name))
+    description = ask(settings, 'description', 'What is the description of this region map?', '')
     regionMapping_entries = OrderedDict()
-    regionMapping_entry_name = request_input('Name another regionMapping.json entry (leave blank to finish)', '')
     regionId_columns = set() # All the columns that need regionId file generation
     test_csv_futures = []
 
-    while regionMapping_entry_name != '':
+    for regionMapping_entry_name, entry_settings in regionMapping_entries_to_add(settings):
         o = OrderedDict([
             ('layerName', layer_name),
             ('server', server_url),
@@ -250,39 +500,64 @@ async def create_layer(geometry_file):
             ('bbox', None), # bbox is calculated asynchronously
             ('uniqueIdProp', fid_attribute),
             ('regionProp', None),
-            ('nameProp', select_name_prop(attributes)),
+            ('nameProp', select_name_prop(attributes, entry_settings)),
             ('aliases', None),
             ('description', description)
         ])
 
         # Get regionProp, aliases and disambigProp (if needed) for regionMapping.json file
         while True:
-            o['regionProp'] = request_input('Which attribute should be used as the region property?', '')
+            o['regionProp'] = ask(entry_settings, 'regionProp', 'Which attribute should be used as the region property?', '')
             if o['regionProp'] in attributes:
                 break
             print('Attribute {} not found'.format(o['regionProp']))
+            if entry_settings is not None:
+                return
         regionId_columns.add(o['regionProp'])
         o['regionIdsFile'] = 'data/regionids/region_map-{0}_{1}.json'.format(layer_name, o['regionProp'])
-        all_unique = unique_with_prop(data_source, input_layer_name, o['regionProp'])
+        all_unique = is_unique(attribute_table.column(o['regionProp']))
         print('The given region property {} each region.'.format('uniquely defines' if all_unique else 'does not uniquely define'))
-        o['aliases'] = request_input('What aliases should this be available under? Separate aliases with a comma and space', '').split(', ')
+        o['aliases'] = ask(entry_settings, 'aliases', 'What aliases should this be available under? Separate aliases with a comma and space', '')
+        if isinstance(o['aliases'], str):
+            o['aliases'] = o['aliases'].split(', ')
         if not all_unique:
             while True:
-                o['disambigProp'] = request_input('Which attribute should be used to disambiguate region matching?', '')
+                o['disambigProp'] = ask(entry_settings, 'disambigProp', 'Which attribute should be used to disambiguate region matching?', '')
                 if o['disambigProp'] in attributes:
                     break
                 print('Attribute {} not found'.format(o['disambigProp']))
+                if entry_settings is not None:
+                    return
             regionId_columns.add(o['disambigProp'])
             o['regionDisambigIdsFile'] = 'data/regionids/region_map-{0}_{1}.json'.format(layer_name, o['disambigProp'])
-            o['disambigRegionId'] = request_input('Which regionMapping definition does this disambiguation property come from?', '')
+            o['disambigRegionId'] = ask(entry_settings, 'disambigRegionId', 'Which regionMapping definition does this disambiguation property come from?', '')
             print('No test CSV generated for this regionMapping entry (test CSV generation does not currently support disambiguation properties)')
         else:
             # Make test CSVs (only when no disambiguation property needed)
             test_csv_file = os.path.join('output_files', 'test-{0}_{1}.csv'.format(layer_name, o['regionProp']))
-            test_csv_futures.append(await generate_test_csv(geometry_file, test_csv_file, input_layer_name, o['regionProp'], o['aliases'][0]))
+            test_csv_futures.append(await cached_test_csv(geometry_file, test_csv_file, input_layer_name, o['regionProp'], o['aliases'][0], attribute_table.column(o['regionProp']), layer_name))
 
         regionMapping_entries[regionMapping_entry_name] = o
-        regionMapping_entry_name = request_input('Name another regionMapping.json entry (leave blank to finish)', '')
+
+    # Extract all the values needed for the regionid files that aren't cached before closing the data source
+    # Doesn't assume that fids are sequential: features without an FID attribute are given FIDs in layer order
+    regionId_writers = OrderedDict()
+    regionId_keys = {}
+    for column in sorted(regionId_columns):
+        regionId_filename = os.path.join('output_files', 'region_map-{0}_{1}.json'.format(layer_name, column))
+        regionId_keys[column] = build_cache.key('regionids', source_digests, input_layer_name, layer_name, column, has_fid and fid_attribute, compact_regionids) if build_cache.enabled else None
+        if restore_regionids(regionId_keys[column], regionId_filename) is not None:
+            print('Restored {} from build cache'.format(regionId_filename))
+        else:
+            regionId_writers[column] = regionids.RegionIdsWriter(regionId_filename, layer_name, column, num_features, compact_regionids)
+    if regionId_writers and not stream: # Otherwise values are collected from the geometry stream
+        def collect_regionids():
+            # The FID attribute has already been checked to number features from 0, so values can be written out of order by FID
+            fids = attribute_table.column(fid_attribute) if has_fid else np.arange(num_features)
+            for column, values in zip(regionId_writers, attribute_table.columns(*regionId_writers)):
+                regionId_writers[column].extend(fids, values)
+        build_trace.measure(layer_name, 'regionid values', collect_regionids)
+    attribute_table = None
 
     # Close data source
     layer = None
@@ -298,67 +573,150 @@ async def create_layer(geometry_file):
     config_filename = os.path.join('config', '{0}.json'.format(layer_name))
     json.dump(config_json, open(config_filename, 'w'))
 
+    def write_outputs(bounds, tile_settings, cache_regionids=True):
+        'Add bbox and max zoom to regionMapping entries, then write the regionMapping and regionid files'
+        w, e, s, n = bounds
+        for entry in regionMapping_entries.values():
+            entry['bbox'] = [w, s, e, n]
+            entry['serverMaxNativeZoom'] = tile_settings['maxzoom']
+        # Make regionMapping file
+        regionMapping_filename = os.path.join('output_files', 'regionMapping-{0}.json'.format(layer_name))
+        json.dump({'regionWmsMap': regionMapping_entries}, open(regionMapping_filename, 'w'), indent=4)
+
+        # Make the regionid files that weren't restored from the build cache
+        for column, writer in regionId_writers.items():
+            build_trace.measure(layer_name, 'regionids {}'.format(column), writer.close)
+            print(regionids.size_summary(writer.filename))
+            if cache_regionids:
+                files = regionids.outputs(writer.filename)
+                if writer.encoding:
+                    files.update(regionids.outputs(writer.filename, compact=True))
+                build_cache.store(regionId_keys[column], files, {'encoding': writer.encoding})
+
+    # The index is built from the source geometry, so it doesn't wait on tiling
+    index_key = build_cache.key('regionindex', source_digests, input_layer_name, layer_name, sorted(regionId_columns), has_fid and fid_attribute) if build_cache.enabled else None
+    index_future = asyncio.ensure_future(index_regions(geometry_file, input_layer_name, layer_name, sorted(regionId_columns), fid_attribute if has_fid else None, index_key))
+
     async def finish_processing():
-        # Wait for geojson conversion here, then add bbox to regionMapping entries, generate regionids and generate vector tiles
-        async with geojson_tempfile as geojson_filename:
-            # Start tippecanoe
-            tippecanoe_future = await generate_tiles(geojson_filename, layer_name, generate_tiles_to)
-
-            # Calculate bounding box upadte regionMapping entries, then write to file
-            geojson_ds = ogr.GetDriverByName('GeoJSON').Open(geojson_filename)
-            geojson_layer = geojson_ds.GetLayer()
-            w, e, s, n = geojson_layer.GetExtent()
-            for entry in regionMapping_entries.values():
-                entry['bbox'] = [w, s, e, n]
-            # Make regionMapping file
-            regionMapping_filename = os.path.join('output_files', 'regionMapping-{0}.json'.format(layer_name))
-            json.dump({'regionWmsMap': regionMapping_entries}, open(regionMapping_filename, 'w'), indent=4)
-
-            # Make regionid files
-            # Extract all the variables needed for the regionid files
-            # Doesn't assume that fids are sequential
-            # Make a dict of the attributes from the features first, then put them in the right order
-            geojson_layer.ResetReading() # Reset layer reading before iterating over layer
-            regionID_values_dict = {feature.GetField(fid_attribute): tuple(feature.GetField(column) for column in regionId_columns) for feature in geojson_layer}
-            # The FID attribute has already been checked to allow this transformation
-            regionID_values = [regionID_values_dict[i] for i in range(num_features)]
-            for column, values in zip(regionId_columns, zip(*regionID_values)):
-                regionId_json = OrderedDict([ # Make string comparison of files possible
-                    ('layer', layer_name),
-                    ('property', column),
-                    ('values', list(values))
-                ])
-                regionId_filename = os.path.join('output_files', 'region_map-{0}_{1}.json'.format(layer_name, column))
-                json.dump(regionId_json, open(regionId_filename, 'w'))
-            geojson_layer = None
-            geojson_ds = None
-            await tippecanoe_future # Wait for tippecanoe to finish before destroying the geojson file
-        await asyncio.gather(*test_csv_futures) # Wait for csv generation to finish (almost definitely finished by here anyway, but correctness yay)
-        return layer_name
+        if cached_tiles is not None:
+            write_outputs(cached_tiles['bounds'], cached_tiles.get('tileSettings', default_settings(generate_tiles_to)))
+            await asyncio.gather(index_future, *test_csv_futures)
+            return layer_name
+        verified = True
+        # Tuning runs on samples of the source, alongside geojson conversion
+        tile_settings = await tune_tiles(geometry_file, input_layer_name, layer_name, generate_tiles_to)
+        if stream:
+            # Reprojection and tiling overlap, with bbox and regionids collected from the same stream
+            bounds, returncode = await stream_tiles(geometry_file, input_layer_name, layer_name, tile_settings, not has_fid, fid_attribute, regionId_writers, memory)
+            if bounds is None:
+                print('No features streamed from {}, skipping {}'.format(geometry_file, layer_name))
+                await asyncio.gather(index_future, *test_csv_futures)
+                return None
+            write_outputs(bounds, tile_settings, cache_regionids=returncode == 0) # Values may be missing if streaming failed
+            if returncode == 0:
+                await compact_tiles(layer_name)
+                await profile_tiles(layer_name)
+                verified = await verify_tiles(layer_name, num_features)
+                if verified:
+                    build_cache.store(tiles_key, {'mbtiles': mbtiles_filename(layer_name)}, {'bounds': bounds, 'tileSettings': tile_settings}, link=True)
+        else:
+            # Wait for geojson conversion here, then add bbox to regionMapping entries, generate regionids and generate vector tiles
+            async with geojson_tempfile as geojson_filename:
+                # Start tippecanoe
+                tippecanoe_future = await generate_tiles(geojson_filename, layer_name, tile_settings, memory)
+
+                bounds = build_trace.measure(layer_name, 'bbox', geojson_bounds, geojson_filename)
+                write_outputs(bounds, tile_settings)
+                # Wait for tippecanoe to finish before destroying the geojson file
+                if await tippecanoe_future == 0:
+                    await compact_tiles(layer_name)
+                    await profile_tiles(layer_name)
+                    verified = await verify_tiles(layer_name, num_features)
+                    if verified:
+                        build_cache.store(tiles_key, {'mbtiles': mbtiles_filename(layer_name)}, {'bounds': list(bounds), 'tileSettings': tile_settings, 'geometryCounters': geojson_tempfile.counters}, link=True)
+        await asyncio.gather(index_future, *test_csv_futures) # Wait for csv generation to finish (almost definitely finished by here anyway, but correctness yay)
+        return layer_name if verified else None # Layers that failed verification aren't published
 
     return finish_processing() # Return a future to a future to the layer_name
 
+async def timed(name, finished_future, wall_clock):
+    'Wait for a layer to finish processing, recording when it finished'
+    layer_name = await finished_future
+    wall_clock.finish(name)
+    if build_trace.write(layer_name) is not None:
+        print(build_trace.summary(layer_name))
+    return layer_name
+
 async def main():
-    # geometries = ['geoserver_shapefiles/FID_SA4_2011_AUST.shp']
-    geometries = sys.argv[1:] or request_input('Which geometries do you want to add? Seperate geometry files with a comma and space', '').split(', ')
-    finished_layers = await asyncio.gather(*[await create_layer(geometry_file) for geometry_file in geometries])
+    global scheduler, build_cache, build_trace, compact_gzip_level, tile_budget, auto_tune_target, partitions, partition_zoom, compact_regionids, prepare_processes, build_region_indexes, verify_layers
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('geometries', nargs='*', help='Geometry files to create layers from')
+    parser.add_argument('--stream', action='store_true', help='Pipe cleaned geometry straight into tippecanoe instead of writing temporary GeoJSON files')
+    parser.add_argument('--manifest', help='JSON/YAML manifest of layers to build without prompts (see manifest.py)')
+    parser.add_argument('--max-processes', type=int, help='Maximum number of subprocesses to run at once (default: number of cores)')
+    parser.add_argument('--max-memory', type=float, help='Maximum estimated memory in GB of subprocesses running at once (default: physical memory)')
+    parser.add_argument('--cache-dir', default='cache', help='Directory of the build cache used to skip regenerating unchanged artifacts (default: cache)')
+    parser.add_argument('--no-cache', action='store_true', help='Rebuild everything without reading or writing the build cache')
+    parser.add_argument('--gzip-level', type=int, default=9, help='gzip level to recompress tiles at when compacting mbtiles (default: 9)')
+    parser.add_argument('--no-compact', action='store_true', help="Leave tippecanoe's mbtiles as is instead of deduplicating and recompressing tiles")
+    parser.add_argument('--tile-budget', type=float, default=500, help='Flag layers with compressed tiles over this size in KB (default: 500)')
+    parser.add_argument('--no-profile', action='store_true', help="Don't profile the tiles of each layer after generating them")
+    parser.add_argument('--no-verify', action='store_true', help="Don't check the FIDs, region values and validity of the tiles of each layer after generating them (see verify_tiles.py)")
+    parser.add_argument('--auto-tune', type=float, metavar='KB', help='Tune maxzoom, detail and simplification of each layer on a sample so p99 compressed tile size is under KB (see auto_tune.py)')
+    parser.add_argument('--partitions', type=int, help='Tile each layer in this many spatial partitions in parallel, merging them afterwards (see partition_tiles.py)')
+    parser.add_argument('--partition-zoom', type=int, default=partition_tiles.PARTITION_ZOOM, help='Zoom level partitions start from, with lower zooms tiled from every feature (default: {})'.format(partition_tiles.PARTITION_ZOOM))
+    parser.add_argument('--compact-regionids', action='store_true', help='Also write a compact (delta or dictionary) encoding of each regionid file (see regionids.py)')
+    parser.add_argument('--prepare-processes', type=int, help='Repair and reproject geometry in this many worker processes instead of one ogr2ogr (see prepare_geometry.py)')
+    parser.add_argument('--region-index', action='store_true', help='Also build a point in region index of each layer, for region_index.py lookups (needs Shapely 1.8)')
+    parser.add_argument('--trace', action='store_true', help='Record the time, CPU, peak memory and IO of each build stage, writing output_files/trace-<layer>.json (Chrome trace format) and a summary table (see build_trace.py)')
+    parser.add_argument('--profile-stages', action='store_true', help='Also run in-process stages under cProfile, writing output_files/trace-<layer>-<stage>.prof (implies --trace)')
+    args = parser.parse_args()
+    if args.region_index and region_index is None:
+        parser.error('--region-index needs Shapely 1.8 (pip install -r requirements.txt)')
+    if args.prepare_processes and args.stream:
+        parser.error('--prepare-processes writes temporary GeoJSON files, so it cannot be used with --stream')
+    if args.partitions and args.stream:
+        parser.error('--partitions splits temporary GeoJSON files, so it cannot be used with --stream')
+    compact_gzip_level = None if args.no_compact else args.gzip_level
+    tile_budget = None if args.no_profile else int(args.tile_budget * 1024)
+    verify_layers = not args.no_verify
+    auto_tune_target = args.auto_tune and int(args.auto_tune * 1024)
+    partitions, partition_zoom = args.partitions, args.partition_zoom
+    compact_regionids = args.compact_regionids
+    prepare_processes = args.prepare_processes
+    build_region_indexes = args.region_index
+    scheduler = JobScheduler(args.max_processes, args.max_memory and int(args.max_memory * 1024**3))
+    build_cache = BuildCache(None if args.no_cache else args.cache_dir)
+    build_trace = BuildTrace('output_files' if args.trace or args.profile_stages else None, args.profile_stages)
+    wall_clock = WallClock()
+
+    if args.manifest:
+        async def build(settings):
+            name = settings.get('layerName') or settings['geometryFile']
+            wall_clock.start(name)
+            finished_future = await create_layer(settings['geometryFile'], stream=args.stream, settings=settings)
+            return await timed(name, finished_future, wall_clock) if finished_future is not None else None
+        # Queue the largest layers first so they aren't left running alone at the end
+        layer_settings = sorted(load_manifest(args.manifest), key=lambda settings: geometry_size(settings['geometryFile']), reverse=True)
+        finished_layers = await asyncio.gather(*[build(settings) for settings in layer_settings])
+    else:
+        # geometries = ['geoserver_shapefiles/FID_SA4_2011_AUST.shp']
+        geometries = args.geometries or request_input('Which geometries do you want to add? Seperate geometry files with a comma and space', '').split(', ')
+        finished_futures = []
+        for geometry_file in geometries:
+            wall_clock.start(geometry_file)
+            finished_future = await create_layer(geometry_file, stream=args.stream)
+            if finished_future is not None:
+                finished_futures.append(timed(geometry_file, finished_future, wall_clock))
+        finished_layers = await asyncio.gather(*finished_futures)
+    finished_layers = [layer_name for layer_name in finished_layers if layer_name is not None]
+    print(wall_clock.summary())
 
     try:
-        terria_aws = boto3.session.Session(profile_name='terria')
-
-        s3 = terria_aws.resource('s3')
-        bucket = s3.Bucket('vector-tile-server')
-        for layer_name in finished_layers:
-            # Get the highest version of this layer and add 1
-            maxversion = max([int(re.search(r'v(\d*).json$', obj.key).group(1)) for obj in bucket.objects.filter(Prefix='config/{}'.format(layer_name))] + [0]) # Default to 0
-            print('Uploading {}-v{} to S3'.format(layer_name, maxversion+1))
-
-            bucket.upload_file('config/{}.json'.format(layer_name), 'config/{}-v{}.json'.format(layer_name, maxversion+1))
-            bucket.upload_file('data/{}.mbtiles'.format(layer_name), 'mbtiles/{}-v{}.mbtiles'.format(layer_name, maxversion+1))
+        publish_layers(s3_client(), BUCKET, finished_layers)
     except:
         print('Uploading to S3 failed. New config saved to config/{layerName}.json and vector tiles to data/{layerName}.mbtiles')
 
-
 if __name__ == '__main__':
     # Create folders if they don't exist
     for directory in ['data', 'config', 'output_files', 'temp']:
@@ -3,11 +3,14 @@
 from __future__ import print_function
 
 from datetime import date
-import re, json, base64
+import json, base64
 
 import boto3
 
 from common import request_input, yes_no_to_bool
+import layer_index
+import sharding
+from tile_diff import invalidation_paths
 
 # Walk user through choosing layers (and versions of layers)
 # Allow them to choose to create a deployment from another deployment or to choose all latest or choose individual versions
@@ -19,32 +22,29 @@ print('Connecting to and analysing S3 bucket')
 
 terria_aws = boto3.session.Session(profile_name='terria')
 
-# Get all layers currently on the server
-s3 = terria_aws.resource('s3')
+# Get all layers, deployments and server versions from the bucket index
 s3c = terria_aws.client('s3')
-bucket = s3.Bucket('vector-tile-server')
-keys = [re.search(r'config/(.*)-v(\d*).json$', obj.key).groups() for obj in bucket.objects.filter(Prefix='config/')]
+bucket_name = 'vector-tile-server'
+index, _ = layer_index.load_index(s3c, bucket_name)
+if index is None:
+    print('No index in S3 bucket, building one from a bucket listing (run layer_index.py rebuild to save it)')
+    index = layer_index.rebuild_index(s3c, bucket_name)
 
 # Dictionary of all versions of each layer
-all_versions = {}
-for key, version in keys:
-    all_versions[key] = all_versions.get(key, []) + [int(version)]
+all_versions = layer_index.layer_versions(index)
 
 # Layers to use this deployment
 deployment_data = {}
 
 # Latest available layers
-latest_layers = {}
-for layer, versions in all_versions.items():
-    latest_layers[layer] = max(versions)
+latest_layers = layer_index.latest_layers(index)
 
 if method == 'a':
     deployment_data = latest_layers
 elif method == 'p':
-    old_deployments = sorted([re.search(r'deployments/(.*).json$', key.key).group(1) for key in bucket.objects.filter(Prefix='deployments/')], reverse=True)
+    old_deployments = sorted(index['deployments'].keys(), reverse=True)
     old_deployment = request_input('Out of {}, which old deployment do you want to use?'.format(', '.join(old_deployments)), old_deployments[0])
-    obj = s3c.get_object(Bucket=bucket.name, Key='deployments/{}.json'.format(old_deployment))
-    old_data = json.loads(obj['Body'].read().decode('utf-8'))["data"]
+    old_data = dict(index['deployments'][old_deployment])
     all_layers = set(latest_layers.keys()) | set(old_data.keys())
     changed_layers = [(layer, old_data.get(layer, 0), latest_layers.get(layer, 0)) for layer in all_layers if old_data.get(layer, 0) != latest_layers.get(layer, 0)]
     if changed_layers:
@@ -63,21 +63,85 @@ elif method == 'l':
     print('\n'.join('{:40}  {:7}'.format(*t) for t in [('Layer name', 'Version')] + list(latest_layers.items())))
     deployment_data = dict([(layer_str.split(':')[0], int(layer_str.split(':')[1])) for layer_str in filter(None, request_input('Which layers do you want to add/change versions? Format layers like layer_name:version and separate layers with a comma and space:', '').split(', '))])
 
+deployment = {"data": deployment_data}
+# Layers the server waits for before it starts serving, downloaded first on boot (see server/download_data.py)
+priority = [layer.strip() for layer in request_input('Which layers should be ready before the server starts? Separate layers with a comma (leave blank to start once any layer is ready):', '').split(',') if layer.strip() in deployment_data]
+if priority:
+    deployment['priority'] = priority
+
+# Servers with the previous version of a layer download its delta package instead of the whole mbtiles (see server/download_data.py)
+deltas = {}
+for layer, version in deployment_data.items():
+    delta = index['layers'].get(layer, {}).get(str(version), {}).get('delta', {})
+    if 'key' in delta:
+        deltas[layer] = {'from': delta['from'], 'key': delta['key']}
+if deltas:
+    deployment['deltas'] = deltas
+
+# Shard the layers across several servers (nodes), each serving only its layers from its own stack (see sharding.py)
+node_count = int(request_input('How many servers should the layers be sharded across? (1 for every server to serve every layer)', '1'))
+nodes = sharding.node_names(node_count) if node_count > 1 else []
+if nodes:
+    report_file = request_input('Log analysis report (from analyse_logs.py) to weight layers by requests (leave blank to weight by size only):', '')
+    requests = sharding.load_requests(report_file) if report_file else None
+    previous_assignment = None
+    if method == 'p':
+        old_document = json.loads(s3c.get_object(Bucket=bucket_name, Key='deployments/{}.json'.format(old_deployment))['Body'].read().decode('utf-8'))
+        previous_assignment = old_document.get('shards', {}).get('routing')
+    sizes = sharding.deployment_sizes(index, deployment_data)
+    assignment, weights = sharding.shard(sizes, node_count, requests, previous_assignment)
+    print(sharding.format_shards(assignment, weights, sizes, nodes))
+    if previous_assignment:
+        moved = sharding.moved_layers(previous_assignment, assignment)
+        print('{} layers are new to the servers they are assigned to: {}'.format(len(moved), ', '.join(moved)))
+    deployment['shards'] = {'nodes': nodes, 'routing': assignment}
+    # Stack URLs, as in the outputs of aws-template.json
+    node_hosts = {node: '{}-{}.terria.io'.format(deployment_name, node) for node in nodes}
+    with open('proxy-{}.conf'.format(deployment_name), 'w') as f:
+        f.write(sharding.proxy_config(assignment, node_hosts))
+    print('Front proxy config (nginx) routing layers to servers written to proxy-{}.conf'.format(deployment_name))
+
+if method == 'p':
+    # Tiles to invalidate in caches in front of the old deployment: just the changed tiles of layers diffed against their old
+    # version, and every tile of other changed layers
+    paths = []
+    for layer in sorted(set(deployment_data) | set(index['deployments'][old_deployment])):
+        old_version, new_version = index['deployments'][old_deployment].get(layer), deployment_data.get(layer)
+        if old_version == new_version:
+            continue
+        delta = index['layers'].get(layer, {}).get(str(new_version), {}).get('delta', {})
+        if old_version is not None and delta.get('from') == old_version:
+            diff_report = json.loads(s3c.get_object(Bucket=bucket_name, Key=delta['diff'])['Body'].read().decode('utf-8'))
+            layer_paths = invalidation_paths(diff_report, layer)
+            print('{}: {} tiles changed or removed since v{}'.format(layer, len(layer_paths), old_version))
+        else:
+            layer_paths = ['/{}/*'.format(layer)]
+            print('{}: no diff from {}, invalidating every tile'.format(layer, 'v{}'.format(old_version) if old_version else 'the old deployment'))
+        paths.extend(layer_paths)
+    if paths:
+        with open('invalidate-{}.txt'.format(deployment_name), 'w') as f:
+            f.writelines(path + '\n' for path in paths)
+        print('Paths to invalidate written to invalidate-{}.txt'.format(deployment_name))
+
 key = 'deployments/{}.json'.format(deployment_name)
 obj = s3c.put_object(
-    Bucket=bucket.name,
+    Bucket=bucket_name,
     Key=key,
-    Body=json.dumps({"data": deployment_data}).encode('utf-8')
+    Body=json.dumps(deployment).encode('utf-8')
 )
+for node, node_deployment in sharding.node_deployments(deployment, deployment.get('shards', {}).get('routing', {}), nodes).items():
+    s3c.put_object(Bucket=bucket_name, Key='deployments/{}/{}.json'.format(deployment_name, node), Body=json.dumps(node_deployment).encode('utf-8'))
+layer_index.set_deployment(s3c, bucket_name, deployment_name, deployment_data)
 if yes_no_to_bool(request_input('Deployment file {} uploaded to S3. Start an EC2 with this deployment configuration?'.format(key), 'y'), False):
     # Retrive user-data and template from S3
-    server_versions = sorted([re.search(r'server-(.*).tar.gz$', key.key).group(1) for key in bucket.objects.filter(Prefix='server-')], key=lambda s: [int(n) for n in s.split('.')], reverse=True)
+    server_versions = list(reversed(index['servers']))
     server_version = request_input('Out of {}, which server version do you want to use?'.format(', '.join(server_versions)), server_versions[0])
 
-    userdata = open('user-data').read().replace('{~STACK NAME~}', deployment_name).replace('{~SERVER VERSION~}', server_version)
-    template = open('aws-template.json').read().replace('{~BASE64 USER DATA~}', base64.b64encode(userdata.encode('utf-8')).decode('utf-8'))
-
     cfn = terria_aws.client('cloudformation', region_name='ap-southeast-2')
-    cfn.create_stack(StackName=deployment_name, TemplateBody=template, Capabilities=['CAPABILITY_IAM'])
-    print('Stack {} created'.format(deployment_name))
+    # A stack per node of a sharded deployment, each downloading its node's deployment document
+    for stack_name, node_args in [('{}-{}'.format(deployment_name, node), '--node {}'.format(node)) for node in nodes] or [(deployment_name, '')]:
+        userdata = open('user-data').read().replace('{~STACK NAME~}', deployment_name).replace('{~NODE ARGS~}', node_args).replace('{~SERVER VERSION~}', server_version)
+        template = open('aws-template.json').read().replace('{~BASE64 USER DATA~}', base64.b64encode(userdata.encode('utf-8')).decode('utf-8'))
+        cfn.create_stack(StackName=stack_name, TemplateBody=template, Capabilities=['CAPABILITY_IAM'])
+        print('Stack {} created'.format(stack_name))
 
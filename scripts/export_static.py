@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Export data/<layer>.mbtiles to a static tree of tiles, <output>/<layer>/<z>/<x>/<y>.pbf, for serving from nginx or a CDN
+instead of Tessera. Every tile is written uncompressed with pre-compressed .pbf.gz and (if the brotli module is installed)
+.pbf.br siblings, for nginx gzip_static/brotli_static. Empty tiles are hard links to a single shared empty.pbf, which should
+also be served for missing tiles (eg. try_files $uri /<layer>/empty.pbf). Exporting over a previous export replaces its files
+(never writing through the shared links) and removes tiles no longer in the mbtiles. A TileJSON manifest is written to
+<output>/<layer>/tilejson.json, and with --update-config config/<layer>.json is pointed at it
+'''
+
+import argparse
+import gzip
+import json
+import os
+import re
+from collections import OrderedDict
+from contextlib import closing
+from multiprocessing import Pool
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from mbtiles import open_mbtiles, decompress, metadata, flip_y, tile_columns, batches, column_tiles
+
+BATCH_SIZE = 16 # Tile columns per worker task
+TILE_FILE = re.compile(r'^([0-9]+)\.pbf(\.gz|\.br)?$')
+
+
+def replace_file(filename, data):
+    'Write a file by replacing it, so other hard links to the file it replaces (empty tiles) are left as they were'
+    temp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temp, 'wb') as f:
+        f.write(data)
+    os.replace(temp, filename)
+
+
+def write_variants(filename, data, gzip_level, brotli_quality):
+    'Write an uncompressed tile and its compressed siblings'
+    replace_file(filename, data)
+    replace_file(filename + '.gz', gzip.compress(data, gzip_level))
+    if brotli is not None:
+        replace_file(filename + '.br', brotli.compress(data, quality=brotli_quality))
+    elif os.path.exists(filename + '.br'):
+        os.remove(filename + '.br') # From an export with brotli
+
+
+def link_variants(source, filename):
+    'Hard link a tile and its compressed siblings'
+    for suffix in ['', '.gz', '.br']:
+        if os.path.exists(source + suffix):
+            temp = '{}.{}.tmp'.format(filename + suffix, os.getpid())
+            os.link(source + suffix, temp)
+            os.replace(temp, filename + suffix)
+        elif os.path.exists(filename + suffix):
+            os.remove(filename + suffix)
+
+
+def remove_stale_tiles(db, layer_dir):
+    'Remove tiles (and empty directories) left in layer_dir by a previous export that are no longer in the mbtiles. Returns the number of tiles removed'
+    removed = 0
+    for z_name in filter(str.isdigit, os.listdir(layer_dir)):
+        z, z_dir = int(z_name), os.path.join(layer_dir, z_name)
+        for x_name in filter(str.isdigit, os.listdir(z_dir)):
+            x_dir = os.path.join(z_dir, x_name)
+            rows = {flip_y(z, row) for row, in db.execute('SELECT tile_row FROM tiles WHERE zoom_level = ? AND tile_column = ?', (z, int(x_name)))}
+            for name in os.listdir(x_dir):
+                match = TILE_FILE.match(name)
+                if match and int(match.group(1)) not in rows:
+                    os.remove(os.path.join(x_dir, name))
+                    removed += not match.group(2) # Count each tile once, not each variant
+            if not os.listdir(x_dir):
+                os.rmdir(x_dir)
+        if not os.listdir(z_dir):
+            os.rmdir(z_dir)
+    return removed
+
+
+def export_batch(args):
+    'Export the tiles in a batch of tile columns. Runs in a worker process. Returns (tiles, empty tiles, bytes written uncompressed)'
+    mbtiles, layer_dir, columns, gzip_level, brotli_quality = args
+    empty = os.path.join(layer_dir, 'empty.pbf')
+    tiles = empty_tiles = size = 0
+    with closing(open_mbtiles(mbtiles)) as db:
+        for z, x, y, data in column_tiles(db, columns):
+            tile_dir = os.path.join(layer_dir, str(z), str(x))
+            os.makedirs(tile_dir, exist_ok=True)
+            filename = os.path.join(tile_dir, '{}.pbf'.format(y))
+            data = decompress(data)
+            tiles += 1
+            if not data:
+                link_variants(empty, filename)
+                empty_tiles += 1
+            else:
+                write_variants(filename, data, gzip_level, brotli_quality)
+                size += len(data)
+    return tiles, empty_tiles, size
+
+
+def export_layer(mbtiles, output_dir, base_url='', processes=None, gzip_level=9, brotli_quality=11):
+    'Export a layer mbtiles to output_dir/<layer>. Returns the TileJSON manifest'
+    layer_name = os.path.splitext(os.path.basename(mbtiles))[0]
+    layer_dir = os.path.join(output_dir, layer_name)
+    os.makedirs(layer_dir, exist_ok=True)
+    write_variants(os.path.join(layer_dir, 'empty.pbf'), b'', gzip_level, brotli_quality)
+
+    with closing(open_mbtiles(mbtiles)) as db:
+        meta = metadata(db)
+        tasks = [(mbtiles, layer_dir, columns, gzip_level, brotli_quality) for columns in batches(tile_columns(db), BATCH_SIZE)]
+    tiles = empty_tiles = size = 0
+    with Pool(processes) as pool:
+        for batch_tiles, batch_empty, batch_size in pool.imap_unordered(export_batch, tasks):
+            tiles += batch_tiles
+            empty_tiles += batch_empty
+            size += batch_size
+    with closing(open_mbtiles(mbtiles)) as db:
+        removed = remove_stale_tiles(db, layer_dir)
+
+    manifest = OrderedDict([
+        ('tilejson', '2.2.0'),
+        ('name', meta.get('name', layer_name)),
+        ('format', 'pbf'),
+        ('tiles', ['{}/{}/{{z}}/{{x}}/{{y}}.pbf'.format(base_url.rstrip('/'), layer_name)]),
+        ('minzoom', int(meta.get('minzoom', 0))),
+        ('maxzoom', int(meta.get('maxzoom', 0))),
+        ('bounds', [float(v) for v in meta['bounds'].split(',')] if 'bounds' in meta else [-180, -85.0511, 180, 85.0511]),
+        ('vector_layers', json.loads(meta['json']).get('vector_layers', []) if 'json' in meta else []),
+        ('empty', 'empty.pbf'),
+        ('tileCount', tiles),
+        ('emptyTileCount', empty_tiles),
+        ('encodings', ['identity', 'gzip'] + (['br'] if brotli is not None else []))
+    ])
+    with open(os.path.join(layer_dir, 'tilejson.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print('Exported {}: {} tiles ({} empty), {:.1f}MB uncompressed{}'.format(layer_name, tiles, empty_tiles, size / 1024**2,
+                                                                           ', removed {} stale tiles'.format(removed) if removed else ''))
+    return manifest
+
+
+def update_config(layer_name, tilejson_url):
+    'Point the layer config in config/<layer>.json at its static tile manifest'
+    config_filename = os.path.join('config', '{}.json'.format(layer_name))
+    with open(config_filename) as f:
+        config = json.load(f, object_pairs_hook=OrderedDict)
+    config['/{}'.format(layer_name)]['staticTiles'] = tilejson_url
+    with open(config_filename, 'w') as f:
+        json.dump(config, f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('layers', nargs='+', help='Names of layers to export from data/<layer>.mbtiles')
+    parser.add_argument('--output', default='static', help='Directory to export tiles to (default: static)')
+    parser.add_argument('--base-url', default='', help='URL the output directory will be served from, used in the TileJSON manifests')
+    parser.add_argument('--update-config', action='store_true', help='Add a staticTiles entry pointing at the manifest to config/<layer>.json')
+    parser.add_argument('--processes', type=int, help='Number of worker processes (default: number of cores)')
+    parser.add_argument('--gzip-level', type=int, default=9)
+    parser.add_argument('--brotli-quality', type=int, default=11)
+    args = parser.parse_args()
+
+    if brotli is None:
+        print('brotli module not installed, only writing gzip variants')
+    for layer_name in args.layers:
+        export_layer(os.path.join('data', '{}.mbtiles'.format(layer_name)), args.output, args.base_url, args.processes, args.gzip_level, args.brotli_quality)
+        if args.update_config:
+            update_config(layer_name, '{}/{}/tilejson.json'.format(args.base_url.rstrip('/'), layer_name))
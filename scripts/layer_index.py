@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Index of everything in the vector-tile-server bucket, kept in a single object (index.json) so that publishing and deploying
+don't need to list the bucket. The index looks like:
+
+{
+    "layers": {"<layer>": {"<version>": {"config": {"size": 123, "sha256": "..."},
+                                         "mbtiles": {"size": 456, "sha256": "...", "content": "..."},
+                                         "hashes": {"size": 78, "sha256": "..."},
+                                         "delta": {"from": <version>, "diff": "diffs/...", "key": "deltas/...", ...}}}},
+    "deployments": {"<deployment>": {"<layer>": <version>}},
+    "servers": ["1.0.0"]
+}
+
+A version that has been reserved by a publish that hasn't finished is recorded as {"pending": true}. "delta" records the diff
+report and (if one was worth uploading) delta package from the previous version, "content" the content digest of the
+tiles (see tile_diff.py) and "hashes" the tile hashes the next version is diffed against, see publish.py.
+The index is updated with conditional writes (If-Match on its ETag), retrying when another writer got in first.
+Usage: layer_index.py rebuild|show|add-server <version>
+'''
+
+import argparse
+import json
+import re
+import threading
+
+from botocore.exceptions import ClientError
+
+INDEX_KEY = 'index.json'
+MAX_ATTEMPTS = 10
+
+_conditions = threading.local() # Conditional headers for the current thread's next index write
+
+
+def _add_condition_headers(request, **kwargs):
+    for header, value in getattr(_conditions, 'headers', {}).items():
+        request.headers[header] = value
+
+
+def _put_index(s3c, bucket, index, etag):
+    'Write the index only if it is unchanged since it was read (etag), or if there is no index yet (etag None). Returns False on conflict'
+    # Added as raw headers so conditional writes work with the pinned botocore, which predates the IfMatch parameter
+    s3c.meta.events.register('before-sign.s3.PutObject', _add_condition_headers, unique_id='layer-index-conditions')
+    _conditions.headers = {'If-Match': etag} if etag is not None else {'If-None-Match': '*'}
+    try:
+        s3c.put_object(Bucket=bucket, Key=INDEX_KEY, Body=json.dumps(index, indent=1, sort_keys=True).encode('utf-8'), ContentType='application/json')
+    except ClientError as err:
+        if err.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+            return False
+        raise
+    finally:
+        _conditions.headers = {}
+    return True
+
+
+def empty_index():
+    return {'layers': {}, 'deployments': {}, 'servers': []}
+
+
+def load_index(s3c, bucket):
+    'Read the index in one GET. Returns (index, etag), or (None, None) if there is no index yet'
+    try:
+        obj = s3c.get_object(Bucket=bucket, Key=INDEX_KEY)
+    except ClientError as err:
+        if err.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None, None
+        raise
+    return json.loads(obj['Body'].read().decode('utf-8')), obj['ETag']
+
+
+def update_index(s3c, bucket, update):
+    'Apply update (a function that modifies an index in place and returns a result) atomically, returning its result'
+    for _ in range(MAX_ATTEMPTS):
+        index, etag = load_index(s3c, bucket)
+        if index is None:
+            index, etag = rebuild_index(s3c, bucket), None
+        result = update(index)
+        if _put_index(s3c, bucket, index, etag):
+            return result
+    raise RuntimeError('Could not update s3://{}/{} after {} attempts'.format(bucket, INDEX_KEY, MAX_ATTEMPTS))
+
+
+def layer_versions(index):
+    'Dict of layer name to sorted list of complete (not pending) versions'
+    return {layer: sorted(int(version) for version, record in versions.items() if not record.get('pending'))
+            for layer, versions in index['layers'].items()}
+
+
+def latest_layers(index):
+    'Dict of layer name to latest complete version'
+    return {layer: versions[-1] for layer, versions in layer_versions(index).items() if versions}
+
+
+def reserve_version(s3c, bucket, layer_name):
+    'Atomically reserve the next version of a layer, returning (version, record of the previous latest version or None)'
+    def reserve(index):
+        versions = index['layers'].setdefault(layer_name, {})
+        latest = max([int(version) for version in versions] + [0])
+        versions[str(latest + 1)] = {'pending': True}
+        return latest + 1, versions.get(str(latest))
+    return update_index(s3c, bucket, reserve)
+
+
+def set_version(s3c, bucket, layer_name, version, record):
+    'Record a published version of a layer (record is None to drop a reserved version whose publish failed)'
+    def set_record(index):
+        versions = index['layers'].setdefault(layer_name, {})
+        if record is None:
+            versions.pop(str(version), None)
+        else:
+            versions[str(version)] = record
+    update_index(s3c, bucket, set_record)
+
+
+def set_deployment(s3c, bucket, deployment_name, data):
+    'Record the layer versions of a deployment'
+    def set_data(index):
+        index['deployments'][deployment_name] = data
+    update_index(s3c, bucket, set_data)
+
+
+def add_server(s3c, bucket, server_version):
+    'Record an uploaded server-<version>.tar.gz'
+    def add(index):
+        if server_version not in index['servers']:
+            index['servers'].append(server_version)
+            index['servers'].sort(key=lambda s: [int(n) for n in s.split('.')])
+    update_index(s3c, bucket, add)
+
+
+def _object_record(s3c, bucket, key, size):
+    return {'size': size, 'sha256': s3c.head_object(Bucket=bucket, Key=key).get('Metadata', {}).get('sha256')}
+
+
+def rebuild_index(s3c, bucket):
+    'Build an index from a full listing of the bucket (without writing it)'
+    index = empty_index()
+    objects = {}
+    for page in s3c.get_paginator('list_objects_v2').paginate(Bucket=bucket):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = obj['Size']
+    for key, size in objects.items():
+        match = re.match(r'^config/(.*)-v(\d+)\.json$', key)
+        if match:
+            layer, version = match.groups()
+            mbtiles_key = 'mbtiles/{}-v{}.mbtiles'.format(layer, version)
+            if mbtiles_key not in objects:
+                continue
+            index['layers'].setdefault(layer, {})[str(int(version))] = {
+                'config': _object_record(s3c, bucket, key, size),
+                'mbtiles': _object_record(s3c, bucket, mbtiles_key, objects[mbtiles_key])
+            }
+            continue
+        match = re.match(r'^deployments/([^/]*)\.json$', key) # Not the per node documents of sharded deployments
+        if match:
+            obj = s3c.get_object(Bucket=bucket, Key=key)
+            index['deployments'][match.group(1)] = json.loads(obj['Body'].read().decode('utf-8'))['data']
+            continue
+        match = re.match(r'^server-(\d+(?:\.\d+)*)\.tar\.gz$', key)
+        if match:
+            index['servers'].append(match.group(1))
+    index['servers'].sort(key=lambda s: [int(n) for n in s.split('.')])
+    return index
+
+
+if __name__ == '__main__':
+    from publish import s3_client, BUCKET
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['rebuild', 'show', 'add-server'])
+    parser.add_argument('server_version', nargs='?', help='Server version for add-server, eg. 1.0.0 for server-1.0.0.tar.gz')
+    parser.add_argument('--bucket', default=BUCKET)
+    parser.add_argument('--profile', default='terria', help='AWS profile (use an empty string for the default credentials)')
+    parser.add_argument('--endpoint-url', help='S3 endpoint, eg. http://localhost:9000 for MinIO')
+    args = parser.parse_args()
+    s3c = s3_client(args.profile, args.endpoint_url)
+
+    if args.command == 'rebuild':
+        def replace(index):
+            # Keep reserved versions of publishes that are still running
+            rebuilt = rebuild_index(s3c, args.bucket)
+            for layer, versions in index['layers'].items():
+                for version, record in versions.items():
+                    if record.get('pending'):
+                        rebuilt['layers'].setdefault(layer, {}).setdefault(version, record)
+            index.clear()
+            index.update(rebuilt)
+        update_index(s3c, args.bucket, replace)
+        print('Rebuilt s3://{}/{}'.format(args.bucket, INDEX_KEY))
+    elif args.command == 'show':
+        index, _ = load_index(s3c, args.bucket)
+        print(json.dumps(index, indent=2, sort_keys=True))
+    elif args.command == 'add-server':
+        if not args.server_version:
+            parser.error('add-server needs a server version')
+        add_server(s3c, args.bucket, args.server_version)
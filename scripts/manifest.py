@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Layer manifests for building layers without prompts. A manifest is a JSON (or YAML, if PyYAML is installed) file like:
+
+{
+    "generateTilesTo": 12,
+    "layers": [
+        {
+            "geometryFile": "geoserver_shapefiles/FID_SA4_2011_AUST.shp",
+            "inputLayer": "FID_SA4_2011_AUST",
+            "layerName": "FID_SA4_2011_AUST",
+            "generateTilesTo": 12,
+            "fidAttribute": null,
+            "server": "http://localhost:8000/FID_SA4_2011_AUST/{z}/{x}/{y}.pbf",
+            "description": "Statistical Area Level 4",
+            "regionMappingEntries": {
+                "SA4": {
+                    "regionProp": "SA4_CODE11",
+                    "nameProp": "SA4_NAME11",
+                    "aliases": ["sa4_code_2011", "sa4_code", "sa4"]
+                }
+            }
+        }
+    ]
+}
+
+Keys at the top level other than "layers" are defaults for every layer. Keys that are left out of a layer take the default
+answer of the matching create_layer prompt. A null (or missing) fidAttribute means an FID is added to the layer.
+regionMapping entries whose regionProp doesn't uniquely identify regions need disambigProp and disambigRegionId
+'''
+
+import json
+import os
+
+
+def load_manifest(filename):
+    'Load a manifest file and return the list of layer settings, with top level defaults applied'
+    with open(filename) as f:
+        if os.path.splitext(filename)[1].lower() in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise RuntimeError('PyYAML is needed to read YAML manifests (pip install pyyaml), or use a JSON manifest')
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+
+    defaults = {key: value for key, value in manifest.items() if key != 'layers'}
+    layers = []
+    for i, layer in enumerate(manifest.get('layers', [])):
+        settings = dict(defaults)
+        settings.update(layer)
+        if 'geometryFile' not in settings:
+            raise ValueError('Layer {} in manifest {} has no geometryFile'.format(i, filename))
+        layers.append(settings)
+    return layers
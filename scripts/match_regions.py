@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Match the rows of a CSV file to regions the way TerriaJS region mapping does, to check a CSV before it is loaded. The
+regionMapping entry is chosen from the CSV's column headers via each entry's aliases (the first entry, in file order, with an
+alias matching a header), and the column's values are matched against the entry's regionid file
+(region_map-<layer>_<column>.json, or its .compact.json encoding). Values from both sides are normalised alike: CSV values with
+the entry's dataReplacements and regionid values with its serverReplacements, then trimmed and lowercased, with codes of digits
+zero padded to the entry's digits (unless it has textCodes). Values shared by more than one region are resolved with the
+disambigProp column, found via the aliases of the disambigRegionId entry.
+
+Rows are read in batches, and each distinct value in a batch is normalised and looked up once, so repeated values (the usual
+case in large files) cost little. Reports the match rate and every unmatched value with its number of rows, and optionally
+writes the CSV with the matched FID of each row (-1 if unmatched) appended
+'''
+
+import argparse
+import csv
+import glob
+import json
+import os
+import re
+from collections import Counter, OrderedDict
+from itertools import islice
+
+import numpy as np
+
+import regionids
+
+BATCH_SIZE = 100000 # Rows matched at a time
+DIGITS = re.compile(r'^[0-9]+$')
+
+
+def load_region_mapping(filenames):
+    'regionMapping entries from regionMapping files, in order, with later files replacing entries of the same name'
+    entries = OrderedDict()
+    for filename in filenames:
+        with open(filename) as f:
+            entries.update(json.load(f, object_pairs_hook=OrderedDict)['regionWmsMap'])
+    return entries
+
+
+def find_column(headers, entry):
+    'The first header matching one of the aliases of a regionMapping entry, or None'
+    aliases = [alias.lower() for alias in entry.get('aliases') or []]
+    for header in headers:
+        if header.strip().lower() in aliases:
+            return header
+    return None
+
+
+def choose_entry(headers, entries):
+    'The name of the regionMapping entry to use for a CSV with headers, and the header of its region column, or (None, None)'
+    for name, entry in entries.items():
+        column = find_column(headers, entry)
+        if column is not None:
+            return name, column
+    return None, None
+
+
+class Normaliser:
+    'Normalises values for matching with an entry\'s replacements (a list of [pattern, replacement]), digits and textCodes'
+    def __init__(self, replacements=None, digits=None, text_codes=False):
+        self.replacements = [(re.compile(pattern, re.IGNORECASE), replacement) for pattern, replacement in replacements or []]
+        self.digits = None if text_codes else digits
+
+    def __call__(self, value):
+        if value is None:
+            return None
+        value = str(value).strip()
+        for pattern, replacement in self.replacements:
+            value = pattern.sub(replacement, value)
+        value = value.strip().lower()
+        if self.digits and DIGITS.match(value):
+            value = value.zfill(self.digits)
+        return value
+
+    @classmethod
+    def for_entry(cls, entry, replacements_key):
+        return cls(entry.get(replacements_key), entry.get('digits'), entry.get('textCodes', False))
+
+
+def load_regionids(regionids_dir, regionids_file):
+    'Values of a regionid file named in a regionMapping entry, from regionids_dir (either encoding)'
+    filename = os.path.join(regionids_dir, os.path.basename(regionids_file))
+    if os.path.exists(filename):
+        with open(filename) as f:
+            return json.load(f)['values']
+    with open(regionids.compact_filename(filename)) as f:
+        return regionids.decode_compact(json.load(f))['values']
+
+
+class RegionMatcher:
+    '''
+    Hashed indexes of the normalised regionid values of a regionMapping entry: value to FID and, for values shared by
+    more than one region, (value, disambiguation value) to FID
+    '''
+    def __init__(self, entry, regionids_dir, entries=None):
+        self.entry = entry
+        self.normalise = Normaliser.for_entry(entry, 'dataReplacements')
+        server_normalise = Normaliser.for_entry(entry, 'serverReplacements')
+        self.index = {}
+        self.ambiguous = set()
+        for fid, value in enumerate(load_regionids(regionids_dir, entry['regionIdsFile'])):
+            value = server_normalise(value)
+            if value is None:
+                continue
+            if value in self.index:
+                self.ambiguous.add(value)
+            else:
+                self.index[value] = fid
+
+        self.disambig_entry = (entries or {}).get(entry.get('disambigRegionId'))
+        self.disambig_index = {}
+        if self.ambiguous and entry.get('regionDisambigIdsFile'):
+            disambig_entry = self.disambig_entry or {}
+            self.normalise_disambig = Normaliser.for_entry(disambig_entry, 'dataReplacements')
+            server_normalise_disambig = Normaliser.for_entry(disambig_entry, 'serverReplacements')
+            disambig_values = load_regionids(regionids_dir, entry['regionDisambigIdsFile'])
+            for fid, value in enumerate(load_regionids(regionids_dir, entry['regionIdsFile'])):
+                value = server_normalise(value)
+                if value in self.ambiguous:
+                    self.disambig_index.setdefault((value, server_normalise_disambig(disambig_values[fid])), fid)
+
+    def match(self, values, disambig_values=None):
+        '''
+        FIDs of the regions matching a batch of values (with their disambiguation values, if the CSV has that column), as an
+        int64 array with -1 for unmatched values
+        '''
+        distinct_values, value_codes = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+        if disambig_values is not None and self.disambig_index:
+            # Distinct (value, disambiguation value) pairs, as codes combining the index of each in its distinct values
+            distinct_disambig, disambig_codes = np.unique(np.asarray(disambig_values, dtype=str), return_inverse=True)
+            distinct, inverse = np.unique(value_codes.ravel() * len(distinct_disambig) + disambig_codes.ravel(), return_inverse=True)
+            pairs = [(distinct_values[code // len(distinct_disambig)], distinct_disambig[code % len(distinct_disambig)]) for code in distinct.tolist()]
+        else:
+            pairs = [(value, None) for value in distinct_values.tolist()]
+            inverse = value_codes
+        fids = np.empty(len(pairs), dtype=np.int64)
+        for i, (value, disambig_value) in enumerate(pairs):
+            value = self.normalise(value)
+            if value in self.ambiguous:
+                # Ambiguous without a disambiguation value, as TerriaJS can't choose between the regions either
+                fids[i] = self.disambig_index.get((value, self.normalise_disambig(disambig_value)), -1) if disambig_value is not None else -1
+            else:
+                fids[i] = self.index.get(value, -1)
+        return fids[inverse.ravel()]
+
+
+def batches(reader, batch_size):
+    while True:
+        rows = list(islice(reader, batch_size))
+        if not rows:
+            return
+        yield rows
+
+
+def match_csv(csv_file, entries, regionids_dir='output_files', output=None, batch_size=BATCH_SIZE):
+    'Match the rows of a CSV file, optionally writing it with an FID column to output. Returns a report'
+    with open(csv_file, newline='') as f:
+        reader = csv.reader(f)
+        headers = next(reader)
+        name, column = choose_entry(headers, entries)
+        if name is None:
+            raise ValueError('No regionMapping entry has an alias matching a column of {} ({})'.format(csv_file, ', '.join(headers)))
+        entry = entries[name]
+        matcher = RegionMatcher(entry, regionids_dir, entries)
+        disambig_column = find_column(headers, matcher.disambig_entry) if matcher.disambig_entry is not None else None
+        column_index = headers.index(column)
+        disambig_index = headers.index(disambig_column) if disambig_column is not None else None
+
+        out = None
+        if output is not None:
+            out_file = open(output, 'w', newline='')
+            out = csv.writer(out_file)
+            out.writerow(headers + [entry.get('uniqueIdProp', 'FID')])
+        rows = 0
+        matched = 0
+        unmatched = Counter()
+        try:
+            for batch in batches(reader, batch_size):
+                values = [row[column_index] if column_index < len(row) else '' for row in batch]
+                disambig_values = [row[disambig_index] if disambig_index < len(row) else '' for row in batch] if disambig_index is not None else None
+                fids = matcher.match(values, disambig_values)
+                rows += len(batch)
+                matched += int(np.count_nonzero(fids >= 0))
+                if not np.all(fids >= 0):
+                    distinct, counts = np.unique(np.asarray(values, dtype=str)[fids < 0], return_counts=True)
+                    unmatched.update(dict(zip(distinct.tolist(), counts.tolist())))
+                if out is not None:
+                    out.writerows(row + [fid] for row, fid in zip(batch, fids.tolist()))
+        finally:
+            if out is not None:
+                out_file.close()
+
+    return OrderedDict([
+        ('file', csv_file),
+        ('regionMappingEntry', name),
+        ('column', column),
+        ('disambigColumn', disambig_column),
+        ('rows', rows),
+        ('matched', matched),
+        ('matchRate', matched / rows if rows else None),
+        ('unmatched', unmatched.most_common())
+    ])
+
+
+def format_report(report, show=20):
+    lines = ['{file}: column {column} matched as {regionMappingEntry}{disambig}'.format(
+        disambig=' (disambiguated by {})'.format(report['disambigColumn']) if report['disambigColumn'] else '', **report)]
+    lines.append('{} of {} rows matched ({})'.format(report['matched'], report['rows'],
+        '{:.2%}'.format(report['matchRate']) if report['matchRate'] is not None else '-'))
+    if report['unmatched']:
+        lines.append('{} unmatched values{}:'.format(len(report['unmatched']), ', most frequent first' if len(report['unmatched']) > show else ''))
+        lines.extend('  {!r}: {} rows'.format(value, count) for value, count in report['unmatched'][:show])
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('csv_files', nargs='+')
+    parser.add_argument('--region-mapping', nargs='+', help='regionMapping files to take entries from, in order (default: output_files/regionMapping-*.json)')
+    parser.add_argument('--regionids-dir', default='output_files', help='Directory of regionid files (default: output_files)')
+    parser.add_argument('--output', help='Write each CSV with an FID column appended to this file (or, with several CSVs, directory)')
+    parser.add_argument('--report', help='Write the reports, with every unmatched value, to this JSON file')
+    parser.add_argument('--show', type=int, default=20, help='Number of unmatched values to print (default: 20)')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    entries = load_region_mapping(args.region_mapping or sorted(glob.glob(os.path.join('output_files', 'regionMapping-*.json'))))
+    if args.output and len(args.csv_files) > 1:
+        os.makedirs(args.output, exist_ok=True)
+    reports = []
+    for csv_file in args.csv_files:
+        output = args.output and (os.path.join(args.output, os.path.basename(csv_file)) if len(args.csv_files) > 1 else args.output)
+        reports.append(match_csv(csv_file, entries, args.regionids_dir, output, args.batch_size))
+        print(format_report(reports[-1], args.show))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(reports, f, indent=2)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'Helpers for reading the mbtiles files made by tippecanoe'
+
+import math
+import sqlite3
+import zlib
+
+
+def open_mbtiles(filename):
+    'Open an mbtiles file read-only'
+    return sqlite3.connect('file:{}?mode=ro'.format(filename), uri=True)
+
+
+def decompress(data):
+    'Tile data as an uncompressed protobuf (tippecanoe gzips tiles, other tools may not)'
+    if data[:2] == b'\x1f\x8b':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    return data
+
+
+def metadata(db):
+    'The metadata table as a dict'
+    return dict(db.execute('SELECT name, value FROM metadata'))
+
+
+def flip_y(z, y):
+    'Convert between mbtiles (TMS) rows and XYZ rows'
+    return (1 << z) - 1 - y
+
+
+def tile_bounds(z, x, y):
+    'Bounds (w, s, e, n) in degrees of an XYZ tile'
+    n = 1 << z
+    lat = lambda y: math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y)
+
+
+def tile_for(lon, lat, z):
+    'XYZ tile containing a point'
+    lat = max(min(lat, 85.0511), -85.0511)
+    n = 1 << z
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.log(math.tan(math.radians(lat)) + 1 / math.cos(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_columns(db):
+    '''
+    Every (zoom_level, tile_column) with tiles. Work is split up by tile column rather than rowid
+    so it works whether tiles is a table or a view over deduplicated map/images tables
+    '''
+    return db.execute('SELECT DISTINCT zoom_level, tile_column FROM tiles ORDER BY zoom_level, tile_column').fetchall()
+
+
+def batches(columns, batch_size):
+    'Split a list of (zoom_level, tile_column) into lists of at most batch_size columns'
+    return [columns[i:i + batch_size] for i in range(0, len(columns), batch_size)]
+
+
+def column_tiles(db, columns):
+    'Yield (z, x, y, tile_data) for every tile in the given (zoom_level, tile_column)s, with XYZ y'
+    for z, x in columns:
+        for y, data in db.execute('SELECT tile_row, tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ?', (z, x)):
+            yield z, x, flip_y(z, y), data
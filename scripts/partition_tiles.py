@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Spatially partitioned tile generation, for running several tippecanoe processes on one large layer. Tiles below the partition
+zoom are generated from every feature by one process. From the partition zoom up, the world is split into rectangles of tiles
+at the partition zoom, with about the same number of features in each, and each rectangle is tiled by its own process from
+the features intersecting it (plus a margin wider than tippecanoe's tile buffer). A tile at or above the partition zoom
+belongs to the rectangle containing its ancestor at the partition zoom, and is taken only from that rectangle's output, so
+tiles on partition borders (which every neighbouring partition also makes, from only some of their features) are complete.
+The outputs are merged into a single mbtiles file
+'''
+
+import json
+import math
+import os
+import sqlite3
+import uuid
+from contextlib import closing
+
+import asyncio
+from asyncio.subprocess import DEVNULL
+from osgeo import ogr
+
+from mbtiles import open_mbtiles, metadata, flip_y, tile_columns, column_tiles, tile_for
+
+PARTITION_ZOOM = 6
+MARGIN = 10 / 256 # Tiles at the partition zoom to widen partitions by, twice tippecanoe's default buffer
+
+SCHEMA = '''
+CREATE TABLE metadata (name TEXT, value TEXT);
+CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+'''
+
+INDEXES = '''
+CREATE UNIQUE INDEX name ON metadata (name);
+CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);
+'''
+
+
+def feature_tiles(geojson_file, zoom):
+    'Tile (x, y) at zoom containing the centre of each feature envelope in a GeoJSON file'
+    data_source = ogr.GetDriverByName('GeoJSON').Open(geojson_file)
+    layer = data_source.GetLayer()
+    layer.SetIgnoredFields([layer.GetLayerDefn().GetFieldDefn(i).GetName() for i in range(layer.GetLayerDefn().GetFieldCount())])
+    tiles = []
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None or geometry.IsEmpty():
+            continue
+        w, e, s, n = geometry.GetEnvelope()
+        tiles.append(tile_for((w + e) / 2, (s + n) / 2, zoom))
+    return tiles
+
+
+def split(tiles, rect, parts):
+    '''
+    Recursively split rect (x0, y0, x1, y1 in tiles, exclusive of x1 and y1) into up to parts rectangles with about the same
+    number of the given tiles in each, cutting across whichever axis the tiles are most spread out along
+    '''
+    x0, y0, x1, y1 = rect
+    if parts < 2 or len(tiles) < 2:
+        return [rect]
+    spread = lambda axis: max(tile[axis] for tile in tiles) - min(tile[axis] for tile in tiles)
+    for axis in sorted([0, 1], key=spread, reverse=True):
+        low, high = (x0, x1) if axis == 0 else (y0, y1)
+        if high - low < 2:
+            continue
+        values = sorted(tile[axis] for tile in tiles)
+        cut = min(max(values[len(values) * (parts // 2) // parts], low + 1), high - 1)
+        before = [tile for tile in tiles if tile[axis] < cut]
+        after = [tile for tile in tiles if tile[axis] >= cut]
+        if axis == 0:
+            rects = (x0, y0, cut, y1), (cut, y0, x1, y1)
+        else:
+            rects = (x0, y0, x1, cut), (x0, cut, x1, y1)
+        return split(before, rects[0], parts // 2) + split(after, rects[1], parts - parts // 2)
+    return [rect]
+
+
+def plan(geojson_file, partitions, zoom):
+    'Rectangles of tiles at zoom covering the world, each with about the same number of features'
+    n = 1 << zoom
+    return split(feature_tiles(geojson_file, zoom), (0, 0, n, n), partitions)
+
+
+def rect_bounds(zoom, rect, margin=MARGIN):
+    'Bounds (w, s, e, n) in degrees of a rectangle of tiles, widened by margin tiles'
+    x0, y0, x1, y1 = rect
+    n = 1 << zoom
+    lon = lambda x: min(max(x, 0), n) / n * 360 - 180
+    lat = lambda y: math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * min(max(y, 0), n) / n))))
+    return lon(x0 - margin), lat(y1 + margin), lon(x1 + margin), lat(y0 - margin)
+
+
+def owns(rect, zoom, z, x, y):
+    'Whether a tile (at z >= zoom) belongs to a rectangle of tiles at zoom'
+    x0, y0, x1, y1 = rect
+    return x0 <= x >> (z - zoom) < x1 and y0 <= y >> (z - zoom) < y1
+
+
+def merge(output, low_zooms, partitions, zoom, max_zoom):
+    '''
+    Write output from the tiles below zoom in the low_zooms mbtiles (if any) and the tiles each partition owns in partitions,
+    a list of (mbtiles filename, rect). Metadata comes from low_zooms, which saw every feature, with the zoom range updated
+    '''
+    temp = '{}.{}.tmp'.format(output, uuid.uuid4().hex)
+    sources = [filename for filename, _ in partitions if filename is not None]
+    try:
+        with closing(sqlite3.connect(temp)) as db:
+            db.execute('PRAGMA journal_mode = OFF')
+            db.execute('PRAGMA synchronous = OFF')
+            db.executescript(SCHEMA)
+            with closing(open_mbtiles(low_zooms or sources[0])) as source:
+                meta = metadata(source)
+            meta['maxzoom'] = str(max_zoom)
+            if not low_zooms:
+                meta['minzoom'] = str(zoom)
+            if 'json' in meta:
+                layer_json = json.loads(meta['json'])
+                for vector_layer in layer_json.get('vector_layers', []):
+                    vector_layer['minzoom'] = int(meta['minzoom'])
+                    vector_layer['maxzoom'] = max_zoom
+                meta['json'] = json.dumps(layer_json)
+            db.executemany('INSERT INTO metadata VALUES (?, ?)', meta.items())
+
+            if low_zooms:
+                with closing(open_mbtiles(low_zooms)) as source:
+                    columns = [(z, x) for z, x in tile_columns(source) if z < zoom]
+                    db.executemany('INSERT INTO tiles VALUES (?, ?, ?, ?)', ((z, x, flip_y(z, y), data) for z, x, y, data in column_tiles(source, columns)))
+            for filename, rect in partitions:
+                if filename is None:
+                    continue
+                with closing(open_mbtiles(filename)) as source:
+                    columns = [(z, x) for z, x in tile_columns(source) if z >= zoom and rect[0] <= x >> (z - zoom) < rect[2]]
+                    db.executemany('INSERT INTO tiles VALUES (?, ?, ?, ?)', ((z, x, flip_y(z, y), data) for z, x, y, data in column_tiles(source, columns)
+                                                                             if owns(rect, zoom, z, x, y)))
+            db.executescript(INDEXES)
+            db.commit()
+        os.replace(temp, output) # Replace rather than rewrite, so hard links (eg. to the build cache) are left alone
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+async def _tile(scheduler, args, memory):
+    tippe, tippe_finished = await scheduler.exec(*args, stdout=DEVNULL, stderr=DEVNULL, memory=memory)
+    return await tippe_finished
+
+
+async def _tile_partition(scheduler, command, geojson_file, tile_settings, zoom, rect, has_features, memory):
+    '''
+    Extract the features intersecting a partition and tile them from zoom up. Returns (mbtiles filename, return code),
+    with no filename if the partition has no features
+    '''
+    extract = 'temp/{}.json'.format(uuid.uuid4().hex)
+    mbtiles = 'temp/{}.mbtiles'.format(uuid.uuid4().hex)
+    w, s, e, n = rect_bounds(zoom, rect)
+    try:
+        o2o, o2o_finished = await scheduler.exec(*[
+            'ogr2ogr',
+            '-spat', str(w), str(s), str(e), str(n),
+            '-f', 'GeoJSON',
+            extract, geojson_file
+        ])
+        returncode = await o2o_finished
+        if returncode != 0:
+            return None, returncode
+        if not has_features and ogr.GetDriverByName('GeoJSON').Open(extract).GetLayer().GetFeatureCount() == 0:
+            return None, 0 # tippecanoe fails without any features, and there are no tiles to make anyway
+        return mbtiles, await _tile(scheduler, command(tile_settings, [extract], mbtiles, (zoom, tile_settings['maxzoom'])), memory)
+    finally:
+        if os.path.exists(extract):
+            os.remove(extract)
+
+
+async def generate(scheduler, command, geojson_file, tile_settings, output, partitions, zoom=PARTITION_ZOOM, memory=0):
+    '''
+    Tile geojson_file into output with partitions tippecanoe processes (plus one for the zooms below the partition zoom), run
+    through scheduler. command(tile_settings, geojson_files, mbtiles_filename, (min zoom, max zoom)) gives the tippecanoe
+    command line. memory is the estimated memory use of tiling the whole file. Returns 0, or the first failing return code
+    '''
+    zoom = min(zoom, tile_settings['maxzoom'])
+    loop = asyncio.get_event_loop()
+    tiles = await loop.run_in_executor(None, feature_tiles, geojson_file, zoom)
+    n = 1 << zoom
+    rects = split(tiles, (0, 0, n, n), partitions)
+    print('Tiling {} in {} partitions from zoom {}'.format(geojson_file, len(rects), zoom))
+    low_zooms = 'temp/{}.mbtiles'.format(uuid.uuid4().hex) if zoom > 0 else None
+    # The low zoom process also makes tiles at the partition zoom (which are thrown away), so -pS only applies where it should
+    jobs = [_tile(scheduler, command(tile_settings, [geojson_file], low_zooms, (0, zoom)), memory)] if low_zooms else []
+    jobs += [_tile_partition(scheduler, command, geojson_file, tile_settings, zoom, rect, any(owns(rect, zoom, zoom, x, y) for x, y in tiles), memory // len(rects))
+             for rect in rects]
+    results = await asyncio.gather(*jobs, return_exceptions=True)
+    partition_results = results[1:] if low_zooms else results
+    try:
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        returncodes = ([results[0]] if low_zooms else []) + [returncode for _, returncode in partition_results]
+        failed = [returncode for returncode in returncodes if returncode != 0]
+        if failed:
+            return failed[0]
+        await loop.run_in_executor(None, merge, output, low_zooms, [(filename, rect) for (filename, _), rect in zip(partition_results, rects)], zoom, tile_settings['maxzoom'])
+        return 0
+    finally:
+        for filename in [low_zooms] + [result[0] for result in partition_results if isinstance(result, tuple)]:
+            if filename is not None and os.path.exists(filename):
+                os.remove(filename)
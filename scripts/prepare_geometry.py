@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Parallel geometry preparation: repair invalid geometries (like ST_MakeValid) and reproject to EPSG:4326, splitting a layer
+into ranges of features prepared by a pool of worker processes. Each worker writes its range to a temporary file, and the
+ranges are reassembled in order into one GeoJSON file with one feature per line (as ogr2ogr writes it, so tippecanoe -P can
+read it in parallel). Features keep their place in the layer, so FIDs numbered in layer order are preserved: features whose
+geometry can't be repaired or reprojected are written without geometry rather than left out.
+Counts of invalid, repaired and dropped geometries are returned
+'''
+
+import argparse
+import json
+import os
+import shutil
+import uuid
+from collections import OrderedDict, deque
+from multiprocessing import Pool
+
+from osgeo import ogr, osr
+
+CHUNK_SIZE = 5000 # Features per worker task
+COUNTERS = ['features', 'invalid', 'repaired', 'dropped']
+
+
+def wgs84_transform(srs):
+    'Transformation from srs to longitude/latitude, or None if the layer has no spatial reference'
+    if srs is None:
+        return None
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'): # GDAL 3 defaults to latitude, longitude order for EPSG:4326
+        srs = srs.Clone()
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return osr.CoordinateTransformation(srs, wgs84)
+
+
+def repair(geometry):
+    'A valid version of an invalid geometry, or None if it cannot be repaired'
+    if hasattr(geometry, 'MakeValid'): # GDAL 3 with GEOS 3.8+, as used by ST_MakeValid
+        repaired = geometry.MakeValid()
+    else:
+        repaired = geometry.Buffer(0) # Fixes self intersecting polygons, the usual problem
+    if repaired is None or repaired.IsEmpty() or not repaired.IsValid():
+        return None
+    return repaired
+
+
+def write_chunk(features, start, transform, fid_attribute, temp_dir):
+    '''
+    Repair and reproject (geometry, properties) of features numbered from start, writing them to a temporary file as GeoJSON
+    features separated by ',\\n'. Returns the filename and counters
+    '''
+    counters = OrderedDict((name, 0) for name in COUNTERS)
+    filename = os.path.join(temp_dir, '{}.json'.format(uuid.uuid4().hex))
+    with open(filename, 'w') as f:
+        for i, (original, properties) in enumerate(features, start):
+            counters['features'] += 1
+            geometry = original
+            if geometry is not None and not geometry.IsValid():
+                counters['invalid'] += 1
+                geometry = repair(geometry)
+                if geometry is not None:
+                    counters['repaired'] += 1
+            if geometry is not None:
+                geometry = geometry.Clone()
+                if transform is not None and geometry.Transform(transform) != 0:
+                    geometry = None
+            if geometry is None and original is not None:
+                counters['dropped'] += 1
+            if fid_attribute is not None:
+                properties = OrderedDict([(fid_attribute, i)] + list(properties.items()))
+            record = OrderedDict([
+                ('type', 'Feature'),
+                ('properties', properties),
+                ('geometry', json.loads(geometry.ExportToJson()) if geometry is not None else None)
+            ])
+            f.write((',\n' if i > start else '') + json.dumps(record))
+    return filename, counters
+
+
+def layer_features(layer, count):
+    'Geometry and properties of the next count features of a layer'
+    for _ in range(count):
+        feature = layer.GetNextFeature()
+        if feature is None:
+            break
+        yield feature.GetGeometryRef(), feature.items() # feature is kept alive (owning the geometry) until the next one
+
+
+def prepare_chunk(args):
+    '''
+    Repair and reproject features start to start + count of a layer, seeking to start. Runs in a worker process.
+    Returns the filename and counters
+    '''
+    geometry_file, input_layer_name, start, count, fid_attribute, temp_dir = args
+    data_source = ogr.Open(geometry_file)
+    layer = data_source.GetLayerByName(input_layer_name)
+    layer.SetNextByIndex(start)
+    return write_chunk(layer_features(layer, count), start, wgs84_transform(layer.GetSpatialRef()), fid_attribute, temp_dir)
+
+
+def prepare_read_chunk(args):
+    '''
+    Repair and reproject features read by read_chunks, numbered from start. Runs in a worker process.
+    Returns the filename and counters
+    '''
+    srs_wkt, start, features, fid_attribute, temp_dir = args
+    transform = wgs84_transform(osr.SpatialReference(srs_wkt) if srs_wkt is not None else None)
+    features = ((ogr.CreateGeometryFromWkb(wkb) if wkb is not None else None, properties) for wkb, properties in features)
+    return write_chunk(features, start, transform, fid_attribute, temp_dir)
+
+
+def read_chunks(layer, chunk_size, fid_attribute, temp_dir):
+    '''
+    Tasks for prepare_read_chunk, reading a layer in one pass: for drivers that can't seek to a feature quickly, where
+    SetNextByIndex reads every feature before it and each worker would read the layer up to its range
+    '''
+    srs = layer.GetSpatialRef()
+    srs_wkt = srs.ExportToWkt() if srs is not None else None
+    layer.ResetReading()
+    start = 0
+    features = []
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        features.append((bytes(geometry.ExportToWkb()) if geometry is not None else None, feature.items()))
+        if len(features) == chunk_size:
+            yield srs_wkt, start, features, fid_attribute, temp_dir
+            start += len(features)
+            features = []
+    if features:
+        yield srs_wkt, start, features, fid_attribute, temp_dir
+
+
+def ordered_results(pool, func, tasks, ahead):
+    'Results of func over tasks in order, like pool.imap, but taking at most ahead tasks before their results, to bound memory'
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def prepare(geometry_file, input_layer_name, output, add_fid=False, fid_attribute='FID', processes=None, chunk_size=CHUNK_SIZE, temp_dir='temp'):
+    '''
+    Repair and reproject a layer into a GeoJSON file in parallel. With add_fid, each feature is given its index in the layer
+    as an fid_attribute property. Workers seek to their range of features where the driver supports it, otherwise the
+    layer is read once here and its features sent to the workers. Returns the counters for the whole layer
+    '''
+    data_source = ogr.Open(geometry_file)
+    layer = data_source.GetLayerByName(input_layer_name)
+    fid_attribute = fid_attribute if add_fid else None
+    counters = OrderedDict((name, 0) for name in COUNTERS)
+    chunk_files = []
+    try:
+        with Pool(processes) as pool, open(output, 'w') as out:
+            if layer.TestCapability(ogr.OLCFastSetNextByIndex):
+                num_features = layer.GetFeatureCount()
+                tasks = [(geometry_file, input_layer_name, start, min(chunk_size, num_features - start), fid_attribute, temp_dir)
+                         for start in range(0, num_features, chunk_size)]
+                results = pool.imap(prepare_chunk, tasks) # imap keeps the ranges in order
+            else:
+                results = ordered_results(pool, prepare_read_chunk, read_chunks(layer, chunk_size, fid_attribute, temp_dir),
+                                          2 * (processes or os.cpu_count() or 1))
+            out.write('{"type": "FeatureCollection", "features": [\n')
+            first = True
+            for filename, chunk_counters in results:
+                chunk_files.append(filename)
+                for name, value in chunk_counters.items():
+                    counters[name] += value
+                if os.path.getsize(filename):
+                    if not first:
+                        out.write(',\n')
+                    first = False
+                    with open(filename) as f:
+                        shutil.copyfileobj(f, out)
+                os.remove(filename)
+            out.write('\n]}\n')
+    finally:
+        layer = data_source = None
+        for filename in chunk_files:
+            if os.path.exists(filename):
+                os.remove(filename)
+    return counters
+
+
+def format_counters(counters):
+    return '{features} features: {invalid} invalid geometries, {repaired} repaired, {dropped} dropped'.format(**counters)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('geometry_file')
+    parser.add_argument('output', help='GeoJSON file to write')
+    parser.add_argument('--layer', help='Layer of the geometry file to prepare (default: the first layer)')
+    parser.add_argument('--add-fid', action='store_true', help='Add an FID attribute numbering features in layer order')
+    parser.add_argument('--processes', type=int, help='Number of worker processes (default: number of cores)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Features per worker task (default: {})'.format(CHUNK_SIZE))
+    args = parser.parse_args()
+    layer_name = args.layer or ogr.Open(args.geometry_file).GetLayerByIndex(0).GetName()
+    os.makedirs('temp', exist_ok=True)
+    print(format_counters(prepare(args.geometry_file, layer_name, args.output, args.add_fid, processes=args.processes, chunk_size=args.chunk_size)))
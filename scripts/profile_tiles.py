@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Profile the tiles of data/<layer>.mbtiles: per zoom histograms of compressed and uncompressed tile size, feature and vertex
+counts, the heaviest tiles and totals. Prints a table and writes JSON, and flags layers with tiles over a size budget
+'''
+
+import argparse
+import heapq
+import json
+import os
+import zlib
+from array import array
+from collections import OrderedDict
+from contextlib import closing
+from multiprocessing import Pool
+
+from mbtiles import open_mbtiles, decompress, tile_columns, batches, column_tiles
+from stats import percentile
+from vector_tile import decode
+
+BATCH_SIZE = 16 # Tile columns per worker task
+TOP_N = 10
+DEFAULT_BUDGET = 500 * 1024 # Bytes of compressed tile
+
+
+def bucket(value):
+    'Histogram bucket of a value: the power of 2 at or above it'
+    return 1 << max(value - 1, 0).bit_length() if value else 0
+
+
+class ZoomStats:
+    'Statistics of the tiles at one zoom level'
+    def __init__(self):
+        self.sizes = array('L') # Compressed sizes, kept for percentiles
+        self.raw_size = 0
+        self.features = 0
+        self.vertices = 0
+        self.max_features = 0
+        self.max_vertices = 0
+        self.histograms = {'compressed': {}, 'raw': {}, 'features': {}, 'vertices': {}}
+
+    def add(self, size, raw_size, features, vertices):
+        self.sizes.append(size)
+        self.raw_size += raw_size
+        self.features += features
+        self.vertices += vertices
+        self.max_features = max(self.max_features, features)
+        self.max_vertices = max(self.max_vertices, vertices)
+        for name, value in [('compressed', size), ('raw', raw_size), ('features', features), ('vertices', vertices)]:
+            histogram = self.histograms[name]
+            histogram[bucket(value)] = histogram.get(bucket(value), 0) + 1
+
+    def merge(self, other):
+        self.sizes.extend(other.sizes)
+        self.raw_size += other.raw_size
+        self.features += other.features
+        self.vertices += other.vertices
+        self.max_features = max(self.max_features, other.max_features)
+        self.max_vertices = max(self.max_vertices, other.max_vertices)
+        for name, histogram in other.histograms.items():
+            for key, count in histogram.items():
+                self.histograms[name][key] = self.histograms[name].get(key, 0) + count
+
+    def summary(self):
+        sizes = sorted(self.sizes)
+        return OrderedDict([
+            ('tiles', len(sizes)),
+            ('compressed_bytes', sum(sizes)),
+            ('raw_bytes', self.raw_size),
+            ('p50_bytes', percentile(sizes, 50) or 0),
+            ('p99_bytes', percentile(sizes, 99) or 0),
+            ('max_bytes', sizes[-1] if sizes else 0),
+            ('features', self.features),
+            ('max_features', self.max_features),
+            ('vertices', self.vertices),
+            ('max_vertices', self.max_vertices),
+            ('histograms', OrderedDict((name, OrderedDict((str(k), v) for k, v in sorted(h.items()))) for name, h in self.histograms.items()))
+        ])
+
+
+def profile_batch(args):
+    'Profile the tiles in a batch of tile columns. Runs in a worker process'
+    mbtiles, columns, top_n = args
+    zooms = {}
+    heaviest = []
+    errors = []
+    with closing(open_mbtiles(mbtiles)) as db:
+        for z, x, y, data in column_tiles(db, columns):
+            try:
+                raw = decompress(data)
+                layers = decode(raw, properties=False)
+            except (ValueError, zlib.error) as err:
+                errors.append(((z, x, y), str(err)))
+                continue
+            features = sum(len(layer.features) for layer in layers)
+            vertices = sum(feature.vertices for layer in layers for feature in layer.features)
+            zooms.setdefault(z, ZoomStats()).add(len(data), len(raw), features, vertices)
+            entry = (len(data), (z, x, y), len(raw), features, vertices)
+            if len(heaviest) < top_n:
+                heapq.heappush(heaviest, entry)
+            else:
+                heapq.heappushpop(heaviest, entry)
+    return zooms, heaviest, errors
+
+
+def profile(mbtiles, processes=None, top_n=TOP_N, budget=DEFAULT_BUDGET):
+    'Profile an mbtiles file, returning a JSON serialisable report'
+    with closing(open_mbtiles(mbtiles)) as db:
+        tasks = [(mbtiles, columns, top_n) for columns in batches(tile_columns(db), BATCH_SIZE)]
+    zooms = {}
+    heaviest = []
+    errors = []
+    with Pool(processes) as pool:
+        for batch_zooms, batch_heaviest, batch_errors in pool.imap_unordered(profile_batch, tasks):
+            for z, stats in batch_zooms.items():
+                zooms.setdefault(z, ZoomStats()).merge(stats)
+            heaviest = heapq.nlargest(top_n, heaviest + batch_heaviest)
+            errors.extend(batch_errors)
+
+    total = ZoomStats()
+    for stats in zooms.values():
+        total.merge(stats)
+    over_budget = sum(1 for stats in zooms.values() for size in stats.sizes if size > budget)
+    return OrderedDict([
+        ('mbtiles', mbtiles),
+        ('budget_bytes', budget),
+        ('tiles_over_budget', over_budget),
+        ('over_budget', over_budget > 0),
+        ('total', total.summary()),
+        ('zooms', OrderedDict((str(z), zooms[z].summary()) for z in sorted(zooms))),
+        ('heaviest', [OrderedDict([('z', z), ('x', x), ('y', y), ('compressed_bytes', size), ('raw_bytes', raw), ('features', features), ('vertices', vertices)])
+                      for size, (z, x, y), raw, features, vertices in sorted(heaviest, reverse=True)]),
+        ('decode_errors', [OrderedDict([('z', z), ('x', x), ('y', y), ('error', error)]) for (z, x, y), error in errors])
+    ])
+
+
+def format_report(report):
+    'Text table of a profile report'
+    columns = ['tiles', 'compressed_bytes', 'raw_bytes', 'p50_bytes', 'p99_bytes', 'max_bytes', 'features', 'max_features', 'vertices', 'max_vertices']
+    lines = ['{:>5}  '.format('Zoom') + '  '.join('{:>16}'.format(c) for c in columns)]
+    for z, stats in list(report['zooms'].items()) + [('all', report['total'])]:
+        lines.append('{:>5}  '.format(z) + '  '.join('{:>16}'.format(stats[c]) for c in columns))
+    lines.append('Heaviest tiles (z/x/y: compressed bytes, features, vertices):')
+    lines.extend('  {z}/{x}/{y}: {compressed_bytes}, {features}, {vertices}'.format(**tile) for tile in report['heaviest'])
+    if report['decode_errors']:
+        lines.append('{} tiles could not be decoded'.format(len(report['decode_errors'])))
+    if report['over_budget']:
+        lines.append('WARNING: {} tiles are over the {} byte budget'.format(report['tiles_over_budget'], report['budget_bytes']))
+    return '\n'.join(lines)
+
+
+def profile_layer(layer_name, processes=None, budget=DEFAULT_BUDGET, output_dir='output_files'):
+    'Profile data/<layer>.mbtiles, writing the report to output_files/profile-<layer>.json. Returns the report'
+    report = profile(os.path.join('data', '{}.mbtiles'.format(layer_name)), processes, budget=budget)
+    with open(os.path.join(output_dir, 'profile-{}.json'.format(layer_name)), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('layers', nargs='+', help='Names of layers to profile from data/<layer>.mbtiles')
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET / 1024, help='Tile size budget in KB of compressed tile (default: 500)')
+    parser.add_argument('--processes', type=int, help='Number of worker processes (default: number of cores)')
+    args = parser.parse_args()
+    over_budget = []
+    for layer_name in args.layers:
+        report = profile_layer(layer_name, args.processes, int(args.budget * 1024))
+        print(layer_name)
+        print(format_report(report))
+        if report['over_budget']:
+            over_budget.append(layer_name)
+    if over_budget:
+        print('Layers over budget: {}'.format(', '.join(over_budget)))
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Publish built layers (config/<layer>.json and data/<layer>.mbtiles) to S3 as a new version of each layer.
+Layers are uploaded concurrently with multipart uploads, and a layer is skipped if its config and tiles (by content digest,
+see tile_diff.py) are the same as the latest version's. A multipart upload that is interrupted is recorded in temp/uploads/,
+and publishing the same file to the same key again (as retrying a failed publish does) uploads only its missing parts.
+Versions are allocated and recorded in the bucket's index (see layer_index.py) rather than by listing the bucket.
+Each new version is diffed against the previous one (see tile_diff.py): the diff report is uploaded to diffs/ and, if it is
+less than half the size of the new mbtiles, a delta package turning the previous version into the new one to deltas/, so
+servers with the previous version can download just the delta and caches can invalidate just the changed tiles. The tile
+hashes of each version are uploaded to hashes/ (see write_hashes in tile_diff.py), and the next version is diffed against
+them rather than downloading the previous mbtiles (which is only done for versions published without hashes).
+Use --endpoint-url to publish to a local S3 stand-in (eg. MinIO or moto server) instead of AWS
+'''
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import math
+import os
+import uuid
+from contextlib import closing
+
+import boto3
+from botocore.exceptions import ClientError
+
+from build_cache import file_digest
+from layer_index import load_index, latest_layers, reserve_version, set_version
+from mbtiles import open_mbtiles
+from tile_diff import diff, write_hashes, content_digest
+
+BUCKET = 'vector-tile-server'
+MIN_CHUNK_SIZE = 8 * 1024**2 # S3 minimum part size is 5MB
+MAX_PARTS = 10000 # S3 maximum number of parts in a multipart upload
+DELTA_LIMIT = 0.5 # Largest size of a delta package worth uploading, as a fraction of the size of the new mbtiles
+UPLOADS_DIR = os.path.join('temp', 'uploads') # Records of unfinished multipart uploads
+
+
+def chunk_size(size):
+    'Part size for a file of size bytes: at least 8MB, large enough to stay within the S3 part limit'
+    return max(MIN_CHUNK_SIZE, int(math.ceil(size / (MAX_PARTS - 1) / 1024**2)) * 1024**2)
+
+
+def layer_keys(layer_name, version):
+    'S3 keys of the config and mbtiles of a version of a layer'
+    return 'config/{}-v{}.json'.format(layer_name, version), 'mbtiles/{}-v{}.mbtiles'.format(layer_name, version)
+
+
+def delta_keys(layer_name, from_version, version):
+    'S3 keys of the delta package and diff report between two versions of a layer'
+    name = '{}-v{}-v{}'.format(layer_name, from_version, version)
+    return 'deltas/{}.delta'.format(name), 'diffs/{}.json'.format(name)
+
+
+def hashes_key(layer_name, version):
+    'S3 key of the tile hashes of a version of a layer'
+    return 'hashes/{}-v{}.hashes'.format(layer_name, version)
+
+
+def upload(s3c, bucket, filename, key, digest, max_concurrency):
+    '''
+    Upload a file with its SHA-256 digest recorded in the object metadata. Files larger than a part are uploaded in
+    max_concurrency parts at once, resuming an interrupted upload of the same file to the same key
+    '''
+    size = os.path.getsize(filename)
+    part_size = chunk_size(size)
+    if size <= part_size:
+        with open(filename, 'rb') as f:
+            s3c.put_object(Bucket=bucket, Key=key, Body=f, Metadata={'sha256': digest})
+        return
+
+    record_filename = os.path.join(UPLOADS_DIR, '{}.json'.format(hashlib.sha256('{}/{}/{}'.format(bucket, key, digest).encode('utf-8')).hexdigest()))
+    num_parts = int(math.ceil(size / part_size))
+    upload_id = None
+    parts = {} # Part number: ETag
+    if os.path.exists(record_filename):
+        with open(record_filename) as f:
+            upload_id = json.load(f)['upload_id']
+        try:
+            for page in s3c.get_paginator('list_parts').paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+                for part in page.get('Parts', []):
+                    if part['Size'] == min(part_size, size - (part['PartNumber'] - 1) * part_size):
+                        parts[part['PartNumber']] = part['ETag']
+        except ClientError as err:
+            if err.response['Error']['Code'] not in ('NoSuchUpload', '404'):
+                raise
+            upload_id = None # Aborted or expired
+    if upload_id is None:
+        upload_id = s3c.create_multipart_upload(Bucket=bucket, Key=key, Metadata={'sha256': digest})['UploadId']
+        os.makedirs(UPLOADS_DIR, exist_ok=True)
+        with open(record_filename, 'w') as f:
+            json.dump({'bucket': bucket, 'key': key, 'filename': filename, 'upload_id': upload_id}, f)
+    elif parts:
+        print('Resuming upload of {} to {} ({} of {} parts uploaded)'.format(filename, key, len(parts), num_parts))
+
+    def upload_part(number):
+        with open(filename, 'rb') as f:
+            f.seek((number - 1) * part_size)
+            return number, s3c.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=f.read(part_size))['ETag']
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        parts.update(executor.map(upload_part, [number for number in range(1, num_parts + 1) if number not in parts]))
+    s3c.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                  MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': parts[number]} for number in sorted(parts)]})
+    os.remove(record_filename)
+
+
+def publish_delta(s3c, bucket, layer_name, from_version, version, mbtiles_filename, max_concurrency=10, from_hashes=False):
+    '''
+    Diff a layer's mbtiles against an earlier version in S3 (its tile hashes if from_hashes, otherwise its mbtiles),
+    uploading the diff report and, if it is small enough, a delta package. Returns the record of the delta for the index
+    '''
+    from_key = hashes_key(layer_name, from_version) if from_hashes else layer_keys(layer_name, from_version)[1]
+    delta_key, diff_key = delta_keys(layer_name, from_version, version)
+    os.makedirs('temp', exist_ok=True)
+    previous = os.path.join('temp', '{}.mbtiles'.format(uuid.uuid4().hex))
+    delta = os.path.join('temp', '{}.delta'.format(uuid.uuid4().hex))
+    try:
+        s3c.download_file(bucket, from_key, previous)
+        report = diff(previous, mbtiles_filename, delta)
+        report['old'], report['new'] = layer_keys(layer_name, from_version)[1], layer_keys(layer_name, version)[1]
+        s3c.put_object(Bucket=bucket, Key=diff_key, Body=json.dumps(report).encode('utf-8'), ContentType='application/json')
+        record = {'from': from_version, 'diff': diff_key, 'total': report['total']}
+        if report['delta']['size'] <= DELTA_LIMIT * report['delta']['new_size']:
+            digest = file_digest(delta)
+            upload(s3c, bucket, delta, delta_key, digest, max_concurrency)
+            record.update({'key': delta_key, 'size': report['delta']['size'], 'sha256': digest})
+        print('{}-v{} changes {changed} tiles, adds {added} and removes {removed} from v{}{}'.format(layer_name, version, from_version,
+              ' (uploaded a {:.1f}MB delta)'.format(record['size'] / 1024**2) if 'key' in record else '', **report['total']))
+        return record
+    finally:
+        for filename in [previous, delta]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+def unchanged(latest, record):
+    '''
+    Whether the latest version of a layer has the same config and tiles as a new record. Tiles are compared by content
+    digest, so rebuilding a layer into a differently laid out mbtiles isn't a change (versions published without a content
+    digest are compared by file digest)
+    '''
+    mbtiles = latest.get('mbtiles') or {}
+    if 'content' in mbtiles:
+        same_tiles = mbtiles['content'] == record['mbtiles']['content']
+    else:
+        same_tiles = mbtiles.get('sha256') == record['mbtiles']['sha256']
+    return same_tiles and latest.get('config') == record['config']
+
+
+def publish_layer(s3c, bucket, layer_name, max_concurrency=10, deltas=True):
+    '''
+    Upload a layer as a new version unless it has the same config and tiles as the latest version.
+    Returns (version, uploaded) where version is the new version, or the latest version if the upload was skipped
+    '''
+    config_filename = os.path.join('config', '{}.json'.format(layer_name))
+    mbtiles_filename = os.path.join('data', '{}.mbtiles'.format(layer_name))
+    os.makedirs('temp', exist_ok=True)
+    hashes = os.path.join('temp', '{}.hashes'.format(uuid.uuid4().hex))
+    try:
+        write_hashes(mbtiles_filename, hashes)
+        with closing(open_mbtiles(hashes)) as db:
+            content = content_digest(db) # The same as the mbtiles' content digest, without reading its tiles again
+        record = {
+            'config': {'size': os.path.getsize(config_filename), 'sha256': file_digest(config_filename)},
+            'mbtiles': {'size': os.path.getsize(mbtiles_filename), 'sha256': file_digest(mbtiles_filename), 'content': content},
+            'hashes': {'size': os.path.getsize(hashes), 'sha256': file_digest(hashes)}
+        }
+
+        index, _ = load_index(s3c, bucket)
+        latest = latest_layers(index).get(layer_name) if index is not None else None
+        if latest is not None and unchanged(index['layers'][layer_name][str(latest)], record):
+            print('{} has the same config and tiles as {}-v{}, skipping upload'.format(layer_name, layer_name, latest))
+            return latest, False
+
+        version, previous = reserve_version(s3c, bucket, layer_name)
+        config_key, mbtiles_key = layer_keys(layer_name, version)
+        print('Uploading {}-v{} to S3'.format(layer_name, version))
+        try:
+            if deltas and previous is not None and not previous.get('pending'):
+                try:
+                    record['delta'] = publish_delta(s3c, bucket, layer_name, version - 1, version, mbtiles_filename, max_concurrency, 'hashes' in previous)
+                except Exception as err: # The full mbtiles is still uploaded, so a failed diff doesn't stop publishing
+                    print('Diffing {}-v{} against v{} failed: {}'.format(layer_name, version, version - 1, err))
+            upload(s3c, bucket, hashes, hashes_key(layer_name, version), record['hashes']['sha256'], max_concurrency)
+            # Upload mbtiles first: a version only exists once its config is present
+            upload(s3c, bucket, mbtiles_filename, mbtiles_key, record['mbtiles']['sha256'], max_concurrency)
+            upload(s3c, bucket, config_filename, config_key, record['config']['sha256'], max_concurrency)
+        except:
+            set_version(s3c, bucket, layer_name, version, None)
+            raise
+        set_version(s3c, bucket, layer_name, version, record)
+        return version, True
+    finally:
+        if os.path.exists(hashes):
+            os.remove(hashes)
+
+
+def publish_layers(s3c, bucket, layer_names, max_workers=4, max_concurrency=10, deltas=True):
+    'Publish layers concurrently. Returns a dict of layer name to (version, uploaded), with failed layers left out'
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(publish_layer, s3c, bucket, layer_name, max_concurrency, deltas): layer_name for layer_name in layer_names}
+        for future in concurrent.futures.as_completed(futures):
+            layer_name = futures[future]
+            try:
+                results[layer_name] = future.result()
+            except Exception as err:
+                print('Publishing {} failed: {}'.format(layer_name, err))
+    return results
+
+
+def s3_client(profile_name='terria', endpoint_url=None):
+    'S3 client for the terria profile, or for a local S3 stand-in at endpoint_url'
+    session = boto3.session.Session(profile_name=profile_name) if profile_name else boto3.session.Session()
+    return session.client('s3', endpoint_url=endpoint_url)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('layers', nargs='+', help='Names of layers to publish')
+    parser.add_argument('--bucket', default=BUCKET)
+    parser.add_argument('--profile', default='terria', help='AWS profile (use an empty string for the default credentials)')
+    parser.add_argument('--endpoint-url', help='S3 endpoint, eg. http://localhost:9000 for MinIO')
+    parser.add_argument('--workers', type=int, default=4, help='Number of layers to upload at once')
+    parser.add_argument('--concurrency', type=int, default=10, help='Number of parts of each file to upload at once')
+    parser.add_argument('--no-delta', action='store_true', help="Don't diff new versions against the previous version or upload delta packages")
+    args = parser.parse_args()
+
+    s3c = s3_client(args.profile, args.endpoint_url)
+    results = publish_layers(s3c, args.bucket, args.layers, args.workers, args.concurrency, not args.no_delta)
+    print('\n'.join('{:40}  {:7}  {:8}'.format(*t) for t in [('Layer name', 'Version', 'Uploaded')] + [(layer, version, 'yes' if uploaded else 'no') for layer, (version, uploaded) in sorted(results.items())]))
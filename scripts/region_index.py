@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Point in region lookup for region mapping layers: which region (FID, and regionProp value) contains each of a batch of
+longitude/latitude points. An index of a layer is built from its geometry file (reprojected to EPSG:4326, with invalid
+geometries repaired) and saved to output_files/regionindex-<layer>.npz, with the values of the layer's regionid columns by FID
+and a packed R-tree of the region bounds (regions grouped along a Hilbert curve). Loading an index prepares the geometries,
+and lookups take NumPy arrays of coordinates in batches, querying the tree a level at a time for each point's candidate
+regions, so only regions with points in their bounds are tested, with shapely.vectorized. Needs Shapely 1.8.
+
+    ./region_index.py build <geometry file> <layer name> --columns SA2_MAIN16 [--layer <input layer>] [--fid-attribute FID]
+    ./region_index.py lookup <layer name> <lon> <lat> [--property SA2_MAIN16]
+    ./region_index.py serve <layer name> [<layer name> ...] [--port 8001]
+    ./region_index.py benchmark [<layer name>] [--points 1000000]
+
+The server answers POST /<layer>[?property=<column>] with a body of an (n, 2) array of longitude, latitude as a .npy file
+(Content-Type: application/octet-stream) or as {"lon": [...], "lat": [...]} JSON. It responds with {"fids": [...]} and, with a
+property, {"values": [...]}, with an FID of -1 (and a null value) for points outside every region
+'''
+
+import argparse
+import io
+import json
+import os
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+from osgeo import ogr
+from shapely import vectorized, wkb as shapely_wkb
+from shapely.prepared import prep
+from shapely.validation import make_valid
+
+from prepare_geometry import wgs84_transform
+from tile_archive import hilbert
+
+BATCH_SIZE = 1000000 # Points per lookup batch, each region testing all its candidate points in a batch at once
+QUERY_SIZE = 65536 # Points per tree query, bounding the memory used for (point, node) pairs
+NODE_SIZE = 8 # Children of each node of the region tree, with smaller nodes leaving fewer pairs to test a level down
+HILBERT_ZOOM = 16 # Resolution of the Hilbert curve regions are ordered along, as a zoom of a grid over the layer's bounds
+
+
+def index_filename(layer_name, output_dir='output_files'):
+    return os.path.join(output_dir, 'regionindex-{}.npz'.format(layer_name))
+
+
+def build(geometry_file, input_layer_name, output, columns, fid_attribute=None):
+    '''
+    Build the index of a layer and save it to output. FIDs are read from fid_attribute, or with None number features in
+    layer order (as create_layer.py does when it adds FIDs). Returns the number of regions indexed
+    '''
+    data_source = ogr.Open(geometry_file)
+    layer = data_source.GetLayerByName(input_layer_name)
+    transform = wgs84_transform(layer.GetSpatialRef())
+    wkbs = []
+    fids = []
+    values = OrderedDict((column, {}) for column in columns)
+    for i, feature in enumerate(layer):
+        fid = int(feature.GetField(fid_attribute)) if fid_attribute is not None else i
+        for column in columns:
+            values[column][fid] = feature.GetField(column)
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        geometry = geometry.Clone()
+        if transform is not None and geometry.Transform(transform) != 0:
+            continue
+        wkbs.append(bytes(geometry.ExportToWkb()))
+        fids.append(fid)
+    data_source = None
+
+    num_fids = max(max(column_values, default=-1) for column_values in values.values()) + 1 if columns else max(fids, default=-1) + 1
+    by_fid = OrderedDict((column, [column_values.get(fid) for fid in range(num_fids)]) for column, column_values in values.items())
+    return write_index(output, wkbs, fids, by_fid)
+
+
+def write_index(output, wkbs, fids, values):
+    '''
+    Save an index of regions with EPSG:4326 geometries wkbs (repaired if invalid) and FIDs fids, with values the
+    {column: [value by FID]} of its regionid columns. Returns the number of regions indexed
+    '''
+    geometries = [shapely_wkb.loads(wkb) for wkb in wkbs]
+    wkbs = list(wkbs)
+    for i, geometry in enumerate(geometries):
+        if not geometry.is_valid:
+            geometries[i] = make_valid(geometry)
+            wkbs[i] = geometries[i].wkb
+    tree_items, tree_bounds, tree_levels = pack_tree(geometry_bounds(geometries))
+    np.savez_compressed(output,
+        wkb=np.frombuffer(b''.join(wkbs), dtype=np.uint8),
+        offsets=np.cumsum([0] + [len(wkb) for wkb in wkbs], dtype=np.int64),
+        fids=np.array(fids, dtype=np.int64),
+        values=np.array(json.dumps(values)), # Stored as a string, so loading doesn't need pickle
+        tree_items=tree_items,
+        tree_bounds=tree_bounds,
+        tree_levels=tree_levels)
+    return len(fids)
+
+
+def geometry_bounds(geometries):
+    'Bounds (west, south, east, north) of geometries as an (n, 4) array, NaN for empty geometries'
+    return np.array([geometry.bounds if not geometry.is_empty else (np.nan,) * 4 for geometry in geometries],
+                    dtype=np.float64).reshape(-1, 4)
+
+
+def pack_tree(bounds):
+    '''
+    Pack a tree of boxes bounds ((n, 4) array, with NaN rows left out), as in flatbush: the boxes sorted along a Hilbert curve
+    through their centres, then each level's nodes bounding NODE_SIZE consecutive nodes (or boxes) of the level below, up to a
+    single root. Returns the box indexes in tree order, the bounds of every node (leaves first, the root last), and the
+    offsets of each level in the node bounds
+    '''
+    items = np.flatnonzero(~np.isnan(bounds[:, 0]))
+    if not len(items):
+        return items, np.zeros((0, 4), dtype=np.float64), np.zeros(1, dtype=np.int64)
+    boxes = bounds[items]
+    west, south = boxes[:, :2].min(axis=0)
+    east, north = boxes[:, 2:].max(axis=0)
+    cells = (1 << HILBERT_ZOOM) - 1
+    x = ((boxes[:, 0] + boxes[:, 2]) / 2 - west) / ((east - west) or 1) * cells
+    y = ((boxes[:, 1] + boxes[:, 3]) / 2 - south) / ((north - south) or 1) * cells
+    order = np.argsort(hilbert(HILBERT_ZOOM, x.astype(np.uint64), y.astype(np.uint64)), kind='stable')
+    items, level = items[order], boxes[order]
+    levels = [level[:0]]
+    while len(levels) == 1 or len(level) > 1:
+        starts = np.arange(0, len(level), NODE_SIZE)
+        level = np.column_stack([np.minimum.reduceat(level[:, 0], starts), np.minimum.reduceat(level[:, 1], starts),
+                                 np.maximum.reduceat(level[:, 2], starts), np.maximum.reduceat(level[:, 3], starts)])
+        levels.append(level)
+    return items, np.concatenate(levels[1:]), np.cumsum([len(level) for level in levels], dtype=np.int64)
+
+
+def children(nodes, count, points):
+    'The (point, child) pairs of (point, node) pairs, for nodes of a level above count nodes (or boxes)'
+    first = nodes * NODE_SIZE
+    counts = np.minimum(NODE_SIZE, count - first)
+    points = np.repeat(points, counts)
+    offsets = np.arange(len(points)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(first, counts) + offsets, points
+
+
+def within(bounds, boxes, points, x, y):
+    '(box, point) pairs with point (x[points], y[points]) in the bounds of the box'
+    # A side at a time, as each leaves fewer pairs to test
+    for column, coordinates, inside in [(0, x, np.greater_equal), (2, x, np.less_equal), (1, y, np.greater_equal), (3, y, np.less_equal)]:
+        keep = inside(coordinates[points], bounds[boxes, column])
+        boxes, points = boxes[keep], points[keep]
+    return boxes, points
+
+
+class RegionIndex:
+    'The loaded index of a layer'
+    def __init__(self, filename):
+        with np.load(filename) as data:
+            wkb = data['wkb'].tobytes()
+            offsets = data['offsets']
+            self.fids = data['fids']
+            self.values = json.loads(str(data['values']), object_pairs_hook=OrderedDict)
+            tree = (data['tree_items'], data['tree_bounds'], data['tree_levels']) if 'tree_items' in data else None
+        self.geometries = [shapely_wkb.loads(wkb[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+        self.prepared = [prep(geometry) for geometry in self.geometries]
+        self.geometry_bounds = geometry_bounds(self.geometries)
+        # Indexes saved before they had a tree are packed on loading
+        self.tree_items, self.tree_bounds, self.tree_levels = tree if tree is not None else pack_tree(self.geometry_bounds)
+        self.item_bounds = self.geometry_bounds[self.tree_items]
+        # Position of each region in FID order, so regions matching a point are tested lowest FID first
+        self.rank = np.empty(len(self.fids), dtype=np.int64)
+        self.rank[np.argsort(self.fids, kind='stable')] = np.arange(len(self.fids))
+        self.bounds = (tuple(np.nanmin(self.geometry_bounds[:, :2], axis=0)) + tuple(np.nanmax(self.geometry_bounds[:, 2:], axis=0))
+                       if len(self.geometries) else (np.nan,) * 4)
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def candidates(self, x, y):
+        '''
+        (point, region) pairs of points (x, y) and the regions with them in their bounds, found by querying the tree a level
+        at a time from the root, QUERY_SIZE points at a time
+        '''
+        levels = self.tree_levels
+        pairs = [(np.zeros(0, dtype=np.int64),) * 2]
+        for start in range(0, len(x) if len(self.tree_items) else 0, QUERY_SIZE):
+            points = np.arange(start, min(start + QUERY_SIZE, len(x)))
+            nodes = np.zeros(len(points), dtype=np.int64)
+            for level in range(len(levels) - 2, -1, -1):
+                nodes, points = within(self.tree_bounds[levels[level]:levels[level + 1]], nodes, points, x, y)
+                nodes, points = children(nodes, levels[level] - levels[level - 1] if level else len(self.tree_items), points)
+            nodes, points = within(self.item_bounds, nodes, points, x, y)
+            pairs.append((points, self.tree_items[nodes]))
+        points, regions = zip(*pairs)
+        return np.concatenate(points), np.concatenate(regions)
+
+    def lookup(self, lon, lat, batch_size=BATCH_SIZE):
+        '''
+        FIDs of the regions containing points (lon, lat), as an int64 array with -1 for points outside every region. A point
+        on the boundary between regions gets the lowest of their FIDs
+        '''
+        lon = np.asarray(lon, dtype=np.float64).ravel()
+        lat = np.asarray(lat, dtype=np.float64).ravel()
+        if lon.shape != lat.shape:
+            raise ValueError('lon and lat must have the same length')
+        result = np.full(len(lon), -1, dtype=np.int64)
+        for start in range(0, len(lon), batch_size):
+            x, y = lon[start:start + batch_size], lat[start:start + batch_size]
+            found = np.full(len(x), -1, dtype=np.int64)
+            points, regions = self.candidates(x, y)
+            # Grouped by region, in FID order
+            sort = np.lexsort((points, self.rank[regions]))
+            points, regions = points[sort], regions[sort]
+            starts = np.flatnonzero(np.concatenate([[True], regions[1:] != regions[:-1]]))
+            for first, last in zip(starts.tolist(), starts[1:].tolist() + [len(regions)]):
+                i = regions[first]
+                # Points in the region's bounds that no lower FID has matched
+                candidates = points[first:last][found[points[first:last]] < 0]
+                if not len(candidates):
+                    continue
+                hit = vectorized.contains(self.prepared[i], x[candidates], y[candidates])
+                if not hit.all():
+                    hit[~hit] = vectorized.touches(self.prepared[i], x[candidates[~hit]], y[candidates[~hit]]) # Points on the boundary
+                found[candidates[hit]] = self.fids[i]
+            result[start:start + batch_size] = found
+        return result
+
+    def lookup_values(self, lon, lat, column, batch_size=BATCH_SIZE):
+        'Values of column for the regions containing points (lon, lat), as a list with None for points outside every region'
+        if column not in self.values:
+            raise KeyError('No column {} in the index (has {})'.format(column, ', '.join(self.values) or 'none'))
+        column_values = self.values[column] + [None] # FID -1 indexes the None
+        return [column_values[fid] for fid in self.lookup(lon, lat, batch_size).tolist()]
+
+
+def read_points(body, content_type):
+    'Longitudes and latitudes from a request body'
+    if content_type.startswith('application/json'):
+        request = json.loads(body.decode('utf-8'))
+        return np.asarray(request['lon'], dtype=np.float64), np.asarray(request['lat'], dtype=np.float64)
+    points = np.load(io.BytesIO(body), allow_pickle=False)
+    if points.ndim != 2 or points.shape[1] != 2:
+        raise ValueError('Expected an (n, 2) array of longitude, latitude')
+    return points[:, 0], points[:, 1]
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(indexes):
+    class LookupHandler(BaseHTTPRequestHandler):
+        def respond(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            index = indexes.get(url.path.strip('/'))
+            if index is None:
+                self.respond(404, {'error': 'Unknown layer {}'.format(url.path.strip('/'))})
+                return
+            column = parse_qs(url.query).get('property', [None])[0]
+            try:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                lon, lat = read_points(body, self.headers.get('Content-Type', ''))
+                fids = index.lookup(lon, lat)
+                response = OrderedDict([('fids', fids.tolist())])
+                if column is not None:
+                    column_values = index.values[column] + [None]
+                    response['values'] = [column_values[fid] for fid in response['fids']]
+            except (ValueError, KeyError) as e:
+                self.respond(400, {'error': str(e)})
+                return
+            self.respond(200, response)
+
+    return LookupHandler
+
+
+def serve(layer_names, port, output_dir='output_files'):
+    indexes = OrderedDict((layer_name, RegionIndex(index_filename(layer_name, output_dir))) for layer_name in layer_names)
+    server = ThreadingHTTPServer(('', port), make_handler(indexes))
+    print('Serving point lookups for {} on port {}'.format(', '.join(indexes), port))
+    server.serve_forever()
+
+
+def largest_layer(output_dir='output_files'):
+    'Name of the layer with the largest index'
+    filenames = [name for name in os.listdir(output_dir) if name.startswith('regionindex-') and name.endswith('.npz')]
+    if not filenames:
+        raise FileNotFoundError('No region indexes in {}'.format(output_dir))
+    filename = max(filenames, key=lambda name: os.path.getsize(os.path.join(output_dir, name)))
+    return filename[len('regionindex-'):-len('.npz')]
+
+
+def benchmark(layer_name, points, batch_size=BATCH_SIZE, seed=0, output_dir='output_files'):
+    'Time loading an index and looking up points uniformly distributed over its bounds'
+    start = time.perf_counter()
+    index = RegionIndex(index_filename(layer_name, output_dir))
+    load_time = time.perf_counter() - start
+    rng = np.random.RandomState(seed)
+    w, s, e, n = index.bounds
+    lon, lat = rng.uniform(w, e, points), rng.uniform(s, n, points)
+    start = time.perf_counter()
+    fids = index.lookup(lon, lat, batch_size)
+    lookup_time = time.perf_counter() - start
+    print('{}: {} regions, index loaded in {:.2f}s'.format(layer_name, len(index), load_time))
+    print('{} points in {:.2f}s ({:.0f} points/s), {:.1%} inside a region'.format(points, lookup_time, points / lookup_time, np.mean(fids >= 0)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output-dir', default='output_files', help='Directory of region indexes (default: output_files)')
+    subparsers = parser.add_subparsers(dest='command')
+    build_parser = subparsers.add_parser('build', help='Build the index of a layer')
+    build_parser.add_argument('geometry_file')
+    build_parser.add_argument('layer_name')
+    build_parser.add_argument('--layer', help='Layer of the geometry file to index (default: the first layer)')
+    build_parser.add_argument('--columns', nargs='*', default=[], help='Attribute columns to store for lookups')
+    build_parser.add_argument('--fid-attribute', help='Attribute holding FIDs (default: number features in layer order)')
+    lookup_parser = subparsers.add_parser('lookup', help='Look up a point')
+    lookup_parser.add_argument('layer_name')
+    lookup_parser.add_argument('lon', type=float)
+    lookup_parser.add_argument('lat', type=float)
+    lookup_parser.add_argument('--property', help='Column to return the value of')
+    serve_parser = subparsers.add_parser('serve', help='Serve lookups over HTTP')
+    serve_parser.add_argument('layer_names', nargs='+')
+    serve_parser.add_argument('--port', type=int, default=8001)
+    benchmark_parser = subparsers.add_parser('benchmark', help='Measure lookup throughput')
+    benchmark_parser.add_argument('layer_name', nargs='?', help='Layer to benchmark (default: the layer with the largest index)')
+    benchmark_parser.add_argument('--points', type=int, default=1000000)
+    benchmark_parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        input_layer_name = args.layer or ogr.Open(args.geometry_file).GetLayerByIndex(0).GetName()
+        os.makedirs(args.output_dir, exist_ok=True)
+        count = build(args.geometry_file, input_layer_name, index_filename(args.layer_name, args.output_dir), args.columns, args.fid_attribute)
+        print('Indexed {} regions'.format(count))
+    elif args.command == 'lookup':
+        index = RegionIndex(index_filename(args.layer_name, args.output_dir))
+        if args.property:
+            print(index.lookup_values([args.lon], [args.lat], args.property)[0])
+        else:
+            print(index.lookup([args.lon], [args.lat])[0])
+    elif args.command == 'serve':
+        serve(args.layer_names, args.port, args.output_dir)
+    elif args.command == 'benchmark':
+        benchmark(args.layer_name or largest_layer(args.output_dir), args.points, args.batch_size, output_dir=args.output_dir)
+    else:
+        parser.print_help()
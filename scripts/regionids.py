@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Streaming writer for regionid files (output_files/region_map-<layer>_<column>.json): the values of a region property in FID
+order, which TerriaJS matches region names against. Values can be added in any order. Each value is appended to a spool file as
+it arrives, and only its offset is kept, in an array indexed by FID, so memory use doesn't grow with the values themselves.
+Closing the writer streams the values out in FID order to the JSON file and to gzip (and, if the brotli module is installed,
+brotli) pre-compressed siblings. Optionally a compact encoding is written as well, to region_map-<layer>_<column>.compact.json:
+
+- {"encoding": "delta", "type": "number" or "string", "values": [first value, difference to the previous value, ...]} when
+  every value is an integer (or a string of digits without leading zeros)
+- {"encoding": "dictionary", "dictionary": [distinct values], "values": [index into the dictionary, ...]} when at most half
+  the values are distinct
+
+with "layer" and "property" as in the JSON file, and nulls left as null. Run with regionid files to compare the size and
+parse time of each encoding
+'''
+
+import argparse
+import gzip
+import json
+import os
+import re
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CHUNK_SIZE = 1 << 16 # Bytes of output collected before writing
+DIGITS = re.compile(r'^(0|[1-9][0-9]*)$')
+
+
+def compact_filename(filename):
+    'Filename of the compact encoding of a regionid file'
+    return os.path.splitext(filename)[0] + '.compact.json'
+
+
+def variants(filename):
+    'A file and its pre-compressed siblings that exist'
+    return [name for name in [filename, filename + '.gz', filename + '.br'] if os.path.exists(name)]
+
+
+def outputs(filename, compact=False):
+    '''
+    Artifact names and filenames of the files a regionid file is written as: the plain file and its pre-compressed
+    siblings, or with compact those of its compact encoding
+    '''
+    if compact:
+        filename = compact_filename(filename)
+    suffixes = ['', '.gz'] + (['.br'] if brotli is not None else [])
+    return OrderedDict(('{}json{}'.format('compact.' if compact else '', suffix), filename + suffix) for suffix in suffixes)
+
+
+class CompressedFiles:
+    'Writes the same bytes to a file and its pre-compressed siblings'
+    def __init__(self, filename, gzip_level=9, brotli_quality=11):
+        self.files = [open(filename, 'wb')]
+        self.gzip_file = open(filename + '.gz', 'wb')
+        self.files.append(gzip.GzipFile(filename='', mode='wb', compresslevel=gzip_level, fileobj=self.gzip_file, mtime=0)) # No timestamp, so output is reproducible
+        self.brotli_file = open(filename + '.br', 'wb') if brotli is not None else None
+        self.brotli = brotli.Compressor(quality=brotli_quality) if brotli is not None else None
+        if brotli is None and os.path.exists(filename + '.br'):
+            os.remove(filename + '.br') # Stale
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+        if self.brotli is not None:
+            self.brotli_file.write(self.brotli.process(data))
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.gzip_file.close()
+        if self.brotli is not None:
+            self.brotli_file.write(self.brotli.finish())
+            self.brotli_file.close()
+
+
+def _python_value(value):
+    'Convert numpy scalars (from attribute columns) to Python values'
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class RegionIdsWriter:
+    '''
+    Collects the values of one region property by FID and writes its regionid file on close.
+    num_features is the number of FIDs, which run from 0 to num_features - 1. FIDs that are never set are written as null
+    '''
+    def __init__(self, filename, layer_name, column, num_features, compact=False, spool_dir='temp'):
+        self.filename = filename
+        self.layer_name = layer_name
+        self.column = column
+        self.compact = compact
+        self.offsets = np.full(num_features, -1, dtype=np.int64)
+        self.spool = tempfile.TemporaryFile(dir=spool_dir)
+        self.position = 0
+        self.encoding = None
+
+    def set(self, fid, value):
+        'Set the value of a feature'
+        record = json.dumps(_python_value(value)).encode('utf-8') + b'\n'
+        self.offsets[fid] = self.position
+        self.spool.write(record)
+        self.position += len(record)
+
+    def extend(self, fids, values):
+        'Set the values of many features'
+        for fid, value in zip(fids, values):
+            self.set(int(fid), value)
+
+    def _records(self):
+        'Yield the JSON encoded value of each feature in FID order'
+        self.spool.flush()
+        self.spool.seek(0)
+        set_offsets = self.offsets[self.offsets >= 0]
+        if len(set_offsets) == len(self.offsets) and np.all(np.diff(set_offsets) > 0):
+            # Added in FID order, so the spool can just be read through
+            for line in self.spool:
+                yield line[:-1]
+            return
+        for offset in self.offsets:
+            if offset < 0:
+                yield b'null'
+            else:
+                self.spool.seek(offset)
+                yield self.spool.readline()[:-1]
+
+    def _choose_encoding(self):
+        'The compact encoding suited to the values, or None if neither helps'
+        self.spool.flush()
+        self.spool.seek(0)
+        integers = True
+        digit_strings = True
+        distinct = set()
+        limit = len(self.offsets) // 2
+        for line in self.spool:
+            value = json.loads(line.decode('utf-8'))
+            if value is None:
+                continue
+            integers = integers and isinstance(value, int) and not isinstance(value, bool)
+            digit_strings = digit_strings and isinstance(value, str) and DIGITS.match(value) is not None
+            if distinct is not None:
+                distinct.add(line) # By JSON encoding, as equal values like true, 1 and 1.0 must stay apart
+                if len(distinct) > limit:
+                    distinct = None # Too many distinct values for a dictionary to help
+            if not integers and not digit_strings and distinct is None:
+                return None
+        if integers or digit_strings:
+            return 'delta', 'number' if integers else 'string'
+        return ('dictionary', None) if distinct is not None else None
+
+    def _header(self):
+        return json.dumps(OrderedDict([('layer', self.layer_name), ('property', self.column)]))[:-1]
+
+    def close(self):
+        'Write the regionid file (and the compact encoding if requested), returning the filenames written'
+        encoding = self._choose_encoding() if self.compact else None
+        out = CompressedFiles(self.filename)
+        compact_out = CompressedFiles(compact_filename(self.filename)) if encoding else None
+        dictionary = OrderedDict()
+        previous = 0
+        try:
+            # Same formatting as json.dump of OrderedDict([('layer', ...), ('property', ...), ('values', [...])]), so files can still be compared as strings
+            out.write((self._header() + ', "values": [').encode('utf-8'))
+            if encoding:
+                compact_out.write((self._header() + ', "encoding": "{}"'.format(encoding[0]) + (', "type": "{}"'.format(encoding[1]) if encoding[1] else '') + ', "values": [').encode('utf-8'))
+            chunk = []
+            compact_chunk = []
+            for i, record in enumerate(self._records()):
+                chunk.append(record)
+                if encoding:
+                    value = json.loads(record.decode('utf-8'))
+                    if value is None:
+                        code = None
+                    elif encoding[0] == 'delta':
+                        code = int(value) - previous
+                        previous = int(value)
+                    else:
+                        code = dictionary.setdefault(record, len(dictionary))
+                    compact_chunk.append(json.dumps(code).encode('utf-8'))
+                if len(chunk) * 8 >= CHUNK_SIZE or (i + 1) == len(self.offsets):
+                    out.write((b', ' if i + 1 > len(chunk) else b'') + b', '.join(chunk))
+                    if encoding:
+                        compact_out.write((b', ' if i + 1 > len(compact_chunk) else b'') + b', '.join(compact_chunk))
+                    chunk = []
+                    compact_chunk = []
+            out.write(b']}')
+            if encoding:
+                compact_out.write(b']' + (b', "dictionary": [' + b', '.join(dictionary) + b']' if encoding[0] == 'dictionary' else b'') + b'}')
+        finally:
+            out.close()
+            if compact_out is not None:
+                compact_out.close()
+            self.spool.close()
+        if not encoding:
+            for name in variants(compact_filename(self.filename)):
+                os.remove(name) # Stale
+        self.encoding = encoding and encoding[0]
+        return variants(self.filename) + (variants(compact_filename(self.filename)) if encoding else [])
+
+
+def decode_compact(regionids):
+    'Decode a parsed compact regionid file into the parsed form of the plain file'
+    values = regionids['values']
+    if regionids['encoding'] == 'dictionary':
+        dictionary = regionids['dictionary']
+        values = [dictionary[code] if code is not None else None for code in values]
+    elif regionids['encoding'] == 'delta':
+        decoded = []
+        previous = 0
+        for delta in values:
+            if delta is None:
+                decoded.append(None)
+            else:
+                previous += delta
+                decoded.append(previous if regionids['type'] == 'number' else str(previous))
+        values = decoded
+    return OrderedDict([('layer', regionids['layer']), ('property', regionids['property']), ('values', values)])
+
+
+def size_summary(filename):
+    'One line summary of the sizes of a regionid file, its pre-compressed siblings and compact encoding'
+    def sizes(name):
+        return ', '.join('{:.2f}MB{}'.format(os.path.getsize(variant) / 1024**2, variant[len(name):] and ' ' + variant[len(name) + 1:])
+                         for variant in variants(name))
+    summary = '{}: {}'.format(filename, sizes(filename))
+    if os.path.exists(compact_filename(filename)):
+        summary += '; compact: {}'.format(sizes(compact_filename(filename)))
+    return summary
+
+
+def compare(filename, repeat=3):
+    'Size and parse time (best of repeat, including decoding) of a regionid file and its compact encoding'
+    rows = []
+    for name, decode in [(filename, lambda regionids: regionids), (compact_filename(filename), decode_compact)]:
+        if not os.path.exists(name):
+            continue
+        with open(name, 'rb') as f:
+            data = f.read()
+        parse_times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            decoded = decode(json.loads(data.decode('utf-8')))
+            parse_times.append(time.perf_counter() - start)
+        rows.append(OrderedDict([
+            ('file', name),
+            ('bytes', len(data)),
+            ('gzip_bytes', os.path.getsize(name + '.gz') if os.path.exists(name + '.gz') else None),
+            ('brotli_bytes', os.path.getsize(name + '.br') if os.path.exists(name + '.br') else None),
+            ('parse_ms', min(parse_times) * 1000),
+            ('values', len(decoded['values']))
+        ]))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help='regionid files (eg. output_files/region_map-*.json) to report on')
+    parser.add_argument('--repeat', type=int, default=3, help='Times to parse each file, taking the fastest (default: 3)')
+    args = parser.parse_args()
+    columns = ['bytes', 'gzip_bytes', 'brotli_bytes', 'parse_ms', 'values']
+    print('{:60}  '.format('File') + '  '.join('{:>12}'.format(column) for column in columns))
+    for filename in args.files:
+        if filename.endswith('.compact.json'):
+            continue
+        for row in compare(filename, args.repeat):
+            print('{:60}  '.format(row['file']) + '  '.join('{:>12}'.format('-' if row[c] is None else round(row[c], 1) if isinstance(row[c], float) else row[c]) for c in columns))
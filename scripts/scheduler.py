@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'Bounded scheduling of the subprocesses (ogr2ogr, tippecanoe) run while building layers'
+
+import os
+import time
+from collections import deque, OrderedDict
+
+import asyncio.subprocess
+
+
+def physical_memory():
+    'Total physical memory in bytes, or None if it cannot be determined'
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class JobScheduler:
+    '''
+    Caps the number of concurrently running subprocesses and their total estimated memory use
+    Waiting jobs are started in the order they asked to start, so jobs queued first (eg. the largest layers) run first.
+    A job is always allowed to start when nothing else is running, so a job larger than the limits cannot block forever
+    '''
+    def __init__(self, max_processes=None, max_memory=None):
+        self.max_processes = max_processes or os.cpu_count() or 1
+        self.max_memory = max_memory or physical_memory() or float('inf')
+        self.processes = 0
+        self.memory = 0
+        self._waiters = deque()
+
+    def _fits(self, processes, memory):
+        if self.processes == 0:
+            return True
+        return self.processes + processes <= self.max_processes and self.memory + memory <= self.max_memory
+
+    def _take(self, processes, memory):
+        self.processes += processes
+        self.memory += memory
+
+    def _wake(self):
+        'Start waiting jobs in order while they fit'
+        while self._waiters:
+            processes, memory, future = self._waiters[0]
+            if future.cancelled():
+                self._waiters.popleft()
+                continue
+            if not self._fits(processes, memory):
+                break
+            self._waiters.popleft()
+            self._take(processes, memory)
+            future.set_result(None)
+
+    async def acquire(self, processes=1, memory=0):
+        'Wait until processes subprocesses using memory bytes can be started'
+        if not self._waiters and self._fits(processes, memory):
+            self._take(processes, memory)
+            return
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.append((processes, memory, future))
+        await future
+
+    def release(self, processes=1, memory=0):
+        'Mark processes subprocesses using memory bytes as finished'
+        self.processes -= processes
+        self.memory -= memory
+        self._wake()
+
+    def slot(self, processes=1, memory=0):
+        'Async context manager holding room for processes subprocesses for the duration of the block'
+        return _Slot(self, processes, memory)
+
+    async def exec(self, *args, memory=0, **kwargs):
+        '''
+        Start a subprocess once there is room for it. Returns the process and a future to its return code
+        The slot is released as soon as the process exits, whether or not the future is awaited yet
+        '''
+        await self.acquire(1, memory)
+        try:
+            proc = await asyncio.create_subprocess_exec(*args, **kwargs)
+        except:
+            self.release(1, memory)
+            raise
+        return proc, asyncio.ensure_future(self._finish(proc, memory))
+
+    async def _finish(self, proc, memory):
+        try:
+            return await proc.wait()
+        finally:
+            self.release(1, memory)
+
+
+class _Slot:
+    def __init__(self, scheduler, processes, memory):
+        self.scheduler = scheduler
+        self.processes = processes
+        self.memory = memory
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.processes, self.memory)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.scheduler.release(self.processes, self.memory)
+
+
+class WallClock:
+    'Records wall-clock time of named jobs and prints a summary table'
+    def __init__(self):
+        self.started = OrderedDict()
+        self.finished = {}
+
+    def start(self, name):
+        self.started[name] = time.time()
+
+    def finish(self, name):
+        self.finished[name] = time.time()
+
+    def summary(self):
+        rows = [('Layer', 'Wall clock (s)')]
+        for name, start in self.started.items():
+            rows.append((name, '{:.1f}'.format(self.finished[name] - start) if name in self.finished else 'failed'))
+        return '\n'.join('{:40}  {:>14}'.format(*row) for row in rows)
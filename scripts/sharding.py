@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Shard the layers of a deployment across several servers (nodes), each downloading and serving only its layers, so a
+deployment isn't limited by what one server can hold. Layers are weighted by a mix of their share of the deployment's
+mbtiles size and their share of requests (from the report of analyse_logs.py), and placed by consistent hashing with bounded
+loads: nodes have points on a hash ring, each layer goes to the first node clockwise from its hash that it fits on without
+taking the node over LOAD_FACTOR times the average load. Heavy layers are placed first. Hot layers (at least HOT_SHARE of
+requests) are replicated on the next nodes around the ring, and the proxy in front balances between them.
+
+Nodes are named node-0, node-1, ... and keep their ring points as nodes are added or removed, so changing the number of
+nodes only moves the layers whose ring position changes owner (about 1/N of them), plus any pushed over a node's load bound.
+
+deploy.py uploads a deployment document per node (deployments/<deployment>/<node>.json, read by server/download_data.py
+--node) and writes the routing of layers to nodes as an nginx config for the front proxy. Run this script to preview a
+sharding and how many layers it moves from another number of nodes:
+
+    ./sharding.py index.json <deployment> --nodes 4 [--previous-nodes 3] [--requests log_analysis/report.json]
+
+where index.json is the bucket index (layer_index.py show > index.json)
+'''
+
+import argparse
+import bisect
+import hashlib
+import json
+from collections import OrderedDict
+
+VIRTUAL_NODES = 100 # Ring points per node, to spread each node's share of the ring evenly
+LOAD_FACTOR = 1.25 # Most a node's load can be over the average
+REQUEST_WEIGHT = 0.5 # Share of a layer's weight from its requests, the rest being from its size
+HOT_SHARE = 0.1 # Share of requests making a layer hot
+HOT_REPLICAS = 2 # Nodes serving each hot layer
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+def node_names(count):
+    return ['node-{}'.format(i) for i in range(count)]
+
+
+def layer_weights(sizes, requests=None, request_weight=REQUEST_WEIGHT):
+    '''
+    Weight of each layer: its share of the total size, mixed with its share of requests by request_weight.
+    sizes and requests map layers to mbtiles bytes and request counts. Without requests, weights are size shares
+    '''
+    total_size = sum(sizes.values()) or 1
+    total_requests = sum((requests or {}).get(layer, 0) for layer in sizes)
+    if not total_requests:
+        request_weight = 0
+    return OrderedDict((layer, (1 - request_weight) * size / total_size + request_weight * (requests or {}).get(layer, 0) / (total_requests or 1))
+                       for layer, size in sorted(sizes.items()))
+
+
+def replica_counts(layers, nodes, requests=None, hot_share=HOT_SHARE, hot_replicas=HOT_REPLICAS):
+    'Number of nodes serving each layer: hot_replicas for layers with at least hot_share of requests, otherwise 1'
+    total_requests = sum((requests or {}).get(layer, 0) for layer in layers)
+    return OrderedDict((layer, min(nodes, hot_replicas) if total_requests and (requests or {}).get(layer, 0) / total_requests >= hot_share else 1)
+                       for layer in layers)
+
+
+class Ring:
+    'Consistent hash ring with VIRTUAL_NODES points per node'
+    def __init__(self, nodes):
+        self.points = sorted((ring_hash('{}#{}'.format(node, i)), node) for node in nodes for i in range(VIRTUAL_NODES))
+        self.hashes = [point for point, _ in self.points]
+
+    def walk(self, key):
+        'Each node once, in ring order clockwise from the hash of key'
+        start = bisect.bisect(self.hashes, ring_hash(key))
+        seen = set()
+        for i in range(len(self.points)):
+            node = self.points[(start + i) % len(self.points)][1]
+            if node not in seen:
+                seen.add(node)
+                yield node
+
+
+def assign(weights, nodes, replicas=None, load_factor=LOAD_FACTOR, previous=None):
+    '''
+    Assign layers (weights from layer_weights) to nodes by consistent hashing with bounded loads.
+    replicas maps layers to how many nodes serve them (default 1). With the previous assignment, layers stay on their
+    nodes where they fit, unless the ring now puts them on a new node, so changing nodes moves as few layers as possible.
+    Returns {layer: [nodes]}, primary node first
+    '''
+    replicas = replicas or {}
+    previous = previous or {}
+    previous_nodes = {node for layer_nodes in previous.values() for node in layer_nodes}
+    ring = Ring(nodes)
+    copies = {layer: min(replicas.get(layer, 1), len(nodes)) for layer in weights}
+    # A replicated layer's requests are split between its nodes, so each copy carries its size and a share of its requests
+    total = sum(weight * copies[layer] for layer, weight in weights.items())
+    capacity = max([load_factor * total / len(nodes)] + list(weights.values()))
+    loads = OrderedDict((node, 0) for node in nodes)
+    assignment = {}
+    for layer in sorted(weights, key=lambda layer: (-weights[layer], layer)):
+        assigned = []
+        for _ in range(copies[layer]):
+            candidates = [node for node in ring.walk(layer) if node not in assigned]
+            if previous:
+                # Stay put, or failing that move to a new node, rather than between nodes that were already there. A layer
+                # the ring now puts on a new node moves there, but stays put rather than moving on if that node is full
+                kept = [node for node in previous.get(layer, []) if node in loads and node not in assigned]
+                first = candidates[:1] if candidates[0] not in previous_nodes else []
+                candidates = first + kept + sorted((node for node in candidates if node not in kept + first), key=lambda node: node in previous_nodes)
+            node = next((node for node in candidates if loads[node] + weights[layer] <= capacity), None)
+            if node is None: # Every node is full, which only a layer heavier than the bound can cause
+                node = min(candidates, key=lambda node: loads[node])
+            assigned.append(node)
+            loads[node] += weights[layer]
+        assignment[layer] = assigned
+    return OrderedDict((layer, assignment[layer]) for layer in sorted(assignment))
+
+
+def node_layers(assignment, nodes):
+    'Layers of each node'
+    layers = OrderedDict((node, []) for node in nodes)
+    for layer, layer_nodes in assignment.items():
+        for node in layer_nodes:
+            layers[node].append(layer)
+    return layers
+
+
+def moved_layers(old_assignment, new_assignment):
+    'Layers served by a node in the new assignment that didn\'t serve them in the old one (which it would need to download)'
+    return sorted(layer for layer, nodes in new_assignment.items() if set(nodes) - set(old_assignment.get(layer, [])))
+
+
+def node_deployments(deployment, assignment, nodes):
+    'Deployment document for each node: the deployment restricted to the node\'s layers'
+    documents = OrderedDict()
+    for node, layers in node_layers(assignment, nodes).items():
+        document = OrderedDict([('data', OrderedDict((layer, deployment['data'][layer]) for layer in layers)), ('node', node)])
+        priority = [layer for layer in deployment.get('priority', []) if layer in layers]
+        if priority:
+            document['priority'] = priority
+        deltas = OrderedDict((layer, delta) for layer, delta in deployment.get('deltas', {}).items() if layer in layers)
+        if deltas:
+            document['deltas'] = deltas
+        documents[node] = document
+    return documents
+
+
+def upstream_name(nodes):
+    return '_'.join(node.replace('-', '') for node in nodes)
+
+
+def proxy_config(assignment, node_hosts, port=443, scheme='https'):
+    '''
+    nginx config routing /<layer>/... to the nodes serving the layer: an upstream per set of nodes serving a layer (so
+    replicated layers are balanced between their nodes) and a map from layer to upstream. node_hosts maps nodes to hosts
+    '''
+    groups = OrderedDict()
+    for layer_nodes in assignment.values():
+        groups.setdefault(upstream_name(layer_nodes), layer_nodes)
+    lines = []
+    for name, layer_nodes in sorted(groups.items()):
+        lines.append('upstream {} {{'.format(name))
+        lines.extend('    server {}:{};'.format(node_hosts[node], port) for node in layer_nodes)
+        lines.append('    keepalive 16;')
+        lines.append('}')
+    lines.append('map $tile_layer $tile_upstream {')
+    lines.append('    default "";')
+    lines.extend('    {} {};'.format(layer, upstream_name(layer_nodes)) for layer, layer_nodes in assignment.items())
+    lines.append('}')
+    lines.append('server {')
+    lines.append('    listen 80;')
+    lines.append('    location ~ ^/(?<tile_layer>[^/]+)/ {')
+    lines.append('        if ($tile_upstream = "") { return 404; }')
+    lines.append('        proxy_pass {}://$tile_upstream;'.format(scheme))
+    lines.append('        proxy_http_version 1.1;')
+    lines.append('        proxy_set_header Connection "";')
+    lines.append('        proxy_next_upstream error timeout http_502 http_503 http_504;')
+    lines.append('    }')
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+def format_shards(assignment, weights, sizes, nodes):
+    rows = [('Node', 'Layers', 'Size (MB)', 'Load')]
+    for node, layers in node_layers(assignment, nodes).items():
+        rows.append((node, str(len(layers)), '{:.1f}'.format(sum(sizes[layer] for layer in layers) / 1024**2), '{:.1%}'.format(sum(weights[layer] for layer in layers))))
+    replicated = ['{} ({})'.format(layer, ', '.join(layer_nodes)) for layer, layer_nodes in assignment.items() if len(layer_nodes) > 1]
+    return '\n'.join('{:10}  {:>7}  {:>10}  {:>7}'.format(*row) for row in rows) + \
+        ('\nReplicated: ' + ', '.join(replicated) if replicated else '')
+
+
+def shard(sizes, nodes, requests=None, previous=None, hot_share=HOT_SHARE, hot_replicas=HOT_REPLICAS):
+    'Assign layers of the given sizes to node_names(nodes), keeping them where they were in previous. Returns (assignment, weights)'
+    weights = layer_weights(sizes, requests)
+    return assign(weights, node_names(nodes), replica_counts(weights, nodes, requests, hot_share, hot_replicas), previous=previous), weights
+
+
+def deployment_sizes(index, data):
+    'mbtiles size of each layer version of a deployment, from the bucket index'
+    return OrderedDict((layer, index['layers'].get(layer, {}).get(str(version), {}).get('mbtiles', {}).get('size', 0)) for layer, version in sorted(data.items()))
+
+
+def load_requests(report_file):
+    'Requests per layer from a report written by analyse_logs.py'
+    with open(report_file) as f:
+        return {layer: stats['requests'] for layer, stats in json.load(f)['layers'].items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('index', help='Bucket index JSON file')
+    parser.add_argument('deployment', help='Deployment in the index to shard')
+    parser.add_argument('--nodes', type=int, required=True)
+    parser.add_argument('--previous-nodes', type=int, help='Number of nodes to count moved layers from')
+    parser.add_argument('--requests', help='Report of analyse_logs.py to weight layers by requests')
+    parser.add_argument('--hot-share', type=float, default=HOT_SHARE)
+    parser.add_argument('--hot-replicas', type=int, default=HOT_REPLICAS)
+    args = parser.parse_args()
+
+    with open(args.index) as f:
+        index = json.load(f)
+    sizes = deployment_sizes(index, index['deployments'][args.deployment])
+    requests = load_requests(args.requests) if args.requests else None
+    previous = shard(sizes, args.previous_nodes, requests, None, args.hot_share, args.hot_replicas)[0] if args.previous_nodes else None
+    assignment, weights = shard(sizes, args.nodes, requests, previous, args.hot_share, args.hot_replicas)
+    print(format_shards(assignment, weights, sizes, node_names(args.nodes)))
+    if previous is not None:
+        moved = moved_layers(previous, assignment)
+        print('{} of {} layers move from {} nodes: {}'.format(len(moved), len(assignment), args.previous_nodes, ', '.join(moved)))
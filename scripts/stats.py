@@ -0,0 +1,12 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'Summary statistics shared by the benchmark, profiling and tuning scripts'
+
+import math
+
+
+def percentile(sorted_values, p):
+    'The pth percentile (nearest rank) of sorted values, or None if there are none'
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(math.ceil(p / 100 * len(sorted_values))) - 1)]
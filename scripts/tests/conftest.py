@@ -0,0 +1,28 @@
+import gzip
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # The scripts import each other by module name
+
+
+@pytest.fixture
+def make_mbtiles(tmp_path):
+    'Function writing an mbtiles file from {(z, x, y): uncompressed data} (mbtiles rows) and a metadata dict. Returns its filename'
+    def make(name, tiles, meta=None):
+        filename = str(tmp_path / name)
+        db = sqlite3.connect(filename)
+        db.executescript('''
+            CREATE TABLE metadata (name TEXT, value TEXT);
+            CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+            CREATE UNIQUE INDEX name ON metadata (name);
+            CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);
+        ''')
+        db.executemany('INSERT INTO metadata VALUES (?, ?)', sorted((meta or {'name': name}).items()))
+        db.executemany('INSERT INTO tiles VALUES (?, ?, ?, ?)', [(z, x, y, gzip.compress(data)) for (z, x, y), data in sorted(tiles.items())])
+        db.commit()
+        db.close()
+        return filename
+    return make
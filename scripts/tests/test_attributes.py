@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+ogr = pytest.importorskip('osgeo.ogr')
+
+from attributes import AttributeTable, is_valid_fid, is_unique
+
+
+@pytest.fixture
+def layer():
+    'An in memory layer with a column of each type read by feature, with nulls in some'
+    data_source = ogr.GetDriverByName('Memory').CreateDataSource('attributes')
+    layer = data_source.CreateLayer('regions', geom_type=ogr.wkbPoint)
+    for name, field_type in [('FID_REAL', ogr.OFTReal), ('count', ogr.OFTInteger), ('big', ogr.OFTInteger64), ('code', ogr.OFTString), ('date', ogr.OFTDate)]:
+        layer.CreateField(ogr.FieldDefn(name, field_type))
+    for i in range(1000):
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('FID_REAL', float(999 - i))
+        if i % 100:
+            feature.SetField('count', i)
+        feature.SetField('big', i << 40)
+        feature.SetField('code', 'R{}'.format(i))
+        feature.SetField('date', '2016/07/{:02}'.format(i % 28 + 1))
+        layer.CreateFeature(feature)
+    yield layer
+    data_source = None
+
+
+@pytest.mark.parametrize('arrow', [True, False])
+def test_columns(layer, monkeypatch, arrow):
+    if not arrow:
+        monkeypatch.setattr(AttributeTable, '_read_arrow', lambda table, columns: table._read_features(columns))
+    elif not hasattr(layer, 'GetArrowStreamAsNumPy'):
+        pytest.skip('GDAL < 3.6 has no Arrow stream')
+    table = AttributeTable(layer, batch_size=300)
+    fids, counts, big, codes, dates = table.columns('FID_REAL', 'count', 'big', 'code', 'date')
+    assert fids.dtype == np.float64 and is_valid_fid(fids, 1000)
+    assert counts.tolist() == [None if i % 100 == 0 else i for i in range(1000)]
+    assert big.dtype == np.int64 and big.tolist() == [i << 40 for i in range(1000)]
+    assert codes.tolist() == ['R{}'.format(i) for i in range(1000)] and is_unique(codes)
+    if not arrow: # Dates are strings as from GetField
+        assert dates.tolist() == [feature.GetField('date') for feature in layer]
+    assert table.column('code') is codes # Cached
@@ -0,0 +1,16 @@
+import gzip
+import sqlite3
+
+from test_vector_tile import TILE
+from profile_tiles import profile
+
+
+def test_profile_records_undecodable_tiles(make_mbtiles):
+    mbtiles = make_mbtiles('regions.mbtiles', {(0, 0, 0): TILE, (1, 0, 0): TILE, (1, 0, 1): TILE, (1, 1, 0): b'\x1a\x05x'})
+    with sqlite3.connect(mbtiles) as db:
+        db.execute('UPDATE tiles SET tile_data = ? WHERE zoom_level = 1 AND tile_column = 0 AND tile_row = 1', (gzip.compress(TILE)[:-10],))
+    report = profile(mbtiles, processes=1)
+    # A truncated gzip tile and a truncated protobuf one, at XYZ rows
+    assert sorted((error['z'], error['x'], error['y']) for error in report['decode_errors']) == [(1, 0, 0), (1, 1, 1)]
+    assert (report['zooms']['0']['tiles'], report['zooms']['1']['tiles']) == (1, 1)
+    assert report['total']['features'] == 6
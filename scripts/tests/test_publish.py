@@ -0,0 +1,126 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+moto = pytest.importorskip('moto', minversion='5') # Honours conditional writes, as S3 does
+import boto3
+
+import layer_index
+import publish
+
+BUCKET = 'tiles'
+PART_SIZE = 5 * 1024**2 # The S3 minimum
+
+
+@pytest.fixture
+def s3c(monkeypatch, tmp_path):
+    'A client of a local S3 stand-in with an empty bucket, in a directory for temp/, config/ and data/'
+    for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN']:
+        monkeypatch.setenv(name, 'testing')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(publish, 'MIN_CHUNK_SIZE', PART_SIZE)
+    with moto.mock_aws():
+        s3c = boto3.client('s3', region_name='us-east-1')
+        s3c.create_bucket(Bucket=BUCKET)
+        yield s3c
+
+
+def write_file(filename, size, seed=0):
+    data = bytes((seed + i * 7919) % 251 for i in range(size))
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return data
+
+
+def test_multipart_upload(s3c):
+    data = write_file('layer.mbtiles', 2 * PART_SIZE + 1000)
+    publish.upload(s3c, BUCKET, 'layer.mbtiles', 'mbtiles/layer-v1.mbtiles', 'digest', 4)
+    obj = s3c.get_object(Bucket=BUCKET, Key='mbtiles/layer-v1.mbtiles')
+    assert obj['Body'].read() == data
+    assert obj['Metadata'] == {'sha256': 'digest'}
+    assert obj['ETag'].strip('"').endswith('-3') # Three parts
+    assert os.listdir(publish.UPLOADS_DIR) == []
+
+
+def test_small_upload(s3c):
+    data = write_file('layer.json', 1000)
+    publish.upload(s3c, BUCKET, 'layer.json', 'config/layer-v1.json', 'digest', 4)
+    obj = s3c.get_object(Bucket=BUCKET, Key='config/layer-v1.json')
+    assert (obj['Body'].read(), obj['Metadata']) == (data, {'sha256': 'digest'})
+    assert not os.path.exists(publish.UPLOADS_DIR)
+
+
+def test_resumed_upload(s3c, monkeypatch):
+    data = write_file('layer.mbtiles', 2 * PART_SIZE + 1000)
+    upload_part = s3c.upload_part
+    uploaded = []
+    failed = []
+    def failing_upload_part(**kwargs):
+        if kwargs['PartNumber'] == 2 and not failed:
+            failed.append(2)
+            uploaded.append(2)
+            raise ConnectionError('Connection reset')
+        uploaded.append(kwargs['PartNumber'])
+        return upload_part(**kwargs)
+    monkeypatch.setattr(s3c, 'upload_part', failing_upload_part)
+    with pytest.raises(ConnectionError):
+        publish.upload(s3c, BUCKET, 'layer.mbtiles', 'mbtiles/layer-v1.mbtiles', 'digest', 1)
+    assert len(os.listdir(publish.UPLOADS_DIR)) == 1
+    assert sorted(uploaded) == [1, 2, 3]
+
+    del uploaded[:]
+    publish.upload(s3c, BUCKET, 'layer.mbtiles', 'mbtiles/layer-v1.mbtiles', 'digest', 1)
+    assert uploaded == [2] # Only the part that failed
+    assert s3c.get_object(Bucket=BUCKET, Key='mbtiles/layer-v1.mbtiles')['Body'].read() == data
+    assert os.listdir(publish.UPLOADS_DIR) == []
+
+
+def test_upload_restarts_when_the_unfinished_upload_is_gone(s3c, monkeypatch):
+    data = write_file('layer.mbtiles', 2 * PART_SIZE + 1000)
+    with monkeypatch.context() as patch:
+        patch.setattr(s3c, 'complete_multipart_upload', lambda **kwargs: 1 / 0)
+        with pytest.raises(ZeroDivisionError):
+            publish.upload(s3c, BUCKET, 'layer.mbtiles', 'mbtiles/layer-v1.mbtiles', 'digest', 2)
+    for upload in s3c.list_multipart_uploads(Bucket=BUCKET)['Uploads']:
+        s3c.abort_multipart_upload(Bucket=BUCKET, Key=upload['Key'], UploadId=upload['UploadId'])
+    publish.upload(s3c, BUCKET, 'layer.mbtiles', 'mbtiles/layer-v1.mbtiles', 'digest', 2)
+    assert s3c.get_object(Bucket=BUCKET, Key='mbtiles/layer-v1.mbtiles')['Body'].read() == data
+
+
+def test_index_conflict_retried(s3c):
+    layer_index.set_deployment(s3c, BUCKET, 'first', {'regions': 1})
+    attempts = []
+    def update(index):
+        attempts.append(json.loads(json.dumps(index)))
+        if len(attempts) == 1: # Another publish writes the index between this one reading and writing it
+            layer_index.set_deployment(s3c, BUCKET, 'other', {'regions': 2})
+        index['deployments']['second'] = {'regions': 3}
+        return len(attempts)
+    assert layer_index.update_index(s3c, BUCKET, update) == 2
+    assert 'other' not in attempts[0]['deployments'] and 'other' in attempts[1]['deployments']
+    index, _ = layer_index.load_index(s3c, BUCKET)
+    assert index['deployments'] == {'first': {'regions': 1}, 'other': {'regions': 2}, 'second': {'regions': 3}}
+
+
+def test_publish_layer_skips_unchanged_tiles(s3c, make_mbtiles):
+    os.makedirs('config')
+    os.makedirs('data')
+    with open('config/regions.json', 'w') as f:
+        json.dump({'regions': {}}, f)
+    tiles = {(0, 0, 0): b'world', (1, 0, 0): b'west', (1, 1, 0): b'east'}
+    os.rename(make_mbtiles('regions.mbtiles', tiles), 'data/regions.mbtiles')
+    assert publish.publish_layer(s3c, BUCKET, 'regions') == (1, True)
+    # Rebuilt into a different file with the same tiles
+    with sqlite3.connect('data/regions.mbtiles') as db:
+        db.execute('CREATE TABLE build (id INTEGER)')
+    assert publish.publish_layer(s3c, BUCKET, 'regions') == (1, False)
+
+    os.remove('data/regions.mbtiles')
+    os.rename(make_mbtiles('regions.mbtiles', dict(list(tiles.items()) + [((1, 1, 1), b'north east')])), 'data/regions.mbtiles')
+    assert publish.publish_layer(s3c, BUCKET, 'regions') == (2, True)
+    index, _ = layer_index.load_index(s3c, BUCKET)
+    record = index['layers']['regions']['2']
+    assert record['delta']['from'] == 1 and record['delta']['total']['added'] == 1
+    assert s3c.head_object(Bucket=BUCKET, Key='hashes/regions-v2.hashes')['Metadata']['sha256'] == record['hashes']['sha256']
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+pytest.importorskip('shapely.vectorized') # Shapely 1.8
+from shapely.geometry import Polygon, box
+
+from region_index import write_index, pack_tree, RegionIndex
+
+CELL = 0.5 # Degrees, exact in binary so points on cell edges are exactly on them
+GRID = 200 # Cells in each direction, 40000 regions as in a layer of SA1s
+
+
+@pytest.fixture(scope='module')
+def grid(tmp_path_factory):
+    'An index of a grid of square regions numbered with shuffled FIDs, in a shuffled order, and a band over the top overlapping it'
+    rng = np.random.RandomState(0)
+    fids = rng.permutation(GRID * GRID).reshape(GRID, GRID) # By column, row
+    cells = [(i, j) for i in range(GRID) for j in range(GRID)]
+    order = rng.permutation(len(cells))
+    wkbs = [box(cells[k][0] * CELL, cells[k][1] * CELL, (cells[k][0] + 1) * CELL, (cells[k][1] + 1) * CELL).wkb for k in order]
+    region_fids = [int(fids[cells[k]]) for k in order]
+    band = GRID * GRID
+    wkbs += [box(-10, GRID * CELL / 2, GRID * CELL + 10, GRID * CELL + 10).wkb, Polygon().wkb]
+    region_fids += [band, band + 1]
+    values = {'code': ['C{}'.format(fid) for fid in range(band + 2)]}
+    filename = str(tmp_path_factory.mktemp('index') / 'regionindex-grid.npz')
+    assert write_index(filename, wkbs, region_fids, values) == len(wkbs)
+    return RegionIndex(filename), fids, band
+
+
+def expected(fids, band, lon, lat):
+    i, j = np.floor(lon / CELL).astype(int), np.floor(lat / CELL).astype(int)
+    inside = (i >= 0) & (i < GRID) & (j >= 0) & (j < GRID)
+    result = np.where((lon >= -10) & (lon <= GRID * CELL + 10) & (lat >= GRID * CELL / 2) & (lat <= GRID * CELL + 10), band, -1)
+    result[inside] = fids[i[inside], j[inside]]
+    return result
+
+
+def test_lookup_many_regions(grid):
+    index, fids, band = grid
+    rng = np.random.RandomState(1)
+    lon, lat = rng.uniform(-20, GRID * CELL + 20, 200000), rng.uniform(-20, GRID * CELL + 20, 200000)
+    assert len(index) == GRID * GRID + 2
+    assert (index.lookup(lon, lat, batch_size=50000) == expected(fids, band, lon, lat)).all()
+
+
+def test_lookup_boundaries(grid):
+    # Points on cell edges and corners get the lowest FID of the cells they touch
+    index, fids, band = grid
+    rng = np.random.RandomState(2)
+    i, j = rng.randint(1, GRID, 1000), rng.randint(1, GRID, 1000)
+    corners = index.lookup(i * CELL, j * CELL)
+    assert (corners == np.minimum.reduce([fids[i, j], fids[i - 1, j], fids[i, j - 1], fids[i - 1, j - 1]])).all()
+    edges = index.lookup(i * CELL, (j + 0.5) * CELL)
+    assert (edges == np.minimum(fids[i, j], fids[i - 1, j])).all()
+
+
+def test_lookup_values(grid):
+    index, fids, band = grid
+    assert index.lookup_values([CELL * 3.5, 1000], [CELL * 7.5, 0], 'code') == ['C{}'.format(fids[3, 7]), None]
+    with pytest.raises(KeyError):
+        index.lookup_values([0], [0], 'name')
+
+
+def test_tree_candidates_match_bounds():
+    rng = np.random.RandomState(3)
+    west, south = rng.uniform(0, 100, 5000), rng.uniform(0, 100, 5000)
+    bounds = np.column_stack([west, south, west + rng.exponential(2, 5000), south + rng.exponential(2, 5000)])
+    bounds[::97] = np.nan # Empty geometries
+    items, node_bounds, levels = pack_tree(bounds)
+    assert sorted(items.tolist()) == np.flatnonzero(~np.isnan(bounds[:, 0])).tolist()
+    assert levels[-1] - levels[-2] == 1 # A single root
+
+    index = RegionIndex.__new__(RegionIndex)
+    index.item_bounds, index.tree_items, index.tree_bounds, index.tree_levels = bounds[items], items, node_bounds, levels
+    x, y = rng.uniform(-5, 105, 2000), rng.uniform(-5, 105, 2000)
+    points, regions = index.candidates(x, y)
+    with np.errstate(invalid='ignore'):
+        inside = ((x[:, None] >= bounds[:, 0]) & (x[:, None] <= bounds[:, 2]) & (y[:, None] >= bounds[:, 1]) & (y[:, None] <= bounds[:, 3]))
+    assert sorted(zip(points.tolist(), regions.tolist())) == list(zip(*[a.tolist() for a in np.nonzero(inside)]))
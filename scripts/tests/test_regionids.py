@@ -0,0 +1,79 @@
+import gzip
+import json
+import os
+import random
+from collections import OrderedDict
+
+import pytest
+
+from regionids import RegionIdsWriter, compact_filename, decode_compact
+
+
+def write(tmp_path, values, order=None, compact=True):
+    'Write values (by FID) through a RegionIdsWriter, adding them in order (FIDs). Returns the writer and its filename'
+    filename = str(tmp_path / 'region_map-layer_prop.json')
+    writer = RegionIdsWriter(filename, 'layer', 'prop', len(values), compact, spool_dir=str(tmp_path))
+    for fid in (order if order is not None else range(len(values))):
+        if values[fid] is not None:
+            writer.set(fid, values[fid])
+    writer.close()
+    return writer, filename
+
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+@pytest.mark.parametrize('values, encoding', [
+    ([10, 11, 13, 12, 100, None, -5], 'delta'),
+    (['10', '11', '13', '9', None, '0'], 'delta'),
+    (['NSW', 'VIC', 'NSW', None, 'NSW', 'VIC', 'QLD', 'VIC', 'NSW', 'QLD'], 'dictionary'),
+    ([1.5, 1.5, 2.5, 1.5], 'dictionary'),
+    (['a', 'b', 'c', 'd'], None),
+    (['01', '02', '03', '04'], None), # Leading zeros wouldn't survive a delta encoding
+    ([True, False, True, 1], None),
+    ([1, True, 1.0, None, True, 1, 1.0], 'dictionary')
+])
+def test_compact_round_trip(tmp_path, values, encoding):
+    writer, filename = write(tmp_path, values)
+    plain = load(filename)
+    # Compared as JSON, as Python compares true, 1 and 1.0 equal
+    assert json.dumps(plain) == json.dumps(OrderedDict([('layer', 'layer'), ('property', 'prop'), ('values', values)]))
+    assert writer.encoding == encoding
+    if encoding is None:
+        assert not os.path.exists(compact_filename(filename))
+        return
+    compact = load(compact_filename(filename))
+    assert compact['encoding'] == encoding
+    assert json.dumps(decode_compact(compact)) == json.dumps(plain)
+    with gzip.open(compact_filename(filename) + '.gz', 'rt') as f:
+        assert json.load(f) == compact
+
+
+def test_compact_round_trip_out_of_order(tmp_path):
+    rng = random.Random(0)
+    values = [rng.choice([None, 'A', 'B', 'C']) for _ in range(50000)] # Spans several output chunks
+    order = list(range(len(values)))
+    rng.shuffle(order)
+    writer, filename = write(tmp_path, values, order)
+    assert writer.encoding == 'dictionary'
+    assert load(filename)['values'] == values
+    assert decode_compact(load(compact_filename(filename)))['values'] == values
+
+
+def test_delta_encoding_is_smaller(tmp_path):
+    values = list(range(1000000, 1010000))
+    writer, filename = write(tmp_path, values)
+    compact = load(compact_filename(filename))
+    assert compact['values'][:3] == [1000000, 1, 1]
+    assert os.path.getsize(compact_filename(filename)) < os.path.getsize(filename) / 2
+    assert decode_compact(compact)['values'] == values
+
+
+def test_stale_compact_files_removed(tmp_path):
+    _, filename = write(tmp_path, [1, 2, 3])
+    assert os.path.exists(compact_filename(filename))
+    write(tmp_path, ['a', 'b', 'c'])
+    assert not os.path.exists(compact_filename(filename))
+    assert not os.path.exists(compact_filename(filename) + '.gz')
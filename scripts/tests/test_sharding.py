@@ -0,0 +1,111 @@
+import random
+from collections import OrderedDict
+
+from sharding import Ring, assign, layer_weights, moved_layers, node_deployments, node_names, node_layers, shard, LOAD_FACTOR
+
+
+def sizes(count):
+    'Layer sizes with a long tail, like a real deployment'
+    return OrderedDict(('layer_{:03}'.format(i), 10**6 * (1 + 1000 // (i + 1))) for i in range(count))
+
+
+def even_sizes(count, seed=0):
+    'Layer sizes between 1 and 10MB'
+    rng = random.Random(seed)
+    return OrderedDict(('layer_{:03}'.format(i), rng.randint(1, 10) * 10**6) for i in range(count))
+
+
+def test_ring_is_stable():
+    ring = Ring(node_names(4))
+    assert list(ring.walk('layer')) == list(Ring(list(reversed(node_names(4)))).walk('layer'))
+    assert sorted(ring.walk('layer')) == node_names(4)
+
+
+def test_assignment_is_deterministic():
+    layer_sizes = sizes(200)
+    assignment, _ = shard(layer_sizes, 5)
+    reordered = OrderedDict(reversed(list(layer_sizes.items())))
+    assert shard(reordered, 5)[0] == assignment
+    assert shard(layer_sizes, 5, previous=assignment)[0] == assignment
+
+
+def test_loads_are_bounded():
+    layer_sizes = sizes(200)
+    for nodes in [2, 3, 5, 8]:
+        assignment, weights = shard(layer_sizes, nodes)
+        capacity = max(LOAD_FACTOR / nodes, max(weights.values()))
+        for layers in node_layers(assignment, node_names(nodes)).values():
+            assert sum(weights[layer] for layer in layers) <= capacity + 1e-9
+
+
+def test_adding_a_node_moves_few_layers():
+    layer_sizes = even_sizes(400)
+    for nodes in [2, 3, 4, 6, 9]:
+        previous, _ = shard(layer_sizes, nodes)
+        assignment, _ = shard(layer_sizes, nodes + 1, previous=previous)
+        moved = moved_layers(previous, assignment)
+        # About 1/(N + 1) of layers move, all of them to the new node
+        assert 0 < len(moved) <= 1.5 * len(layer_sizes) / (nodes + 1)
+        assert all(assignment[layer] == ['node-{}'.format(nodes)] for layer in moved)
+
+
+def test_adding_a_node_with_a_heavy_layer():
+    # Nodes over the new, lower load bound shed layers, but no more than the new node's share moves
+    layer_sizes = sizes(400)
+    for nodes in [3, 4, 6]:
+        previous, _ = shard(layer_sizes, nodes)
+        assignment, _ = shard(layer_sizes, nodes + 1, previous=previous)
+        assert len(moved_layers(previous, assignment)) <= 2 * len(layer_sizes) / (nodes + 1)
+
+
+def test_layers_stay_put_when_their_new_node_is_full():
+    # A heavy layer the ring puts on the new node fills it, so the light layers the ring also puts there stay where they were
+    ring = Ring(node_names(4))
+    heavy = next(layer for layer in ('heavy_{}'.format(i) for i in range(100)) if next(ring.walk(layer)) == 'node-3')
+    weights = OrderedDict([(heavy, 0.5)] + [('layer_{:02}'.format(i), 0.01) for i in range(50)])
+    previous = assign(weights, node_names(3), load_factor=2)
+    assignment = assign(weights, node_names(4), load_factor=2, previous=previous)
+    assert any(next(ring.walk(layer)) == 'node-3' for layer in weights if layer != heavy)
+    assert moved_layers(previous, assignment) == [heavy]
+
+
+def test_removing_a_node_only_moves_its_layers():
+    layer_sizes = even_sizes(400)
+    previous, _ = shard(layer_sizes, 5)
+    assignment, _ = shard(layer_sizes, 4, previous=previous)
+    removed = {layer for layer, layer_nodes in previous.items() if 'node-4' in layer_nodes}
+    assert set(moved_layers(previous, assignment)) == removed
+
+
+def test_hot_layers_are_replicated():
+    layer_sizes = sizes(50)
+    requests = {layer: 1 for layer in layer_sizes}
+    requests['layer_040'] = 100
+    assignment, _ = shard(layer_sizes, 4, requests)
+    assert len(assignment['layer_040']) == 2
+    assert len(set(assignment['layer_040'])) == 2
+    assert all(len(layer_nodes) == 1 for layer, layer_nodes in assignment.items() if layer != 'layer_040')
+
+
+def test_request_weights():
+    weights = layer_weights({'a': 3, 'b': 1}, {'a': 0, 'b': 10}, request_weight=0.5)
+    assert weights == OrderedDict([('a', 0.375), ('b', 0.625)])
+    assert layer_weights({'a': 3, 'b': 1}) == OrderedDict([('a', 0.75), ('b', 0.25)])
+
+
+def test_node_deployments():
+    deployment = {'data': {'a': 1, 'b': 2, 'c': 3}, 'priority': ['c', 'a'], 'deltas': {'b': {'from': 1, 'key': 'deltas/b-v1-v2.delta'}}}
+    assignment = OrderedDict([('a', ['node-0']), ('b', ['node-1']), ('c', ['node-0', 'node-1'])])
+    documents = node_deployments(deployment, assignment, node_names(2))
+    assert documents['node-0'] == OrderedDict([('data', OrderedDict([('a', 1), ('c', 3)])), ('node', 'node-0'), ('priority', ['c', 'a'])])
+    assert documents['node-1']['data'] == OrderedDict([('b', 2), ('c', 3)])
+    assert documents['node-1']['deltas'] == {'b': {'from': 1, 'key': 'deltas/b-v1-v2.delta'}}
+
+
+def test_assign_without_previous_matches_ring():
+    # With equal light layers and no load pressure, each layer goes to the first node clockwise from its hash
+    weights = OrderedDict(('layer_{}'.format(i), 0.001) for i in range(20))
+    nodes = node_names(3)
+    assignment = assign(weights, nodes, load_factor=100)
+    ring = Ring(nodes)
+    assert all(assignment[layer] == [next(ring.walk(layer))] for layer in weights)
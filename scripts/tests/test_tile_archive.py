@@ -0,0 +1,88 @@
+import gzip
+import random
+
+import numpy as np
+
+from mbtiles import flip_y
+from tile_archive import tile_ids, tile_id, encode_directory, decode_directory, export, TileArchive
+
+
+def test_tile_ids_match_tile_id():
+    for z in range(7):
+        xs, ys = np.meshgrid(np.arange(1 << z), np.arange(1 << z))
+        ids = tile_ids(z, xs.ravel(), ys.ravel())
+        assert ids.tolist() == [tile_id(z, x, y) for x, y in zip(xs.ravel().tolist(), ys.ravel().tolist())]
+
+
+def test_tile_ids_match_tile_id_at_high_zooms():
+    rng = random.Random(0)
+    for z in [12, 20, 26]:
+        xs = [rng.randrange(1 << z) for _ in range(500)]
+        ys = [rng.randrange(1 << z) for _ in range(500)]
+        assert tile_ids(z, xs, ys).tolist() == [tile_id(z, x, y) for x, y in zip(xs, ys)]
+
+
+def test_tile_ids_number_each_zoom_consecutively():
+    first = 0
+    for z in range(6):
+        xs, ys = np.meshgrid(np.arange(1 << z), np.arange(1 << z))
+        ids = np.sort(tile_ids(z, xs.ravel(), ys.ravel()))
+        assert ids.tolist() == list(range(first, first + (1 << (2 * z))))
+        first += 1 << (2 * z)
+
+
+def test_tile_ids_follow_a_curve():
+    # Consecutive tile IDs are neighbouring tiles
+    z = 5
+    xs, ys = np.meshgrid(np.arange(1 << z), np.arange(1 << z))
+    xs, ys = xs.ravel(), ys.ravel()
+    order = np.argsort(tile_ids(z, xs, ys))
+    steps = np.abs(np.diff(xs[order])) + np.abs(np.diff(ys[order]))
+    assert (steps == 1).all()
+
+
+def test_directory_round_trip():
+    rng = random.Random(0)
+    runs = []
+    tile, offset = 0, 0
+    for _ in range(1000):
+        tile += rng.randrange(1, 1000)
+        run_length = rng.randrange(1, 50)
+        length = rng.randrange(0, 5000)
+        runs.append([tile, run_length, offset, length])
+        tile += run_length
+        offset += length
+    directory = decode_directory(encode_directory(runs))
+    assert list(directory) == ['tile_id', 'run_length', 'offset', 'length']
+    assert np.array(list(directory.values())).T.tolist() == runs
+
+
+def test_directory_round_trip_large_values():
+    runs = [[0, 1, 0, 10], [2**40, 2**20, 2**35, 2**31]]
+    assert np.array(list(decode_directory(encode_directory(runs)).values())).T.tolist() == runs
+
+
+def test_empty_directory_round_trip():
+    directory = decode_directory(encode_directory([]))
+    assert all(len(column) == 0 for column in directory.values())
+
+
+def test_export_and_get(make_mbtiles, tmp_path):
+    # XYZ tiles, with a run of repeated (ocean) tiles and a missing tile
+    xyz = {(z, x, y): 'tile {}/{}/{}'.format(z, x, y).encode() for z in range(4) for x in range(1 << z) for y in range(1 << z)}
+    for x in range(4):
+        xyz[(3, x, 0)] = b'ocean'
+    del xyz[(3, 7, 7)]
+    mbtiles = make_mbtiles('layer.mbtiles', {(z, x, flip_y(z, y)): data for (z, x, y), data in xyz.items()}, {'name': 'layer', 'maxzoom': '3'})
+    archive_file = str(tmp_path / 'layer.tilepack')
+    tiles, distinct = export(mbtiles, archive_file)
+    assert (tiles, distinct) == (len(xyz), len(set(xyz.values())))
+
+    archive = TileArchive(archive_file)
+    assert (archive.min_zoom, archive.max_zoom) == (0, 3)
+    assert archive.metadata == {'name': 'layer', 'maxzoom': '3'}
+    for (z, x, y), data in xyz.items():
+        assert gzip.decompress(bytes(archive.get(z, x, y))) == data
+    assert archive.get(3, 7, 7) is None
+    assert archive.get(4, 0, 0) is None
+    assert archive.get(2, 4, 0) is None
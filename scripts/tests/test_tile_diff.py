@@ -0,0 +1,95 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import sys
+from contextlib import closing
+
+import pytest
+
+from compact_mbtiles import compact
+from mbtiles import open_mbtiles
+from tile_diff import diff, content_digest, write_hashes, invalidation_paths
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'server'))
+import mbtiles_delta # The server side of deltas, see server/download_data.py
+
+
+OLD = {(z, x, y): 'tile {}/{}/{}'.format(z, x, y).encode() for z in range(4) for x in range(1 << z) for y in range(1 << z)}
+NEW = dict(OLD)
+NEW.update({(3, 1, 1): b'changed', (3, 2, 2): b'changed', (4, 0, 0): b'added'})
+del NEW[(3, 7, 7)]
+
+
+def digest(filename):
+    with closing(open_mbtiles(filename)) as db:
+        return content_digest(db)
+
+
+def server_digest(filename):
+    with closing(sqlite3.connect(filename)) as db:
+        return mbtiles_delta.content_digest(db)
+
+
+@pytest.fixture
+def versions(make_mbtiles):
+    return make_mbtiles('old.mbtiles', OLD, {'name': 'layer', 'maxzoom': '3'}), make_mbtiles('new.mbtiles', NEW, {'name': 'layer', 'maxzoom': '4'})
+
+
+def test_diff_report(versions):
+    old, new = versions
+    report = diff(old, new)
+    assert report['total'] == {'changed': 2, 'added': 1, 'removed': 1, 'unchanged': len(OLD) - 3}
+    assert report['zooms']['4'] == {'changed': 0, 'added': 1, 'removed': 0, 'unchanged': 0}
+    # Tile lists are XYZ
+    assert report['tiles']['removed'] == [[3, 7, 0]]
+    assert sorted(invalidation_paths(report, 'layer')) == ['/layer/3/1/6.pbf', '/layer/3/2/5.pbf', '/layer/3/7/0.pbf']
+    assert report['digests'] == {'base': digest(old), 'target': digest(new)}
+
+
+def test_server_content_digest_matches(versions, tmp_path):
+    old, new = versions
+    compacted = str(tmp_path / 'compacted.mbtiles')
+    shutil.copyfile(old, compacted)
+    compact(compacted)
+    hashes = str(tmp_path / 'old.hashes')
+    write_hashes(old, hashes)
+    for filename in [old, new, compacted, hashes]:
+        assert server_digest(filename) == digest(filename) == (digest(new) if filename == new else digest(old))
+
+
+@pytest.mark.parametrize('compacted', [False, True])
+@pytest.mark.parametrize('from_hashes', [False, True])
+def test_apply_delta(versions, tmp_path, compacted, from_hashes):
+    old, new = versions
+    delta = str(tmp_path / 'old-new.delta')
+    if from_hashes:
+        hashes = str(tmp_path / 'old.hashes')
+        write_hashes(old, hashes)
+        diff(hashes, new, delta)
+    else:
+        diff(old, new, delta)
+    base = old
+    if compacted:
+        base = str(tmp_path / 'compacted.mbtiles')
+        shutil.copyfile(old, base)
+        compact(base)
+
+    output = str(tmp_path / 'applied.mbtiles')
+    mbtiles_delta.apply_delta(base, delta, output)
+    assert digest(output) == digest(new)
+    with closing(open_mbtiles(output)) as db:
+        tiles = {(z, x, y): mbtiles_delta.tile_hash(data) for z, x, y, data in db.execute('SELECT * FROM tiles')}
+    assert tiles == {tile: hashlib.md5(data).hexdigest() for tile, data in NEW.items()}
+
+
+def test_apply_delta_to_wrong_version(versions, make_mbtiles, tmp_path):
+    old, new = versions
+    delta = str(tmp_path / 'old-new.delta')
+    diff(old, new, delta)
+    other = make_mbtiles('other.mbtiles', OLD, {'name': 'layer', 'maxzoom': '2'}) # Same tiles, different metadata
+    output = str(tmp_path / 'applied.mbtiles')
+    with pytest.raises(IOError):
+        mbtiles_delta.apply_delta(other, delta, output)
+    assert not os.path.exists(output)
+    assert not os.path.exists(output + '.tmp')
@@ -0,0 +1,105 @@
+import struct
+
+import pytest
+
+from vector_tile import decode, count_vertices, DecodeError
+
+
+def varint(n):
+    out = bytearray()
+    while True:
+        out.append((n & 0x7f) | (0x80 if n > 0x7f else 0))
+        n >>= 7
+        if not n:
+            return bytes(out)
+
+
+def field(number, value):
+    'A protobuf field: varint for ints, length delimited for bytes and str'
+    if isinstance(value, int):
+        return varint(number << 3) + varint(value)
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return varint(number << 3 | 2) + varint(len(value)) + value
+
+
+def packed(number, values):
+    return field(number, b''.join(varint(v) for v in values))
+
+
+def zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+POINT = [9, zigzag(25), zigzag(17)] # MoveTo(25, 17), as in the vector tile spec
+SQUARE = [9, 0, 0, 26, zigzag(20), 0, 0, zigzag(20), zigzag(-20), 0, 15] # MoveTo, LineTo x 3, ClosePath
+LINE = [9, zigzag(2), zigzag(2), 18, zigzag(2), zigzag(2), zigzag(-2), zigzag(2)] # MoveTo, LineTo x 2
+
+# A tile with two layers: regions, with a value of every type, and an empty labels layer with a smaller extent
+TILE = (
+    field(3,
+        field(15, 2) + # Version
+        field(1, 'regions') +
+        field(2, field(1, 1) + packed(2, [0, 0, 1, 1, 2, 2]) + field(3, 1) + packed(4, POINT)) +
+        field(2, field(1, 2) + packed(2, [0, 3, 1, 4, 3, 5, 4, 6]) + field(3, 3) + packed(4, SQUARE)) +
+        field(2, packed(2, [5, 7, 6, 8]) + field(3, 2) + packed(4, LINE)) +
+        b''.join(field(3, key) for key in ['FID', 'name', 'area', 'neg', 'flag', 'f32', 'big']) +
+        field(4, field(5, 0)) + # uint FID
+        field(4, field(1, 'Sydney')) +
+        field(4, varint(3 << 3 | 1) + struct.pack('<d', 12.5)) + # double
+        field(4, field(5, 1)) +
+        field(4, field(1, 'Ålesund')) +
+        field(4, field(6, zigzag(-7))) + # sint
+        field(4, field(7, 1)) + # bool
+        field(4, varint(2 << 3 | 5) + struct.pack('<f', 0.5)) + # float
+        field(4, field(4, (1 << 64) - 3)) + # Negative int64
+        field(5, 4096)
+    ) +
+    field(3, field(15, 2) + field(1, 'labels') + field(5, 512))
+)
+
+
+def test_decode_known_tile():
+    regions, labels = decode(TILE)
+    assert (regions.name, regions.extent, len(regions.features)) == ('regions', 4096, 3)
+    assert (labels.name, labels.extent, labels.features) == ('labels', 512, [])
+    point, square, line = regions.features
+    assert (point.id, point.type, point.vertices) == (1, 1, 1)
+    assert point.properties == {'FID': 0, 'name': 'Sydney', 'area': 12.5}
+    assert (square.id, square.type, square.vertices) == (2, 3, 4)
+    assert square.properties == {'FID': 1, 'name': 'Ålesund', 'neg': -7, 'flag': True}
+    assert (line.id, line.type, line.vertices) == (None, 2, 3)
+    assert line.properties == {'f32': 0.5, 'big': -3}
+    assert isinstance(square.properties['flag'], bool)
+
+
+def test_decode_without_properties():
+    regions, _ = decode(TILE, properties=False)
+    assert [feature.properties for feature in regions.features] == [None, None, None]
+    assert [feature.vertices for feature in regions.features] == [1, 4, 3]
+
+
+def test_decode_memoryview_and_empty():
+    assert decode(memoryview(TILE))[0].features[1].properties['name'] == 'Ålesund'
+    assert decode(b'') == []
+
+
+def test_count_vertices():
+    assert count_vertices([]) == 0
+    assert count_vertices(SQUARE + SQUARE) == 8
+    with pytest.raises(DecodeError):
+        count_vertices([9, 0]) # Truncated
+    with pytest.raises(DecodeError):
+        count_vertices([12]) # Unknown command 4
+
+
+@pytest.mark.parametrize('data', [
+    TILE[:-3], # Truncated
+    field(3, field(1, 'x') + field(2, packed(2, [0]) + field(3, 1)) + field(3, 'k')), # Odd number of tags
+    field(3, field(1, 'x') + field(2, packed(2, [0, 1]) + field(3, 1)) + field(3, 'k') + field(4, field(5, 1))), # Value out of range
+    field(3, varint(1 << 3 | 3)), # Group wire type
+    field(3, b'\x08' + b'\xff' * 11) # Varint too long
+])
+def test_decode_errors(data):
+    with pytest.raises(DecodeError):
+        decode(data)
@@ -0,0 +1,43 @@
+import json
+import struct
+
+from test_vector_tile import field, packed, varint, POINT
+from verify_tiles import verify
+
+
+def double(value):
+    return field(4, varint(3 << 3 | 1) + struct.pack('<d', value))
+
+
+def regions_tile(fids, names):
+    'A tile with a point feature for each FID, written as a double as tippecanoe does for Real FID columns'
+    features = b''.join(field(2, packed(2, [0, i, 1, len(fids) + i]) + field(3, 1) + packed(4, POINT)) for i in range(len(fids)))
+    return field(3,
+        field(15, 2) + field(1, 'regions') + features +
+        field(3, 'FID') + field(3, 'name') +
+        b''.join(double(fid) for fid in fids) +
+        b''.join(field(4, field(1, name)) for name in names) +
+        field(5, 4096)
+    )
+
+
+def write_regionids(tmp_path, values):
+    with open(str(tmp_path / 'region_ids.json'), 'w') as f:
+        json.dump({'layer': 'regions', 'property': 'name', 'values': values}, f)
+    return 'region_ids.json'
+
+
+def test_verify_double_fids(tmp_path, make_mbtiles):
+    names = ['Sydney', 'Perth', 'Hobart']
+    mbtiles = make_mbtiles('regions.mbtiles', {(0, 0, 0): regions_tile([0.0, 1.0, 2.0], names)})
+    report = verify(mbtiles, 0, 'FID', 3, {'name': write_regionids(tmp_path, names)}, str(tmp_path), processes=1)
+    assert report['ok']
+    assert (report['missingFids'], report['fidsOutOfRange'], report['valueMismatches']['name']['count']) == (0, [], 0)
+
+
+def test_verify_fractional_fids(tmp_path, make_mbtiles):
+    names = ['Sydney', 'Perth']
+    mbtiles = make_mbtiles('regions.mbtiles', {(0, 0, 0): regions_tile([0.0, 1.5], names)})
+    report = verify(mbtiles, 0, 'FID', 2, {'name': write_regionids(tmp_path, names)}, str(tmp_path), processes=1)
+    assert not report['ok']
+    assert (report['missingFids'], report['fidsOutOfRange']) == (1, [-1])
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Single file tile archives (.tilepack), an alternative to serving tiles from mbtiles: a tile is found with a binary search of
+an in-memory directory and read as one contiguous slice of the file, instead of with an SQLite query, and an archive can be
+read in place from object storage with HTTP range requests instead of being downloaded first.
+
+Layout (integers little endian):
+
+- Header (HEADER_SIZE bytes): magic b'TILEPACK', format version, min and max zoom, then the offset and length of the
+  directory, metadata and tile data sections, the number of tiles and the number of distinct tiles
+- Tile data: each distinct tile once (as stored in the mbtiles, normally gzipped), in the order its first use appears in
+  tile ID order. A tile ID numbers tiles by zoom then along a Hilbert curve within the zoom (as in PMTiles), so tiles near
+  each other on the map are near each other in the file
+- Directory: runs of consecutive tile IDs with the same content, sorted by tile ID, as four columns (first tile ID, run
+  length, data offset, data length), zlib compressed with the tile ID and offset columns delta encoded
+- Metadata: the mbtiles metadata table as JSON
+
+    ./tile_archive.py export data/<layer>.mbtiles [data/<layer>.tilepack]
+    ./tile_archive.py get <archive file or URL> <z> <x> <y>
+    ./tile_archive.py serve <archive> [<archive> ...] [--port 8002]
+    ./tile_archive.py benchmark data/<layer>.mbtiles data/<layer>.tilepack [--url http://.../<layer>.tilepack]
+'''
+
+import argparse
+import http.client
+import json
+import mmap
+import os
+import random
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import closing
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from mbtiles import open_mbtiles, metadata, flip_y
+from tile_diff import tile_hashes
+from stats import percentile
+
+MAGIC = b'TILEPACK'
+VERSION = 1
+HEADER = struct.Struct('<8sHBB8Q')
+HEADER_SIZE = 128 # Room to add fields to the header
+DIRECTORY_COLUMNS = [('tile_id', np.uint64), ('run_length', np.uint32), ('offset', np.uint64), ('length', np.uint32)]
+
+
+def hilbert(z, x, y):
+    'Position of tiles (x, y) (NumPy arrays) along the Hilbert curve covering zoom z'
+    x, y = np.array(x, dtype=np.uint64), np.array(y, dtype=np.uint64)
+    d = np.zeros(x.shape, dtype=np.uint64)
+    last = np.uint64((1 << z) - 1)
+    s = (1 << z) >> 1
+    while s > 0:
+        rx = (x & np.uint64(s)) > 0
+        ry = (y & np.uint64(s)) > 0
+        d += np.uint64(s * s) * ((np.uint64(3) * rx) ^ ry).astype(np.uint64)
+        # Rotate the quadrant so the curve continues from the previous one
+        flip = rx & ~ry
+        x, y = np.where(flip, last - x, x), np.where(flip, last - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return d
+
+
+def tile_ids(z, x, y):
+    'Tile IDs of XYZ tiles (x, y) at zoom z: the number of tiles at lower zooms, plus the Hilbert position'
+    return np.uint64(((1 << (2 * z)) - 1) // 3) + hilbert(z, x, y)
+
+
+def tile_id(z, x, y):
+    'Tile ID of one XYZ tile, without the overhead of NumPy for a single tile'
+    d = 0
+    last = (1 << z) - 1
+    s = (1 << z) >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        if not ry:
+            if rx:
+                x, y = last - x, last - y
+            x, y = y, x
+        s >>= 1
+    return ((1 << (2 * z)) - 1) // 3 + d
+
+
+def export(mbtiles, output):
+    'Pack the tiles of an mbtiles file into an archive. Returns the number of tiles and distinct tiles'
+    temp = '{}.{}.tmp'.format(output, uuid.uuid4().hex)
+    try:
+        with closing(open_mbtiles(mbtiles)) as db, open(temp, 'wb') as f:
+            # Tile IDs and content hashes, with Hilbert positions computed a zoom at a time
+            coordinates, hashes = [], []
+            zooms = OrderedDict()
+            for z, x, y, tile_hash in tile_hashes(db):
+                coordinates.append((z, x, y))
+                hashes.append(tile_hash)
+                zoom_columns = zooms.setdefault(z, ([], []))
+                zoom_columns[0].append(x)
+                zoom_columns[1].append(flip_y(z, y))
+            ids = np.concatenate([tile_ids(z, xs, ys) for z, (xs, ys) in zooms.items()]) if zooms else np.zeros(0, dtype=np.uint64)
+            order = np.argsort(ids, kind='stable')
+
+            # Tile data, each distinct tile once, and runs of consecutive tile IDs with the same content
+            f.write(b'\0' * HEADER_SIZE)
+            data_offset = f.tell()
+            blobs = {} # Hash to (offset, length)
+            runs = []
+            for i in order.tolist():
+                tile_hash = hashes[i]
+                if tile_hash not in blobs:
+                    z, x, y = coordinates[i]
+                    data = db.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?', (z, x, y)).fetchone()[0]
+                    blobs[tile_hash] = (f.tell() - data_offset, len(data))
+                    f.write(data)
+                offset, length = blobs[tile_hash]
+                tile_id = int(ids[i])
+                if runs and runs[-1][0] + runs[-1][1] == tile_id and runs[-1][2] == offset:
+                    runs[-1][1] += 1
+                else:
+                    runs.append([tile_id, 1, offset, length])
+            data_length = f.tell() - data_offset
+
+            directory_offset = f.tell()
+            f.write(encode_directory(runs))
+            directory_length = f.tell() - directory_offset
+            metadata_offset = f.tell()
+            f.write(json.dumps(metadata(db)).encode('utf-8'))
+            metadata_length = f.tell() - metadata_offset
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, VERSION, min(zooms, default=0), max(zooms, default=0), directory_offset, directory_length,
+                                metadata_offset, metadata_length, data_offset, data_length, len(ids), len(blobs)))
+        os.replace(temp, output)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    return len(ids), len(blobs)
+
+
+def encode_directory(runs):
+    columns = np.array(runs, dtype=np.uint64).reshape(-1, 4).T
+    parts = []
+    for (name, dtype), column in zip(DIRECTORY_COLUMNS, columns):
+        column = column.astype(dtype)
+        if name in ('tile_id', 'offset'):
+            column = np.diff(column, prepend=dtype(0)).astype(dtype) # Small numbers compress better
+        parts.append(column.tobytes())
+    return zlib.compress(struct.pack('<Q', len(runs)) + b''.join(parts), 9)
+
+
+def decode_directory(data):
+    data = zlib.decompress(data)
+    count, = struct.unpack_from('<Q', data)
+    position = 8
+    columns = OrderedDict()
+    for name, dtype in DIRECTORY_COLUMNS:
+        column = np.frombuffer(data, dtype=dtype, count=count, offset=position)
+        position += column.nbytes
+        columns[name] = np.cumsum(column, dtype=dtype) if name in ('tile_id', 'offset') else column
+    return columns
+
+
+class FileSource:
+    'Reads an archive through mmap: tiles are zero-copy memoryview slices of the mapped file'
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+
+    def read(self, offset, length):
+        return self.view[offset:offset + length]
+
+
+class HTTPSource:
+    'Reads an archive with HTTP range requests (eg. from S3), with a persistent connection per thread'
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = parts.netloc
+        self.path = parts.path + ('?' + parts.query if parts.query else '')
+        self.local = threading.local()
+
+    def read(self, offset, length):
+        if length == 0:
+            return b''
+        for attempt in range(2): # Once more on a fresh connection if the kept alive one was closed
+            if not hasattr(self.local, 'connection'):
+                self.local.connection = self.connection_class(self.netloc, timeout=30)
+            try:
+                self.local.connection.request('GET', self.path, headers={'Range': 'bytes={}-{}'.format(offset, offset + length - 1)})
+                response = self.local.connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                self.local.connection.close()
+                del self.local.connection
+                if attempt:
+                    raise
+                continue
+            if response.status != 206 or len(data) != length:
+                raise IOError('Range request for bytes {}-{} of {} failed with status {}'.format(offset, offset + length - 1, self.path, response.status))
+            return data
+
+
+class TileArchive:
+    'Reads tiles from an archive file (through mmap) or URL (through HTTP range requests)'
+    def __init__(self, location):
+        self.source = HTTPSource(location) if location.startswith(('http://', 'https://')) else FileSource(location)
+        magic, version, self.min_zoom, self.max_zoom, directory_offset, directory_length, metadata_offset, metadata_length, \
+            self.data_offset, self.data_length, self.tiles, self.distinct_tiles = HEADER.unpack(bytes(self.source.read(0, HEADER.size)))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a version {} tile archive'.format(location, VERSION))
+        # Searched and indexed as lists, which is faster than NumPy for one tile at a time
+        directory = decode_directory(bytes(self.source.read(directory_offset, directory_length)))
+        self.ids, self.run_lengths, self.offsets, self.lengths = (column.tolist() for column in directory.values())
+        self.metadata = json.loads(bytes(self.source.read(metadata_offset, metadata_length)).decode('utf-8'))
+
+    def get(self, z, x, y):
+        'Data of XYZ tile (z, x, y) as stored (normally gzipped), or None if there is no such tile'
+        if not self.min_zoom <= z <= self.max_zoom or not (0 <= x < (1 << z) and 0 <= y < (1 << z)):
+            return None
+        target = tile_id(z, x, y)
+        i = bisect_right(self.ids, target) - 1
+        if i < 0 or target >= self.ids[i] + self.run_lengths[i]:
+            return None
+        return self.source.read(self.data_offset + self.offsets[i], self.lengths[i])
+
+
+def make_handler(archives):
+    class TileHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            parts = self.path.strip('/').split('/')
+            archive = archives.get(parts[0]) if len(parts) == 4 and parts[3].endswith('.pbf') else None
+            try:
+                data = archive.get(int(parts[1]), int(parts[2]), int(parts[3][:-len('.pbf')])) if archive is not None else None
+            except ValueError:
+                data = None
+            if data is None:
+                self.send_response(204) # As tilelive-bridge serves missing tiles
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-protobuf')
+            if bytes(data[:2]) == b'\x1f\x8b':
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+    return TileHandler
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def latencies(read, tiles):
+    'Sorted latencies in microseconds of reading each tile'
+    samples = []
+    for z, x, y in tiles:
+        start = time.perf_counter()
+        data = read(z, x, y)
+        bytes(data) # Include copying the tile out, as serving it would
+        samples.append((time.perf_counter() - start) * 1e6)
+    return sorted(samples)
+
+
+def benchmark(mbtiles, archive_locations, samples=10000, seed=0):
+    'Latency of reading random tiles of a layer from its mbtiles and from archives. Returns a report per reader'
+    with closing(open_mbtiles(mbtiles)) as db:
+        coordinates = db.execute('SELECT zoom_level, tile_column, tile_row FROM tiles').fetchall()
+        tiles = [(z, x, flip_y(z, y)) for z, x, y in random.Random(seed).choices(coordinates, k=samples)] if coordinates else []
+        readers = [('sqlite', lambda z, x, y: db.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?', (z, x, flip_y(z, y))).fetchone()[0])]
+        for location in archive_locations:
+            archive = TileArchive(location)
+            readers.append(('http range' if isinstance(archive.source, HTTPSource) else 'mmap', archive.get))
+        report = OrderedDict()
+        for name, read in readers:
+            read(*tiles[0]) # Warm up connections and caches
+            results = latencies(read, tiles)
+            report[name] = OrderedDict([('p50_us', percentile(results, 50)), ('p99_us', percentile(results, 99)),
+                                        ('mean_us', sum(results) / len(results)), ('reads_per_second', 1e6 * len(results) / sum(results))])
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    export_parser = subparsers.add_parser('export', help='Pack an mbtiles file into an archive')
+    export_parser.add_argument('mbtiles')
+    export_parser.add_argument('output', nargs='?', help='Archive to write (default: the mbtiles filename with a .tilepack extension)')
+    get_parser = subparsers.add_parser('get', help='Write a tile to stdout')
+    get_parser.add_argument('archive', help='Archive file or URL')
+    get_parser.add_argument('z', type=int)
+    get_parser.add_argument('x', type=int)
+    get_parser.add_argument('y', type=int)
+    serve_parser = subparsers.add_parser('serve', help='Serve tiles of archives at /<layer>/<z>/<x>/<y>.pbf')
+    serve_parser.add_argument('archives', nargs='+', help='Archive files or URLs, served as the layer named by their filename')
+    serve_parser.add_argument('--port', type=int, default=8002)
+    benchmark_parser = subparsers.add_parser('benchmark', help='Compare tile read latency of an mbtiles file and its archive')
+    benchmark_parser.add_argument('mbtiles')
+    benchmark_parser.add_argument('archive')
+    benchmark_parser.add_argument('--url', help='URL of the archive (eg. in S3) to also benchmark range reads from')
+    benchmark_parser.add_argument('--samples', type=int, default=10000)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        output = args.output or os.path.splitext(args.mbtiles)[0] + '.tilepack'
+        tiles, distinct = export(args.mbtiles, output)
+        print('Packed {} tiles ({} distinct) into {}: {:.1f}MB -> {:.1f}MB'.format(
+            tiles, distinct, output, os.path.getsize(args.mbtiles) / 1024**2, os.path.getsize(output) / 1024**2))
+    elif args.command == 'get':
+        data = TileArchive(args.archive).get(args.z, args.x, args.y)
+        if data is None:
+            raise SystemExit('No tile {}/{}/{}'.format(args.z, args.x, args.y))
+        sys.stdout.buffer.write(data)
+    elif args.command == 'serve':
+        archives = OrderedDict((os.path.splitext(os.path.basename(urlsplit(location).path))[0], TileArchive(location)) for location in args.archives)
+        print('Serving {} on port {}'.format(', '.join(archives), args.port))
+        ThreadingHTTPServer(('', args.port), make_handler(archives)).serve_forever()
+    elif args.command == 'benchmark':
+        report = benchmark(args.mbtiles, [args.archive] + ([args.url] if args.url else []), args.samples)
+        print('{:12}  {:>10}  {:>10}  {:>10}  {:>12}'.format('Reader', 'p50 (us)', 'p99 (us)', 'Mean (us)', 'Reads/s'))
+        for name, row in report.items():
+            print('{:12}  {p50_us:>10.1f}  {p99_us:>10.1f}  {mean_us:>10.1f}  {reads_per_second:>12.0f}'.format(name, **row))
+    else:
+        parser.print_help()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Tile level diff between two versions of a layer's mbtiles. Tiles are compared by a hash of their uncompressed content (the
+tile_id of files compacted by compact_mbtiles.py, which is the same hash), walking both files in tile order, so any size of
+layer can be compared without holding its tiles in memory. The diff counts changed, added, removed and unchanged tiles per
+zoom and lists the changed, added and removed tiles as XYZ [z, x, y].
+
+A delta package turns the old version into the new one: an SQLite file with the new metadata, the changed and added tiles
+(as stored in the new version), the removed tile coordinates, and the content digests of both versions. The server applies
+it to the old version (see apply_delta in server/mbtiles_delta.py) and checks the result's content digest, which covers
+every tile and the metadata but not the file's layout, so the result doesn't need to be byte identical to the new file.
+Building a delta doesn't read the old tiles, so the old version can be given as a hashes file (see write_hashes): its metadata
+and tile hashes, a small fraction of the size of the mbtiles.
+
+    ./tile_diff.py old.mbtiles new.mbtiles [--report diff.json] [--delta old-new.delta] [--paths paths.txt --layer <layer>]
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import uuid
+from collections import OrderedDict
+from contextlib import closing
+
+from mbtiles import open_mbtiles, decompress, metadata, flip_y
+
+STATUSES = ['changed', 'added', 'removed']
+
+DELTA_SCHEMA = '''
+CREATE TABLE metadata (name TEXT, value TEXT);
+CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+CREATE TABLE removed (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER);
+CREATE TABLE delta (name TEXT, value TEXT);
+'''
+
+# A hashes file is laid out like a compacted mbtiles without its images, so tile_hashes and content_digest read it as one
+HASHES_SCHEMA = '''
+CREATE TABLE metadata (name TEXT, value TEXT);
+CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);
+'''
+
+
+def tile_hashes(db):
+    '''
+    Yield (z, x, y, hash) for every tile in (zoom_level, tile_column, tile_row) order, with mbtiles (TMS) rows.
+    The hash is the MD5 of the uncompressed tile, read from the map table of compacted files instead of hashing tiles
+    '''
+    if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'map'").fetchone():
+        yield from db.execute('SELECT zoom_level, tile_column, tile_row, tile_id FROM map ORDER BY zoom_level, tile_column, tile_row')
+        return
+    for z, x, y, data in db.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY zoom_level, tile_column, tile_row'):
+        yield z, x, y, hashlib.md5(decompress(data)).hexdigest()
+
+
+def diff_tiles(old_db, new_db):
+    'Yield (status, z, x, y) for every tile that differs between two mbtiles, status being changed, added or removed, and (None, z, x, y) for unchanged tiles'
+    old_tiles, new_tiles = tile_hashes(old_db), tile_hashes(new_db)
+    old, new = next(old_tiles, None), next(new_tiles, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[:3] < new[:3]):
+            yield ('removed',) + old[:3]
+            old = next(old_tiles, None)
+        elif old is None or new[:3] < old[:3]:
+            yield ('added',) + new[:3]
+            new = next(new_tiles, None)
+        else:
+            yield ('changed' if old[3] != new[3] else None,) + new[:3]
+            old, new = next(old_tiles, None), next(new_tiles, None)
+
+
+def content_digest(db):
+    '''
+    SHA-256 of the metadata and every tile's coordinates and content hash, in tile order. Must match content_digest in
+    server/mbtiles_delta.py
+    '''
+    h = hashlib.sha256()
+    for name, value in sorted(metadata(db).items()):
+        h.update('{}={}\n'.format(name, value).encode('utf-8'))
+    for z, x, y, tile_hash in tile_hashes(db):
+        h.update('{}/{}/{}:{}\n'.format(z, x, y, tile_hash).encode('utf-8'))
+    return h.hexdigest()
+
+
+def write_hashes(mbtiles, filename):
+    'Write the metadata and tile hashes of an mbtiles to a hashes file, which diff takes in place of the old mbtiles'
+    temp = '{}.{}.tmp'.format(filename, uuid.uuid4().hex)
+    try:
+        with closing(open_mbtiles(mbtiles)) as db, closing(sqlite3.connect(temp)) as hashes_db:
+            hashes_db.executescript(HASHES_SCHEMA)
+            hashes_db.executemany('INSERT INTO metadata VALUES (?, ?)', db.execute('SELECT name, value FROM metadata'))
+            hashes_db.executemany('INSERT INTO map VALUES (?, ?, ?, ?)', tile_hashes(db))
+            hashes_db.commit()
+        os.replace(temp, filename)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+def diff(old, new, delta=None):
+    '''
+    Diff two mbtiles files, optionally writing a delta package turning old into new. old can be a hashes file of the old
+    version. Returns the diff report: counts per zoom, the changed, added and removed tiles (XYZ) and, with a delta, its
+    size and the content digests it checks
+    '''
+    zooms = {}
+    tiles = OrderedDict((status, []) for status in STATUSES)
+    temp = '{}.{}.tmp'.format(delta, uuid.uuid4().hex) if delta else None
+    try:
+        with closing(open_mbtiles(old)) as old_db, closing(open_mbtiles(new)) as new_db, closing(sqlite3.connect(temp or ':memory:')) as delta_db:
+            delta_db.executescript(DELTA_SCHEMA)
+            for status, z, x, y in diff_tiles(old_db, new_db):
+                counts = zooms.setdefault(z, OrderedDict((name, 0) for name in STATUSES + ['unchanged']))
+                counts[status or 'unchanged'] += 1
+                if status is None:
+                    continue
+                tiles[status].append([z, x, flip_y(z, y)])
+                if delta is None:
+                    continue
+                if status == 'removed':
+                    delta_db.execute('INSERT INTO removed VALUES (?, ?, ?)', (z, x, y))
+                else:
+                    data = new_db.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?', (z, x, y)).fetchone()[0]
+                    delta_db.execute('INSERT INTO tiles VALUES (?, ?, ?, ?)', (z, x, y, data))
+            digests = OrderedDict([('base', content_digest(old_db)), ('target', content_digest(new_db))])
+            if delta is not None:
+                delta_db.executemany('INSERT INTO metadata VALUES (?, ?)', new_db.execute('SELECT name, value FROM metadata'))
+                delta_db.executemany('INSERT INTO delta VALUES (?, ?)', digests.items())
+                delta_db.commit()
+                delta_db.execute('VACUUM')
+        if delta is not None:
+            os.replace(temp, delta)
+    finally:
+        if temp is not None and os.path.exists(temp):
+            os.remove(temp)
+    report = OrderedDict([
+        ('old', old),
+        ('new', new),
+        ('digests', digests),
+        ('zooms', OrderedDict((str(z), zooms[z]) for z in sorted(zooms))),
+        ('total', OrderedDict((name, sum(counts[name] for counts in zooms.values())) for name in STATUSES + ['unchanged'])),
+        ('tiles', tiles)
+    ])
+    if delta is not None:
+        report['delta'] = OrderedDict([('file', delta), ('size', os.path.getsize(delta)), ('new_size', os.path.getsize(new))])
+    return report
+
+
+def invalidation_paths(report, layer_name):
+    'Tile URL paths (/<layer>/z/x/y.pbf) of the changed and removed tiles in a diff report, to invalidate in caches'
+    return ['/{}/{}/{}/{}.pbf'.format(layer_name, z, x, y) for status in ['changed', 'removed'] for z, x, y in report['tiles'][status]]
+
+
+def format_report(report):
+    lines = ['{:>4}  {:>9}  {:>9}  {:>9}  {:>9}'.format('Zoom', 'Changed', 'Added', 'Removed', 'Unchanged')]
+    for z, counts in list(report['zooms'].items()) + [('All', report['total'])]:
+        lines.append('{:>4}  {changed:>9}  {added:>9}  {removed:>9}  {unchanged:>9}'.format(z, **counts))
+    if 'delta' in report:
+        lines.append('Delta package {file}: {:.2f}MB ({:.1%} of the new version)'.format(
+            report['delta']['size'] / 1024**2, report['delta']['size'] / max(report['delta']['new_size'], 1), **report['delta']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('old', help='mbtiles of the old version')
+    parser.add_argument('new', help='mbtiles of the new version')
+    parser.add_argument('--report', help='Write the diff report (counts per zoom and tile lists) to this JSON file')
+    parser.add_argument('--delta', help='Write a delta package turning the old version into the new one to this file')
+    parser.add_argument('--paths', help='Write the tile URL paths to invalidate to this file, one per line (needs --layer)')
+    parser.add_argument('--layer', help='Layer name used in tile URL paths')
+    args = parser.parse_args()
+    if args.paths and not args.layer:
+        parser.error('--paths needs --layer')
+
+    report = diff(args.old, args.new, args.delta)
+    print(format_report(report))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f)
+    if args.paths:
+        with open(args.paths, 'w') as f:
+            f.writelines(path + '\n' for path in invalidation_paths(report, args.layer))
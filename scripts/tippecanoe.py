@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'Tippecanoe command lines, shared by create_layer.py and the scripts that tile layers outside a full build'
+
+import os
+
+
+def tippecanoe_args(layer_name, tile_settings, geojson_files=None, output=None, zoom_range=None):
+    '''
+    Tippecanoe command line for a layer with tile_settings (maxzoom, detail and simplification, see auto_tune.py).
+    Without geojson_files, tippecanoe reads line-delimited GeoJSON from stdin. With a zoom_range (min zoom, max zoom),
+    only part of the layer's zoom levels are made, but features are dropped as they would be for the whole layer
+    '''
+    args = ['tippecanoe', '-q', '-f']
+    if geojson_files is not None:
+        args.append('-P') # Parallel reading needs a seekable file
+    args += [
+        '-pp',
+        '-pS',
+        '-l', layer_name,
+        '-z', str(tile_settings['maxzoom']), # Max zoom
+        '-d', str(tile_settings['detail']) # Detail
+    ]
+    if zoom_range is not None:
+        args[args.index('-z') + 1] = str(zoom_range[1])
+        args += ['-Z', str(zoom_range[0]), '-B', str(tile_settings['maxzoom'])] # Min zoom, and base zoom of the whole layer
+    if tile_settings['simplification'] != 1:
+        args += ['-S', str(tile_settings['simplification'])]
+    args += ['-o', './{0}'.format(output or os.path.join('data', '{}.mbtiles'.format(layer_name)))]
+    if geojson_files is not None:
+        args += geojson_files
+    return args
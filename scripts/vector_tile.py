@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'Minimal Mapbox Vector Tile (protobuf) decoder, enough to inspect the tiles tippecanoe makes without extra dependencies'
+
+import struct
+from collections import namedtuple
+
+Layer = namedtuple('Layer', ['name', 'extent', 'features'])
+Feature = namedtuple('Feature', ['id', 'type', 'properties', 'vertices'])
+
+MOVE_TO, LINE_TO, CLOSE_PATH = 1, 2, 7
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def _varint(buf, pos):
+    result = shift = 0
+    while True:
+        if pos >= len(buf):
+            raise DecodeError('Truncated varint')
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise DecodeError('Varint too long')
+
+
+def _fields(buf):
+    'Yield (field number, wire type, value) for each field in a message. Length delimited values are bytes'
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _varint(buf, pos)
+        elif wire_type == 1:
+            value, pos = buf[pos:pos + 8], pos + 8
+        elif wire_type == 2:
+            length, pos = _varint(buf, pos)
+            value, pos = buf[pos:pos + length], pos + length
+        elif wire_type == 5:
+            value, pos = buf[pos:pos + 4], pos + 4
+        else:
+            raise DecodeError('Unsupported wire type {}'.format(wire_type))
+        if pos > end:
+            raise DecodeError('Truncated field {}'.format(field))
+        yield field, wire_type, value
+
+
+def _packed(buf):
+    values = []
+    pos = 0
+    while pos < len(buf):
+        value, pos = _varint(buf, pos)
+        values.append(value)
+    return values
+
+
+def _zigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def _value(buf):
+    for field, _, value in _fields(buf):
+        if field == 1:
+            return bytes(value).decode('utf-8')
+        if field == 2:
+            return struct.unpack('<f', value)[0]
+        if field == 3:
+            return struct.unpack('<d', value)[0]
+        if field == 4:
+            return value - (1 << 64) if value >= 1 << 63 else value
+        if field == 5:
+            return value
+        if field == 6:
+            return _zigzag(value)
+        if field == 7:
+            return bool(value)
+    return None
+
+
+def count_vertices(geometry):
+    'Number of vertices in a geometry command stream'
+    vertices = 0
+    i = 0
+    while i < len(geometry):
+        command, count = geometry[i] & 7, geometry[i] >> 3
+        i += 1
+        if command in (MOVE_TO, LINE_TO):
+            vertices += count
+            i += 2 * count
+        elif command != CLOSE_PATH:
+            raise DecodeError('Unknown geometry command {}'.format(command))
+    if i != len(geometry):
+        raise DecodeError('Truncated geometry')
+    return vertices
+
+
+def _feature(buf, keys, values, properties):
+    fid = None
+    geometry_type = 0
+    tags = []
+    vertices = 0
+    for field, _, value in _fields(buf):
+        if field == 1:
+            fid = value
+        elif field == 2:
+            tags = _packed(value)
+        elif field == 3:
+            geometry_type = value
+        elif field == 4:
+            vertices = count_vertices(_packed(value))
+    props = None
+    if properties:
+        if len(tags) % 2:
+            raise DecodeError('Odd number of feature tags')
+        props = {keys[tags[i]]: values[tags[i + 1]] for i in range(0, len(tags), 2)}
+    return Feature(fid, geometry_type, props, vertices)
+
+
+def _layer(buf, properties):
+    name = None
+    extent = 4096
+    keys = []
+    values = []
+    feature_bufs = []
+    for field, _, value in _fields(buf):
+        if field == 1:
+            name = bytes(value).decode('utf-8')
+        elif field == 2:
+            feature_bufs.append(value)
+        elif field == 3:
+            keys.append(bytes(value).decode('utf-8'))
+        elif field == 4:
+            values.append(_value(value))
+        elif field == 5:
+            extent = value
+    try:
+        features = [_feature(f, keys, values, properties) for f in feature_bufs]
+    except IndexError:
+        raise DecodeError('Feature tag out of range')
+    return Layer(name, extent, features)
+
+
+def decode(data, properties=True):
+    'Decode an uncompressed vector tile into a list of Layers. Skip decoding feature properties if properties is False'
+    data = memoryview(data)
+    return [_layer(value, properties) for field, _, value in _fields(data) if field == 3]
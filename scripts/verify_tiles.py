@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# Written for Python 3.6
+'''
+Verify the tiles of data/<layer>.mbtiles before publishing, against what TerriaJS region mapping relies on:
+
+- every tile decodes (is valid gzip and protobuf)
+- at serverMaxNativeZoom, every FID from 0 to the number of features - 1 is in some tile, and no tile has FIDs outside that
+- the regionProp (and disambigProp) of each feature there matches the value at its FID in the regionid file
+- no tile is at tippecanoe's feature count or size limit, where it starts dropping features or failing
+
+Tile columns are split between worker processes, as in profile_tiles.py, with properties only decoded at
+serverMaxNativeZoom. Reads output_files/regionMapping-<layer>.json and the regionid files, prints a report and writes it to
+output_files/verify-<layer>.json. Exits with an error if any check fails
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import closing
+from multiprocessing import Pool
+
+import numpy as np
+
+from mbtiles import open_mbtiles, decompress, tile_columns, batches, column_tiles
+from match_regions import load_regionids
+from vector_tile import decode
+
+BATCH_SIZE = 16 # Tile columns per worker task
+FEATURE_LIMIT = 200000 # tippecanoe's default maximum features per tile
+TILE_SIZE_LIMIT = 500 * 1024 # tippecanoe's default maximum compressed tile size
+LIMIT_MARGIN = 0.95 # Share of a limit counted as hitting it, as compacting recompresses tiles
+EXAMPLES = 10 # Examples kept of each kind of problem
+
+_columns = {} # Regionid values of each checked property, loaded once per worker
+
+
+def _load_columns(regionids_dir, regionids_files):
+    global _columns
+    _columns = OrderedDict((column, load_regionids(regionids_dir, filename)) for column, filename in regionids_files.items())
+
+
+def same_value(value, expected):
+    'Whether a tile property matches a regionid value (tippecanoe leaves out null properties and may retype numbers)'
+    if expected is None:
+        return value is None
+    return value == expected or str(value) == str(expected)
+
+
+def verify_batch(args):
+    'Check the tiles in a batch of tile columns. Runs in a worker process'
+    mbtiles, columns, max_zoom, fid_property = args
+    tiles = 0
+    fids = []
+    corrupt = []
+    limits = []
+    mismatches = OrderedDict((column, [0, []]) for column in _columns) # Count and examples
+    with closing(open_mbtiles(mbtiles)) as db:
+        for z, x, y, data in column_tiles(db, columns):
+            tiles += 1
+            properties = z == max_zoom
+            try:
+                layers = decode(decompress(data), properties)
+            except (ValueError, zlib.error) as err:
+                corrupt.append([z, x, y, str(err)])
+                continue
+            features = sum(len(layer.features) for layer in layers)
+            if features >= FEATURE_LIMIT * LIMIT_MARGIN or len(data) >= TILE_SIZE_LIMIT * LIMIT_MARGIN:
+                limits.append([z, x, y, features, len(data)])
+            if not properties:
+                continue
+            for layer in layers:
+                for feature in layer.features:
+                    fid = feature.properties.get(fid_property)
+                    if isinstance(fid, float) and fid.is_integer():
+                        fid = int(fid) # Real FID columns are written as doubles
+                    elif not isinstance(fid, int) or isinstance(fid, bool):
+                        fid = -1 # Counted as an FID out of range
+                    fids.append(fid)
+                    for column, values in _columns.items():
+                        value = feature.properties.get(column)
+                        if 0 <= fid < len(values) and not same_value(value, values[fid]):
+                            mismatch = mismatches[column]
+                            mismatch[0] += 1
+                            if len(mismatch[1]) < EXAMPLES:
+                                mismatch[1].append([z, x, y, fid, value, values[fid]])
+    return tiles, np.unique(np.array(fids, dtype=np.int64)), corrupt, limits, mismatches
+
+
+def ranges(values):
+    'Sorted integers as [first, last] ranges of consecutive values'
+    if len(values) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(values) != 1)
+    starts = np.concatenate([[0], breaks + 1])
+    ends = np.concatenate([breaks, [len(values) - 1]])
+    return [[int(values[start]), int(values[end])] for start, end in zip(starts, ends)]
+
+
+def verify(mbtiles, max_zoom, fid_property, num_features, regionids_files=None, regionids_dir='output_files', processes=None):
+    '''
+    Verify an mbtiles file, with the FIDs at max_zoom in property fid_property numbering num_features features, and the
+    properties in regionids_files ({property: regionIdsFile}) matching their regionid files. Returns a report
+    '''
+    regionids_files = regionids_files or {}
+    start = time.time()
+    with closing(open_mbtiles(mbtiles)) as db:
+        tasks = [(mbtiles, columns, max_zoom, fid_property) for columns in batches(tile_columns(db), BATCH_SIZE)]
+    tiles = 0
+    seen = np.zeros(num_features, dtype=bool)
+    out_of_range = []
+    corrupt = []
+    limits = []
+    mismatches = OrderedDict((column, [0, []]) for column in regionids_files)
+    with Pool(processes, _load_columns, (regionids_dir, regionids_files)) as pool:
+        for batch_tiles, fids, batch_corrupt, batch_limits, batch_mismatches in pool.imap_unordered(verify_batch, tasks):
+            tiles += batch_tiles
+            in_range = (fids >= 0) & (fids < num_features)
+            seen[fids[in_range]] = True
+            out_of_range.extend(fids[~in_range].tolist())
+            corrupt.extend(batch_corrupt)
+            limits.extend(batch_limits)
+            for column, (count, examples) in batch_mismatches.items():
+                mismatches[column][0] += count
+                mismatches[column][1] = (mismatches[column][1] + examples)[:EXAMPLES]
+    seconds = time.time() - start
+
+    missing = np.flatnonzero(~seen)
+    report = OrderedDict([
+        ('mbtiles', mbtiles),
+        ('maxNativeZoom', max_zoom),
+        ('fidProperty', fid_property),
+        ('features', num_features),
+        ('tiles', tiles),
+        ('seconds', seconds),
+        ('tilesPerSecond', tiles / seconds if seconds else None),
+        ('missingFids', len(missing)),
+        ('missingFidRanges', ranges(missing)),
+        ('fidsOutOfRange', sorted(set(out_of_range))),
+        ('corruptTiles', [OrderedDict(zip(['z', 'x', 'y', 'error'], tile)) for tile in sorted(corrupt)]),
+        ('tilesAtLimits', [OrderedDict(zip(['z', 'x', 'y', 'features', 'bytes'], tile)) for tile in sorted(limits)]),
+        ('valueMismatches', OrderedDict((column, OrderedDict([
+            ('count', count),
+            ('examples', [OrderedDict(zip(['z', 'x', 'y', 'fid', 'value', 'expected'], example)) for example in examples])
+        ])) for column, (count, examples) in mismatches.items()))
+    ])
+    report['ok'] = not (report['missingFids'] or report['fidsOutOfRange'] or report['corruptTiles'] or report['tilesAtLimits'] or
+                        any(mismatch['count'] for mismatch in report['valueMismatches'].values()))
+    return report
+
+
+def format_report(report):
+    lines = ['{tiles} tiles checked in {seconds:.1f}s ({rate:.0f} tiles/s), {features} features at zoom {maxNativeZoom}'.format(
+        rate=report['tilesPerSecond'] or 0, **report)]
+    if report['missingFids']:
+        shown = ', '.join('{}-{}'.format(*r) if r[0] != r[1] else str(r[0]) for r in report['missingFidRanges'][:EXAMPLES])
+        lines.append('{} FIDs are in no tile: {}{}'.format(report['missingFids'], shown, ', ...' if len(report['missingFidRanges']) > EXAMPLES else ''))
+    if report['fidsOutOfRange']:
+        lines.append('FIDs outside 0-{} (-1 for features without an integer {}): {}'.format(report['features'] - 1, report['fidProperty'], report['fidsOutOfRange'][:EXAMPLES]))
+    for column, mismatch in report['valueMismatches'].items():
+        if mismatch['count']:
+            lines.append('{} features have a {} different to their regionid value, eg. {}'.format(mismatch['count'], column,
+                ', '.join('FID {fid}: {value!r} != {expected!r}'.format(**example) for example in mismatch['examples'][:3])))
+    if report['corruptTiles']:
+        lines.append('{} tiles could not be decoded: {}'.format(len(report['corruptTiles']), ', '.join('{z}/{x}/{y} ({error})'.format(**tile) for tile in report['corruptTiles'][:EXAMPLES])))
+    if report['tilesAtLimits']:
+        lines.append('{} tiles are at tippecanoe\'s feature or size limit: {}'.format(len(report['tilesAtLimits']),
+            ', '.join('{z}/{x}/{y} ({features} features, {bytes} bytes)'.format(**tile) for tile in report['tilesAtLimits'][:EXAMPLES])))
+    lines.append('OK' if report['ok'] else 'FAILED')
+    return '\n'.join(lines)
+
+
+def verify_layer(layer_name, num_features=None, processes=None, output_dir='output_files'):
+    '''
+    Verify data/<layer>.mbtiles against output_dir/regionMapping-<layer>.json and the regionid files it names, writing the
+    report to output_dir/verify-<layer>.json. num_features defaults to the length of the regionid files. Returns the report
+    '''
+    with open(os.path.join(output_dir, 'regionMapping-{}.json'.format(layer_name))) as f:
+        entries = list(json.load(f)['regionWmsMap'].values())
+    if not entries:
+        raise ValueError('regionMapping-{}.json has no entries'.format(layer_name))
+    regionids_files = OrderedDict()
+    for entry in entries:
+        regionids_files[entry['regionProp']] = entry['regionIdsFile']
+        if entry.get('disambigProp'):
+            regionids_files[entry['disambigProp']] = entry['regionDisambigIdsFile']
+    if num_features is None:
+        num_features = len(load_regionids(output_dir, next(iter(regionids_files.values()))))
+    report = verify(os.path.join('data', '{}.mbtiles'.format(layer_name)), entries[0]['serverMaxNativeZoom'], entries[0]['uniqueIdProp'],
+                    num_features, regionids_files, output_dir, processes)
+    with open(os.path.join(output_dir, 'verify-{}.json'.format(layer_name)), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('layers', nargs='+', help='Names of layers to verify from data/<layer>.mbtiles')
+    parser.add_argument('--processes', type=int, help='Number of worker processes (default: number of cores)')
+    args = parser.parse_args()
+    failed = []
+    for layer_name in args.layers:
+        report = verify_layer(layer_name, processes=args.processes)
+        print(layer_name)
+        print(format_report(report))
+        if not report['ok']:
+            failed.append(layer_name)
+    if failed:
+        sys.exit('Layers failing verification: {}'.format(', '.join(failed)))
@@ -1,34 +1,477 @@
 #!/usr/bin/env python
 
 # Written for Python 2.7
-import os, sys, json
+'''
+Download the configs and mbtiles of a deployment to /etc/vector-tiles.
+Files are downloaded in parallel ranged parts with retries, resumed if a previous attempt was interrupted and verified
+against the checksums recorded when they were published. Layer versions already in the cache directory (or in a previous
+deployment) are hard linked instead of downloaded again.
+Layers are downloaded in priority order (--priority, or "priority" in the deployment, then smallest first), and each is made
+ready as soon as it is verified: its mbtiles then config are linked into place and <root>/ready/<layer> is written. The server
+can be started (--serve-command) once the priority layers are ready, and restarted (--restart-command) to pick up the rest
+once every layer is. If the download fails before the server was started, it is started with the layers already in place.
+Ready mbtiles are read into the OS page cache: all of small files, and the hot zoom levels or tile ranges of large ones
+(--hot-tiles). Boot timings are logged and written to <root>/boot-metrics.json.
+When the deployment lists a delta package for a layer (see scripts/publish.py) and the version it applies to is in the cache
+directory or previous deployment, the delta is downloaded and applied instead of the whole mbtiles.
+A server of a sharded deployment (--node, see scripts/sharding.py) downloads only its node's layers, from the node's
+deployment document
+'''
+from __future__ import print_function
+
+import os, sys, json, argparse, hashlib, errno, threading, time, sqlite3, subprocess, urllib2
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
 import boto # Boto is included on Amazon Linux, Boto3 isn't
 from boto.s3.key import Key
 
-conn = boto.connect_s3()
-bucket = conn.get_bucket('vector-tile-server')
+from mbtiles_delta import apply_delta
+
+BUCKET = 'vector-tile-server'
+ROOT = '/etc/vector-tiles'
+PART_SIZE = 32 * 1024 * 1024
+RETRIES = 5
+WARM_FULL_LIMIT = 256 * 1024 * 1024 # mbtiles up to this size are read into the page cache in full
+WARM_ZOOM = 8 # Zoom levels up to this are warmed in larger mbtiles without hot tiles listed
+PROBE_TIMEOUT = 120
+
+thread_local = threading.local()
+
+def get_bucket():
+    'Bucket for the current thread (boto connections are not thread safe)'
+    if not hasattr(thread_local, 'bucket'):
+        thread_local.bucket = boto.connect_s3().get_bucket(BUCKET, validate=False)
+    return thread_local.bucket
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as err:
+        if not (err.errno == errno.EEXIST and os.path.isdir(path)):
+            raise
+
+def file_hash(filename, algorithm):
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def link(source, destination):
+    'Hard link source to destination, replacing destination'
+    temp = destination + '.tmp'
+    if os.path.exists(temp):
+        os.remove(temp)
+    os.link(source, temp)
+    os.rename(temp, destination)
+
+
+class Download(object):
+    'A file downloaded in ranged parts to filename, with completed parts recorded so an interrupted download can resume'
+    def __init__(self, key_name, filename):
+        key = get_bucket().get_key(key_name)
+        if key is None:
+            raise IOError('s3://{}/{} does not exist'.format(BUCKET, key_name))
+        self.key_name = key_name
+        self.filename = filename
+        self.size = key.size
+        self.etag = key.etag.strip('"')
+        self.sha256 = key.get_metadata('sha256') # Recorded by scripts/publish.py
+        self.part_filename = filename + '.part'
+        self.state_filename = filename + '.part.json'
+        self.parts = [(start, min(start + PART_SIZE, self.size) - 1) for start in range(0, self.size, PART_SIZE)] or [(0, -1)]
+        self.lock = threading.Lock()
+        self.completed = self.load_state()
+        if not self.completed or not os.path.exists(self.part_filename):
+            self.completed = set()
+            with open(self.part_filename, 'wb') as f:
+                f.truncate(self.size)
+
+    def load_state(self):
+        'Completed parts of a previous attempt at downloading the same object'
+        try:
+            with open(self.state_filename) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return set()
+        if state.get('etag') != self.etag or state.get('size') != self.size:
+            return set()
+        return set(state['completed'])
+
+    def save_state(self):
+        with open(self.state_filename + '.tmp', 'w') as f:
+            json.dump({'etag': self.etag, 'size': self.size, 'completed': sorted(self.completed)}, f)
+        os.rename(self.state_filename + '.tmp', self.state_filename)
+
+    def missing_parts(self):
+        return [i for i in range(len(self.parts)) if i not in self.completed]
+
+    def download_part(self, i):
+        start, end = self.parts[i]
+        for attempt in range(RETRIES):
+            try:
+                if end >= start:
+                    key = Key(get_bucket(), self.key_name)
+                    with open(self.part_filename, 'r+b') as f:
+                        f.seek(start)
+                        key.get_contents_to_file(f, headers={'Range': 'bytes={}-{}'.format(start, end)})
+                        if f.tell() != end + 1:
+                            raise IOError('Short read of {} bytes {}-{}'.format(self.key_name, start, end))
+                with self.lock:
+                    self.completed.add(i)
+                    self.save_state()
+                return
+            except Exception as err:
+                print('Download of {} bytes {}-{} failed (attempt {}): {}'.format(self.key_name, start, end, attempt + 1, err))
+                time.sleep(2 ** attempt)
+        raise IOError('Giving up on {} after {} attempts'.format(self.key_name, RETRIES))
+
+    def verify(self):
+        'Check the downloaded file against its published SHA-256, or its ETag if that is an MD5 (single part uploads)'
+        if self.sha256:
+            return file_hash(self.part_filename, 'sha256') == self.sha256
+        if '-' not in self.etag:
+            return file_hash(self.part_filename, 'md5') == self.etag
+        print('No checksum available for {}, only checking its size'.format(self.key_name))
+        return os.path.getsize(self.part_filename) == self.size
+
+    def finish(self):
+        if not self.verify():
+            os.remove(self.part_filename)
+            os.remove(self.state_filename)
+            raise IOError('Checksum mismatch for {}'.format(self.key_name))
+        os.rename(self.part_filename, self.filename)
+        os.remove(self.state_filename)
+
+
+class DeltaDownload(Download):
+    'A delta package downloaded and applied to an earlier version of a layer, to give the mbtiles of the new version'
+    def __init__(self, key_name, filename, base, target, full_key_name):
+        Download.__init__(self, key_name, filename)
+        self.base = base
+        self.target = target
+        self.full_key_name = full_key_name
+
+    def finish(self):
+        Download.finish(self)
+        try:
+            apply_delta(self.base, self.filename, self.target)
+            print('Applied {} to {}'.format(self.key_name, self.base))
+        except (IOError, sqlite3.Error) as err:
+            print('Could not apply {} ({}), downloading {} instead'.format(self.key_name, err, self.full_key_name))
+            download = Download(self.full_key_name, self.target)
+            for i in download.missing_parts():
+                download.download_part(i)
+            download.finish()
+        finally:
+            os.remove(self.filename)
+
+
+def previous_file(previous, layer, version, kind):
+    'Path of a layer version in a previous deployment directory, if it has the same version'
+    if not previous:
+        return None
+    try:
+        with open(os.path.join(previous, 'data.json')) as f:
+            if json.load(f)['data'].get(layer) != version:
+                return None
+    except (IOError, ValueError, KeyError):
+        return None
+    filename = os.path.join(previous, kind, '{}.{}'.format(layer, 'json' if kind == 'config' else 'mbtiles'))
+    return filename if os.path.exists(filename) else None
+
+
+def cached_file(cache_dir, layer, version):
+    'Path of the mbtiles of a layer version in the cache directory, if it is there'
+    filename = os.path.join(cache_dir, '{}-v{}.mbtiles'.format(layer, version))
+    return filename if os.path.exists(filename) else None
+
+
+def uptime():
+    'Seconds since the instance booted'
+    try:
+        with open('/proc/uptime') as f:
+            return float(f.read().split()[0])
+    except (IOError, ValueError):
+        return None
+
+
+class Metrics(object):
+    'Boot timings, logged as they happen and written to a JSON file'
+    def __init__(self, filename):
+        self.filename = filename
+        self.start = time.time()
+        self.start_uptime = uptime()
+        self.lock = threading.Lock()
+        self.values = {'layers': {}}
+
+    def record(self, name, layer=None):
+        with self.lock:
+            seconds = round(time.time() - self.start, 3)
+            if layer is not None:
+                self.values['layers'].setdefault(layer, {})[name] = seconds
+                print('METRIC {} {} {}s'.format(layer, name, seconds))
+            elif name not in self.values:
+                self.values[name] = seconds
+                print('METRIC {} {}s{}'.format(name, seconds, ' ({:.1f}s since boot)'.format(self.start_uptime + seconds) if self.start_uptime is not None else ''))
+            self.save()
+
+    def save(self):
+        values = dict(self.values, boot_uptime=self.start_uptime)
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump(values, f, indent=2, sort_keys=True)
+        os.rename(self.filename + '.tmp', self.filename)
+
+
+def warm_ranges(db, ranges):
+    '''
+    Read the tiles in ranges into the page cache. Each range is {"z": zoom} or {"z": zoom, "x": [min, max], "y": [min, max]},
+    with XYZ (not TMS) rows
+    '''
+    for tile_range in ranges:
+        z = tile_range['z']
+        # Selecting the data itself, as SQLite reads length() from the record header without reading the overflow pages
+        # that tiles larger than a page are stored in
+        query = 'SELECT tile_data FROM tiles WHERE zoom_level = ?'
+        params = [z]
+        if 'x' in tile_range:
+            query += ' AND tile_column BETWEEN ? AND ?'
+            params += tile_range['x']
+        if 'y' in tile_range:
+            # mbtiles rows count up from the south (TMS)
+            query += ' AND tile_row BETWEEN ? AND ?'
+            params += [(1 << z) - 1 - tile_range['y'][1], (1 << z) - 1 - tile_range['y'][0]]
+        for _ in db.execute(query, params): # One row at a time, so a range isn't held in memory
+            pass
+
+
+def warm(filename, hot_ranges=None):
+    'Read an mbtiles file into the page cache: all of it if it is small, otherwise its hot tile ranges (or low zooms)'
+    if os.path.getsize(filename) <= WARM_FULL_LIMIT:
+        with open(filename, 'rb') as f:
+            while f.read(1 << 20):
+                pass
+        return 'full'
+    db = sqlite3.connect(filename)
+    try:
+        warm_ranges(db, hot_ranges or [{'z': z} for z in range(WARM_ZOOM + 1)])
+    finally:
+        db.close()
+    return 'hot tiles' if hot_ranges else 'zoom 0-{}'.format(WARM_ZOOM)
+
+
+def probe(url, timeout=PROBE_TIMEOUT):
+    'Request a tile until the server responds. Returns whether it did within timeout seconds'
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib2.urlopen(url, timeout=5).read()
+            return True
+        except urllib2.HTTPError as err:
+            if err.code < 500:
+                return True # The server is up, the tile just doesn't exist
+        except Exception:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def layer_order(layers, sizes, priority):
+    'Priority layers first in the given order, then the rest smallest first, so as many layers as possible are ready early'
+    first = [layer for layer in priority if layer in layers]
+    return first + sorted((layer for layer in layers if layer not in first), key=lambda layer: (sizes[layer], layer))
+
+
+class Boot(object):
+    'Tracks layers as their downloads finish, making them ready, starting the server and warming the page cache'
+    def __init__(self, args, layers, priority, hot_tiles, metrics):
+        self.args = args
+        self.layers = layers # layer: {'files': [(key name, cached, destination, previous)], 'downloads': [], 'remaining': parts}
+        self.waiting_for = set(priority) & set(layers) or None # Layers to wait for before serving (None: any one layer)
+        self.hot_tiles = hot_tiles
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.ready = []
+        self.served_with = None # Layers ready when the server was started
+        self.warm_queue = Queue()
+        self.warm_thread = threading.Thread(target=self.warm_layers)
+        self.warm_thread.start()
+
+    def part_finished(self, layer):
+        with self.lock:
+            self.layers[layer]['remaining'] -= 1
+            finished = self.layers[layer]['remaining'] == 0
+        if finished:
+            self.make_ready(layer)
+
+    def make_ready(self, layer):
+        'Verify and link a layer whose files are all downloaded (mbtiles before config, so configs never point at missing files)'
+        for download in self.layers[layer]['downloads']:
+            download.finish()
+        for key_name, cached, destination, previous in sorted(self.layers[layer]['files'], key=lambda f: not f[0].startswith('mbtiles/')):
+            link(cached, destination)
+        with open(os.path.join(self.args.root, 'ready', layer), 'w') as f:
+            json.dump({'time': time.time()}, f)
+        self.metrics.record('ready', layer)
+        with self.lock:
+            self.ready.append(layer)
+            serve = self.served_with is None and (self.waiting_for is None or self.waiting_for <= set(self.ready))
+            if serve:
+                self.served_with = set(self.ready)
+        if len(self.ready) == 1:
+            self.metrics.record('time_to_first_layer_ready')
+        if serve:
+            self.serve(layer)
+        self.warm_queue.put(layer)
+
+    def serve(self, layer):
+        'Start the server, and time how long it takes to serve a tile'
+        if not self.args.serve_command:
+            return
+        print('Starting server with {} of {} layers ready'.format(len(self.served_with), len(self.layers)))
+        subprocess.call(self.args.serve_command, shell=True)
+        self.metrics.record('time_to_server_started')
+        if layer is None:
+            return
+        def first_tile():
+            if probe(self.args.probe_url.format(layer=layer)):
+                self.metrics.record('time_to_first_tile')
+            else:
+                print('Server did not respond within {}s'.format(PROBE_TIMEOUT))
+        thread = threading.Thread(target=first_tile)
+        thread.daemon = True
+        thread.start()
+
+    def warm_layers(self):
+        while True:
+            layer = self.warm_queue.get()
+            if layer is None:
+                return
+            mbtiles = os.path.join(self.args.root, 'data', '{}.mbtiles'.format(layer))
+            try:
+                print('Warmed {} ({})'.format(layer, warm(mbtiles, self.hot_tiles.get(layer))))
+                self.metrics.record('warm', layer)
+            except (IOError, sqlite3.Error) as err:
+                print('Could not warm {}: {}'.format(layer, err))
+
+    def finish(self):
+        'Once every layer is ready: start the server if it hasn\'t been, or restart it to pick up layers made ready since'
+        self.metrics.record('time_to_all_layers_ready')
+        with open(os.path.join(self.args.root, 'ready', 'all'), 'w') as f:
+            json.dump({'time': time.time(), 'layers': self.ready}, f)
+        if self.served_with is None:
+            self.served_with = set(self.ready)
+            self.serve(self.ready[0] if self.ready else None)
+        elif self.served_with != set(self.ready) and self.args.restart_command:
+            print('Restarting server to serve the {} layers made ready since it started'.format(len(set(self.ready) - self.served_with)))
+            subprocess.call(self.args.restart_command, shell=True)
+        self.warm_queue.put(None)
+        self.warm_thread.join()
+        self.metrics.record('time_to_all_layers_warm')
+
+
+def download_deployment(args, metrics):
+    'Download the layers of a deployment, making each ready as it arrives and starting the server as Boot does'
+    cache_dir = args.cache_dir or os.path.join(args.root, 'store')
+
+    # Download deployment json
+    k = Key(get_bucket())
+    k.key = 'deployments/{}/{}.json'.format(args.deployment, args.node) if args.node else 'deployments/{}.json'.format(args.deployment)
+    k.get_contents_to_filename(os.path.join(args.root, 'data.json'))
+
+    with open(os.path.join(args.root, 'data.json')) as data_config:
+        deployment = json.load(data_config)
+    data = deployment['data']
+    priority = [layer for layer in args.priority.split(',') if layer] or deployment.get('priority', [])
+    deltas = deployment.get('deltas', {}) # layer: {"from": version, "key": delta package key}
+    hot_tiles = {}
+    if args.hot_tiles:
+        with open(args.hot_tiles) as f:
+            hot_tiles = json.load(f)
 
-deployment = sys.argv[1]
+    for directory in ['config', 'data', 'ready']:
+        makedirs(os.path.join(args.root, directory))
+    makedirs(cache_dir)
+    for marker in os.listdir(os.path.join(args.root, 'ready')): # From a previous boot
+        os.remove(os.path.join(args.root, 'ready', marker))
 
-# Download deployment json
-k = Key(bucket)
-k.key = 'deployments/{}.json'.format(deployment)
-k.get_contents_to_filename('/etc/vector-tiles/data.json')
+    # (key in S3, versioned file in the cache, file served from, file in a previous deployment) for every config and mbtiles
+    layers = {}
+    for layer, version in data.items():
+        files = layers.setdefault(layer, {'files': [], 'downloads': [], 'remaining': 0})['files']
+        files.append(('config/{}-v{}.json'.format(layer, version), os.path.join(cache_dir, '{}-v{}.json'.format(layer, version)), os.path.join(args.root, 'config', '{}.json'.format(layer)), previous_file(args.previous, layer, version, 'config')))
+        files.append(('mbtiles/{}-v{}.mbtiles'.format(layer, version), os.path.join(cache_dir, '{}-v{}.mbtiles'.format(layer, version)), os.path.join(args.root, 'data', '{}.mbtiles'.format(layer)), previous_file(args.previous, layer, version, 'data')))
 
+    sizes = {}
+    for layer, state in layers.items():
+        sizes[layer] = 0
+        for key_name, cached, destination, previous in state['files']:
+            if not os.path.exists(cached) and previous is not None:
+                try:
+                    link(previous, cached)
+                    print('Linked {} from previous deployment'.format(key_name))
+                except OSError as err:
+                    print('Could not link {} from previous deployment ({}), downloading instead'.format(key_name, err))
+            delta = deltas.get(layer)
+            base = delta and key_name.startswith('mbtiles/') and (
+                cached_file(cache_dir, layer, delta['from']) or previous_file(args.previous, layer, delta['from'], 'data'))
+            if not os.path.exists(cached) and base:
+                download = DeltaDownload(delta['key'], cached + '.delta', base, cached, key_name)
+                print('Downloading {} to apply to {}'.format(delta['key'], base))
+                state['downloads'].append(download)
+                state['remaining'] += len(download.missing_parts())
+                sizes[layer] += download.size
+            elif not os.path.exists(cached):
+                download = Download(key_name, cached)
+                state['downloads'].append(download)
+                state['remaining'] += len(download.missing_parts())
+                sizes[layer] += download.size
 
-with open('/etc/vector-tiles/data.json') as data_config:
-    data = json.load(data_config)['data']
+    order = layer_order(list(layers), sizes, priority)
+    tasks = [(layer, download, i) for layer in order for download in layers[layer]['downloads'] for i in download.missing_parts()]
+    print('Downloading {} files ({} parts) in the order {}'.format(sum(len(state['downloads']) for state in layers.values()), len(tasks), ', '.join(order)))
+    boot = Boot(args, layers, priority, hot_tiles, metrics)
+    try:
+        for layer in order:
+            if layers[layer]['remaining'] == 0: # Already present, or only needs verifying
+                boot.make_ready(layer)
+        def run(task):
+            layer, download, i = task
+            download.download_part(i)
+            boot.part_finished(layer)
+        pool = ThreadPool(args.threads)
+        try:
+            pool.map(run, tasks, chunksize=1) # Parts are started in priority order
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        boot.finish()
 
-os.mkdir('/etc/vector-tiles/config')
-os.mkdir('/etc/vector-tiles/data')
 
-for layer, version in data.iteritems():
-    # Download config
-    k1 = Key(bucket)
-    k1.key = 'config/{}-v{}.json'.format(layer,version)
-    k1.get_contents_to_filename('/etc/vector-tiles/config/{}.json'.format(layer))
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('deployment', help='Name of the deployment (deployments/<name>.json in S3)')
+    parser.add_argument('--node', help='Node of a sharded deployment to download the layers of (deployments/<name>/<node>.json in S3)')
+    parser.add_argument('--root', default=ROOT, help='Server directory to put config/ and data/ in')
+    parser.add_argument('--cache-dir', help='Directory of downloaded layer versions (default: <root>/store)')
+    parser.add_argument('--previous', help='Root directory of a previous deployment to hard link unchanged layer versions from')
+    parser.add_argument('--threads', type=int, default=16, help='Number of parts to download at once')
+    parser.add_argument('--priority', default='', help='Comma separated layers to download (and wait for before serving) first')
+    parser.add_argument('--hot-tiles', help='JSON file of layer: [{"z": zoom, "x": [min, max], "y": [min, max]}, ...] (x and y optional) to warm in large mbtiles')
+    parser.add_argument('--serve-command', help='Command to start the server with once the priority layers (or any layer) are ready')
+    parser.add_argument('--restart-command', help='Command to restart the server with if layers were made ready after it started')
+    parser.add_argument('--probe-url', default='http://localhost:8000/{layer}/0/0/0.pbf', help='Tile URL requested to time the first tile served')
+    args = parser.parse_args()
+    metrics = Metrics(os.path.join(args.root, 'boot-metrics.json'))
+    try:
+        download_deployment(args, metrics)
+    except:
+        # Still start the server, with whatever layers are in place, if the download failed before it was started
+        if args.serve_command and 'time_to_server_started' not in metrics.values:
+            print('Download failed, starting server with the layers already in place')
+            subprocess.call(args.serve_command, shell=True)
+        raise
 
-    # Download mbtiles
-    k2 = Key(bucket)
-    k2.key = 'mbtiles/{}-v{}.mbtiles'.format(layer,version)
-    k2.get_contents_to_filename('/etc/vector-tiles/data/{}.mbtiles'.format(layer))
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# Written for Python 2.7, and kept runnable on Python 3 so scripts/tests can check it against scripts/tile_diff.py
+'''
+Content digests of mbtiles and applying the delta packages made by scripts/tile_diff.py, for download_data.py
+'''
+
+import os, hashlib, sqlite3, shutil, zlib
+
+
+def tile_hashes(db):
+    'Yield (z, x, y, MD5 of the uncompressed tile) for every tile in order, like scripts/tile_diff.py'
+    if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'map'").fetchone():
+        for row in db.execute('SELECT zoom_level, tile_column, tile_row, tile_id FROM map ORDER BY zoom_level, tile_column, tile_row'):
+            yield row
+        return
+    for z, x, y, data in db.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY zoom_level, tile_column, tile_row'):
+        yield z, x, y, tile_hash(data)
+
+
+def tile_hash(data):
+    data = bytes(data)
+    if data[:2] == b'\x1f\x8b':
+        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    return hashlib.md5(data).hexdigest()
+
+
+def content_digest(db):
+    'SHA-256 of the metadata and every tile of an mbtiles, as computed by scripts/tile_diff.py'
+    h = hashlib.sha256()
+    for name, value in sorted(db.execute('SELECT name, value FROM metadata')):
+        h.update(u'{}={}\n'.format(name, value).encode('utf-8'))
+    for z, x, y, tile_id in tile_hashes(db):
+        h.update(u'{}/{}/{}:{}\n'.format(z, x, y, tile_id).encode('utf-8'))
+    return h.hexdigest()
+
+
+def apply_delta(base, delta, output):
+    '''
+    Apply a delta package (made by scripts/tile_diff.py) to a copy of base mbtiles, writing output. Works on plain and
+    compacted (map/images) mbtiles. Raises IOError if base isn't the version the delta applies to, or the result isn't the
+    version it should give
+    '''
+    temp = output + '.tmp'
+    shutil.copyfile(base, temp)
+    try:
+        db = sqlite3.connect(temp)
+        try:
+            db.execute('ATTACH DATABASE ? AS delta', (delta,))
+            digests = dict(db.execute('SELECT name, value FROM delta.delta'))
+            if content_digest(db) != digests['base']:
+                raise IOError('{} is not the version {} applies to'.format(base, delta))
+            removed = 'EXISTS (SELECT 1 FROM delta.removed AS r WHERE r.zoom_level = {0}.zoom_level AND r.tile_column = {0}.tile_column AND r.tile_row = {0}.tile_row)'
+            if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'map'").fetchone():
+                tiles = db.cursor()
+                tiles.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM delta.tiles')
+                for rows in iter(lambda: tiles.fetchmany(1000), []):
+                    for z, x, y, data in rows:
+                        tile_id = tile_hash(data)
+                        db.execute('INSERT INTO images SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM images WHERE tile_id = ?)', (tile_id, data, tile_id))
+                        db.execute('INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?)', (z, x, y, tile_id))
+                db.execute('DELETE FROM map WHERE ' + removed.format('map'))
+                db.execute('DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)')
+            else:
+                db.execute('INSERT OR REPLACE INTO tiles SELECT zoom_level, tile_column, tile_row, tile_data FROM delta.tiles')
+                db.execute('DELETE FROM tiles WHERE ' + removed.format('tiles'))
+            db.execute('DELETE FROM metadata')
+            db.execute('INSERT INTO metadata SELECT name, value FROM delta.metadata')
+            db.commit()
+            db.execute('DETACH DATABASE delta')
+            if content_digest(db) != digests['target']:
+                raise IOError('Applying {} to {} did not give the expected tiles'.format(delta, base))
+            db.execute('VACUUM')
+        finally:
+            db.close()
+        os.rename(temp, output)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)